@@ -0,0 +1,108 @@
+"""
+Benchmark of compressing an upload archive with ParallelGzipCompressor (as
+used by the 'tgz_' upload methods) against a single-threaded 'w:gz' tarfile
+(as used by XnatPy's 'tgz_file' method).
+
+By default a synthetic DICOM series is generated in a temporary directory, but
+an existing series can be passed with '--dir', e.g. (requires xnatutils to be
+installed, e.g. 'pip install -e .')
+
+    $ python benchmarks/bench_gzip.py --size 5120 --jobs 32
+    $ python benchmarks/bench_gzip.py --dir /path/to/dicom/series
+"""
+import os
+import time
+import shutil
+import tarfile
+import tempfile
+import argparse
+from xnatutils.put_ import _tar_stream
+
+
+class NullWriter(object):
+    "Counts the bytes written to it"
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+
+def synthetic_series(directory, size_mb, file_size=512 * 1024):
+    """
+    Writes files resembling DICOMs (a header followed by pixel data with a
+    mixture of background and noisy values) totalling 'size_mb' MB
+    """
+    slice_ = bytearray(file_size)
+    noise = os.urandom(file_size // 4)
+    # Noisy "tissue" in the middle of each slice, background elsewhere
+    start = (file_size - len(noise)) // 2
+    slice_[start:start + len(noise)] = noise
+    header = b"DICM" + b"\0" * 124 + b"synthetic header " * 64
+    for i in range(size_mb * 1024 * 1024 // file_size):
+        with open(os.path.join(directory, "{:06}.dcm".format(i)), "wb") as f:
+            f.write(header)
+            f.write(i.to_bytes(4, "little") + bytes(slice_[4:]))
+
+
+def bench_tarfile(directory):
+    out = NullWriter()
+    with tarfile.open(mode="w:gz", fileobj=out) as tar:
+        tar.add(directory, "")
+    return out.size
+
+
+def bench_parallel(directory, jobs):
+    return sum(len(c) for c in _tar_stream(directory, compress_jobs=jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dir", default=None, help="Directory to archive")
+    parser.add_argument(
+        "--size", type=int, default=512, help="Size of synthetic series in MB"
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="Compression threads"
+    )
+    args = parser.parse_args()
+
+    tmp_dir = None
+    directory = args.dir
+    if directory is None:
+        tmp_dir = directory = tempfile.mkdtemp()
+        synthetic_series(directory, args.size)
+    try:
+        total = sum(
+            os.path.getsize(os.path.join(d, f))
+            for d, _, fs in os.walk(directory)
+            for f in fs
+        )
+        print("Archiving {:.1f} MB in '{}'".format(total / 2**20, directory))
+        for name, func in (
+            ("tarfile w:gz (1 thread)", lambda: bench_tarfile(directory)),
+            (
+                "ParallelGzipCompressor ({} threads)".format(args.jobs),
+                lambda: bench_parallel(directory, args.jobs),
+            ),
+        ):
+            start = time.perf_counter()
+            size = func()
+            elapsed = time.perf_counter() - start
+            print(
+                "{:<40} {:7.2f}s {:8.1f} MB/s  -> {:.1f} MB".format(
+                    name, elapsed, total / 2**20 / elapsed, size / 2**20
+                )
+            )
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Micro-benchmark of LabelMatcher against matching each label with each pattern
+separately (as the matching_* functions used to), over synthetic session
+labels of the form <PROJECT>_<SUBJECT>_<VISIT> (requires xnatutils to be installed, e.g.
+'pip install -e .')
+
+    $ python benchmarks/bench_matcher.py --labels 100000 --patterns 50
+"""
+import re
+import random
+import argparse
+from timeit import timeit
+from xnatutils.base import LabelMatcher
+
+
+def synthetic_labels(num_labels, num_projects=200, seed=0):
+    rng = random.Random(seed)
+    labels = []
+    for i in range(num_labels):
+        labels.append(
+            "PRJ{:03}_{:05}_MR{:02}".format(
+                rng.randrange(num_projects), i, rng.randrange(1, 5)
+            )
+        )
+    return labels
+
+
+def synthetic_patterns(num_patterns, num_projects=200, seed=1):
+    rng = random.Random(seed)
+    return [
+        "PRJ{:03}_.*_MR0[{}]".format(rng.randrange(num_projects), rng.randrange(1, 5))
+        for _ in range(num_patterns)
+    ]
+
+
+def naive_filter(labels, patterns):
+    return [lbl for lbl in labels if any(re.match(p + "$", lbl) for p in patterns)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--labels", type=int, default=100000)
+    parser.add_argument("--patterns", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    labels = synthetic_labels(args.labels)
+    patterns = synthetic_patterns(args.patterns)
+    expected = naive_filter(labels, patterns)
+    assert LabelMatcher(patterns).filter(labels) == expected
+
+    naive = timeit(lambda: naive_filter(labels, patterns), number=args.repeat)
+    matcher = timeit(
+        lambda: LabelMatcher(patterns).filter(labels), number=args.repeat
+    )
+    print(
+        "{} labels x {} patterns ({} matches)".format(
+            len(labels), len(patterns), len(expected)
+        )
+    )
+    print("per-pattern re.match: {:.3f}s".format(naive / args.repeat))
+    print("LabelMatcher.filter:  {:.3f}s".format(matcher / args.repeat))
+    print("speed-up:             {:.1f}x".format(naive / matcher))
+
+
+if __name__ == "__main__":
+    main()
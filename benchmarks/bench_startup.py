@@ -0,0 +1,92 @@
+"""
+Checks the start-up time of the console scripts against a budget, using the
+import times reported by 'python -X importtime' when printing the version of
+each command (i.e. everything a command imports before it does any work,
+excluding the interpreter's own start-up). Commands also fail the check if
+they import XnatPy, requests or pydicom, which should only be imported once a
+command connects to a server.
+Exits with a non-zero status if any of the commands exceed the budget, e.g.
+(requires xnatutils to be installed, e.g. 'pip install -e .')
+
+    $ python benchmarks/bench_startup.py --budget 50
+"""
+import re
+import sys
+import argparse
+import subprocess as sp
+
+COMMANDS = ["get_", "put_", "ls_", "rename_", "varget_", "varput_", "daemon"]
+
+# Modules that should only be imported once a command does some work
+DEFERRED = ["xnat.session", "requests.sessions", "pydicom"]
+
+importtime_re = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+SCRIPT = """
+import sys
+from xnatutils.{} import cmd
+try:
+    cmd(["--version"])
+except SystemExit:
+    pass
+print("deferred:" + ",".join(m for m in {!r} if m in sys.modules), file=sys.stderr)
+"""
+
+
+def startup(module):
+    """
+    Returns the total import time (in ms) of printing the version of a
+    command and the deferred modules that were imported
+    """
+    result = sp.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT.format(module, DEFERRED)],
+        stdout=sp.DEVNULL,
+        stderr=sp.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    total = 0
+    started = False
+    deferred = []
+    for line in result.stderr.split("\n"):
+        if line.startswith("deferred:"):
+            deferred = [m for m in line[len("deferred:"):].split(",") if m]
+        match = importtime_re.match(line)
+        # Only count the top-level imports as they include their children,
+        # skipping those made by the interpreter on start-up (i.e. 'site')
+        if match is not None and not match.group(3):
+            started |= match.group(4).startswith("xnatutils")
+            if started:
+                total += int(match.group(2))
+    return total / 1000.0, deferred
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--budget", type=float, default=50.0, help="Import time budget (ms)"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for module in COMMANDS:
+        # Take the fastest of the runs to reduce noise from the OS page cache
+        runs = [startup(module) for _ in range(args.repeat)]
+        time_ms = min(t for t, _ in runs)
+        deferred = runs[0][1]
+        ok = time_ms <= args.budget and not deferred
+        failed |= not ok
+        print(
+            "{:10} {:7.1f} ms  {}{}".format(
+                module,
+                time_ms,
+                "OK" if ok else "OVER BUDGET",
+                " (imported {})".format(", ".join(deferred)) if deferred else "",
+            )
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
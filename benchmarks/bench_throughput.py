@@ -0,0 +1,236 @@
+"""
+End-to-end throughput benchmark of the xnat-utils commands against a local
+mock XNAT server (see 'mock_xnat.py'), which is filled with synthetic projects
+of a configurable size. The wall time, number of requests (and requests/sec)
+and the data transferred (MB/s) are reported for listing with 'ls', for
+downloading with 'get' using each of the download methods and for uploading
+with 'put' using each of the upload methods, e.g. (requires xnatutils to be
+installed, e.g. 'pip install -e .')
+
+    $ python benchmarks/bench_throughput.py --subjects 20 --files 50
+    $ python benchmarks/bench_throughput.py --commands get --jobs 4 \\
+        --download_methods per_file --file_jobs 8 --output results.json
+
+The mock server runs in the same process as the commands, so the results are
+mostly a measure of the client-side overhead (e.g. the number of requests
+made and the cost of handling each of them) rather than of the network.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+from contextlib import contextmanager
+from mock_xnat import MockXnatServer, MockArchive
+import xnatutils
+from xnatutils.get_ import download_methods
+from xnatutils.put_ import upload_methods
+
+COMMANDS = ("ls", "get", "put")
+
+
+@contextmanager
+def quiet():
+    """
+    Silences the progress messages and bars printed by the commands (at the
+    file descriptor level, as XnatPy's progress bars hold on to the original
+    stderr)
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    try:
+        with open(os.devnull, "w") as devnull:
+            os.dup2(devnull.fileno(), 1)
+            os.dup2(devnull.fileno(), 2)
+            try:
+                yield
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+    finally:
+        for fd in saved:
+            os.close(fd)
+
+
+def measure(server, name, method, func, repeat=1):
+    """
+    Runs a command 'repeat' times and returns the fastest wall time along
+    with the requests made and bytes transferred in that run
+    """
+    best = None
+    for _ in range(repeat):
+        server.reset_stats()
+        start = time.perf_counter()
+        with quiet():
+            func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best["wall_secs"]:
+            stats = server.stats
+            best = {
+                "command": name,
+                "method": method,
+                "wall_secs": elapsed,
+                "requests": stats["requests"],
+                "requests_per_sec": stats["requests"] / elapsed,
+                "mb": (stats["bytes_sent"] + stats["bytes_received"]) / 2**20,
+                "mb_per_sec": (stats["bytes_sent"] + stats["bytes_received"])
+                / 2**20
+                / elapsed,
+            }
+    return best
+
+
+def bench_ls(server, args, login_kwargs):
+    project = "MOCK001"
+    session = "MOCK001_001_MR01"
+    for datatype, kwargs in (
+        ("project", {}),
+        ("subject", {"xnat_id": project}),
+        ("session", {"project_id": project}),
+        ("scan", {"xnat_id": session}),
+    ):
+        yield measure(
+            server,
+            "ls",
+            datatype,
+            lambda: xnatutils.ls(datatype=datatype, **kwargs, **login_kwargs),
+            repeat=args.repeat,
+        )
+
+
+def bench_get(server, args, login_kwargs):
+    for method in args.download_methods:
+
+        def run():
+            download_dir = tempfile.mkdtemp()
+            try:
+                xnatutils.get(
+                    "MOCK001_.*",
+                    download_dir,
+                    project_id="MOCK001",
+                    method=method,
+                    jobs=args.jobs,
+                    file_jobs=args.file_jobs,
+                    **login_kwargs,
+                )
+            finally:
+                shutil.rmtree(download_dir)
+
+        yield measure(server, "get", method, run, repeat=args.repeat)
+
+
+def bench_put(server, args, login_kwargs):
+    upload_dir = tempfile.mkdtemp()
+    try:
+        for i in range(args.files):
+            with open(os.path.join(upload_dir, "{:04}.dcm".format(i)), "wb") as f:
+                f.write(os.urandom(args.file_size))
+        uploads = iter(range(10**6))
+        for method in args.upload_methods:
+
+            def run():
+                # Upload to a new scan each time so nothing is overwritten
+                xnatutils.put(
+                    "MOCK001_001_MR01",
+                    "upload{}".format(next(uploads)),
+                    upload_dir,
+                    resource_name="DICOM",
+                    method=method,
+                    **login_kwargs,
+                )
+
+            yield measure(server, "put", method, run, repeat=args.repeat)
+    finally:
+        shutil.rmtree(upload_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--projects", type=int, default=1)
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=2, help="Per subject")
+    parser.add_argument("--scans", type=int, default=4, help="Per session")
+    parser.add_argument("--files", type=int, default=10, help="Per scan")
+    parser.add_argument(
+        "--file_size", type=int, default=2**18, help="Size of each file (bytes)"
+    )
+    parser.add_argument("--commands", nargs="+", default=COMMANDS, choices=COMMANDS)
+    parser.add_argument(
+        "--download_methods",
+        nargs="+",
+        default=download_methods,
+        choices=download_methods,
+    )
+    parser.add_argument(
+        "--upload_methods", nargs="+", default=upload_methods, choices=upload_methods
+    )
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--file_jobs", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output", default=None, help="Save the results to a JSON file"
+    )
+    args = parser.parse_args()
+
+    archive = MockArchive().populate(
+        projects=args.projects,
+        subjects=args.subjects,
+        sessions=args.sessions,
+        scans=args.scans,
+        files=args.files,
+        file_size=args.file_size,
+    )
+    server = MockXnatServer(archive=archive).start()
+    cache_dir = tempfile.mkdtemp()
+    # Cache the data model of the mock server separately from real ones and
+    # don't reuse sessions held by a running session daemon
+    environ = dict(os.environ)
+    os.environ["XNATUTILS_CACHE_DIR"] = cache_dir
+    os.environ["XNATUTILS_NO_DAEMON"] = "1"
+    os.environ["XNATUTILS_CACHE_SCHEMA"] = "1"
+    login_kwargs = {"server": server.url, "user": "mock", "password": "mock"}
+    results = []
+    try:
+        # Build (and cache) the data model before timing anything
+        with xnatutils.connect(**login_kwargs):
+            pass
+        print(
+            "{} sessions of {} scans of {} x {:.2f} MB files".format(
+                len(archive.experiments),
+                args.scans,
+                args.files,
+                args.file_size / 2**20,
+            )
+        )
+        print(
+            "{:<5} {:<12} {:>9} {:>9} {:>9} {:>9}".format(
+                "", "", "wall (s)", "requests", "req/s", "MB/s"
+            )
+        )
+        benches = {"ls": bench_ls, "get": bench_get, "put": bench_put}
+        for command in args.commands:
+            for result in benches[command](server, args, login_kwargs):
+                results.append(result)
+                print(
+                    "{command:<5} {method:<12} {wall_secs:9.3f} {requests:9} "
+                    "{requests_per_sec:9.1f} {mb_per_sec:9.1f}".format(**result)
+                )
+    finally:
+        server.stop()
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(cache_dir)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,976 @@
+"""
+A local stand-in for an XNAT server, used to benchmark the xnat-utils commands
+without a real server. It implements (a simplified version of) the REST API
+that XnatPy and xnat-utils use, i.e. logging in, a minimal data model schema,
+listings and objects under '/data/archive', '/data/projects' and
+'/data/experiments', resources and their files (including zip and tar.gz
+downloads of whole resources and archive uploads that are extracted on
+arrival). The archive is held in memory and filled with synthetic projects,
+e.g.
+
+    >>> server = MockXnatServer()
+    >>> server.archive.populate(projects=2, subjects=5, sessions=2, scans=3,
+    ...                       files=10, file_size=2**20)
+    >>> server.start()
+    >>> xnatutils.ls('MOCK001', server=server.url, user='mock',
+    ...              password='mock')
+
+The number of requests handled and the bytes sent and received by the server
+are counted in 'server.stats'. It can also be run on its own, e.g.
+
+    $ python benchmarks/mock_xnat.py --port 8080 --subjects 10
+"""
+import io
+import re
+import sys
+import json
+import time
+import random
+import uuid
+import fnmatch
+import hashlib
+import zipfile
+import tarfile
+import argparse
+import threading
+from datetime import datetime
+from collections import OrderedDict, Counter
+from urllib.parse import urlsplit, parse_qsl, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+XNAT_VERSION = "1.8.5"
+
+# A cut-down version of 'xnat.xsd' with just the datatypes used by xnat-utils,
+# which is enough for XnatPy to build the classes of its data model
+SCHEMA = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema targetNamespace="http://nrg.wustl.edu/xnat" xmlns:xnat="http://nrg.wustl.edu/xnat" xmlns:xs="http://www.w3.org/2001/XMLSchema" elementFormDefault="qualified" attributeFormDefault="unqualified">
+  <xs:element name="Project" type="xnat:projectData"/>
+  <xs:element name="Subject" type="xnat:subjectData"/>
+  <xs:element name="MRSession" type="xnat:mrSessionData"/>
+  <xs:element name="MRScan" type="xnat:mrScanData"/>
+  <xs:element name="ResourceCatalog" type="xnat:resourceCatalog"/>
+  <xs:complexType name="abstractResource" abstract="true">
+    <xs:attribute name="label" type="xs:string"/>
+    <xs:attribute name="file_count" type="xs:integer"/>
+    <xs:attribute name="file_size" type="xs:integer"/>
+  </xs:complexType>
+  <xs:complexType name="resource">
+    <xs:complexContent>
+      <xs:extension base="xnat:abstractResource">
+        <xs:attribute name="URI" type="xs:string"/>
+        <xs:attribute name="format" type="xs:string"/>
+        <xs:attribute name="content" type="xs:string"/>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="resourceCatalog">
+    <xs:complexContent>
+      <xs:extension base="xnat:resource"/>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="projectData">
+    <xs:sequence>
+      <xs:element name="name" type="xs:string"/>
+      <xs:element name="description" type="xs:string" minOccurs="0"/>
+      <xs:element name="resources" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="resource" type="xnat:abstractResource" minOccurs="0" maxOccurs="unbounded"/>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+      <xs:element name="fields" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="field" minOccurs="0" maxOccurs="unbounded">
+              <xs:complexType>
+                <xs:simpleContent>
+                  <xs:extension base="xs:string">
+                    <xs:attribute name="name" type="xs:string" use="required"/>
+                  </xs:extension>
+                </xs:simpleContent>
+              </xs:complexType>
+            </xs:element>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+    <xs:attribute name="secondary_ID" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="subjectData">
+    <xs:sequence>
+      <xs:element name="resources" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="resource" type="xnat:abstractResource" minOccurs="0" maxOccurs="unbounded"/>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+      <xs:element name="experiments" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="experiment" type="xnat:subjectAssessorData" minOccurs="0" maxOccurs="unbounded"/>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+      <xs:element name="fields" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="field" minOccurs="0" maxOccurs="unbounded">
+              <xs:complexType>
+                <xs:simpleContent>
+                  <xs:extension base="xs:string">
+                    <xs:attribute name="name" type="xs:string" use="required"/>
+                  </xs:extension>
+                </xs:simpleContent>
+              </xs:complexType>
+            </xs:element>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string"/>
+    <xs:attribute name="project" type="xs:string"/>
+    <xs:attribute name="label" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="experimentData" abstract="true">
+    <xs:sequence>
+      <xs:element name="date" type="xs:date" minOccurs="0"/>
+      <xs:element name="resources" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="resource" type="xnat:abstractResource" minOccurs="0" maxOccurs="unbounded"/>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+      <xs:element name="fields" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="field" minOccurs="0" maxOccurs="unbounded">
+              <xs:complexType>
+                <xs:simpleContent>
+                  <xs:extension base="xs:string">
+                    <xs:attribute name="name" type="xs:string" use="required"/>
+                  </xs:extension>
+                </xs:simpleContent>
+              </xs:complexType>
+            </xs:element>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+    <xs:attribute name="project" type="xs:string" use="required"/>
+    <xs:attribute name="label" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="subjectAssessorData" abstract="true">
+    <xs:complexContent>
+      <xs:extension base="xnat:experimentData">
+        <xs:sequence>
+          <xs:element name="subject_ID" type="xs:string"/>
+        </xs:sequence>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="imageSessionData" abstract="true">
+    <xs:complexContent>
+      <xs:extension base="xnat:subjectAssessorData">
+        <xs:sequence>
+          <xs:element name="scans" minOccurs="0">
+            <xs:complexType>
+              <xs:sequence>
+                <xs:element name="scan" type="xnat:imageScanData" minOccurs="0" maxOccurs="unbounded"/>
+              </xs:sequence>
+            </xs:complexType>
+          </xs:element>
+        </xs:sequence>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="mrSessionData">
+    <xs:complexContent>
+      <xs:extension base="xnat:imageSessionData"/>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="imageScanData" abstract="true">
+    <xs:sequence>
+      <xs:element name="image_session_ID" type="xs:string" minOccurs="0"/>
+      <xs:element name="file" type="xnat:abstractResource" minOccurs="0" maxOccurs="unbounded"/>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+    <xs:attribute name="type" type="xs:string"/>
+    <xs:attribute name="project" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="mrScanData">
+    <xs:complexContent>
+      <xs:extension base="xnat:imageScanData"/>
+    </xs:complexContent>
+  </xs:complexType>
+</xs:schema>
+"""
+
+# The XSI types of the objects in each kind of collection
+XSI_TYPES = {
+    "projects": "xnat:projectData",
+    "subjects": "xnat:subjectData",
+    "experiments": "xnat:mrSessionData",
+    "scans": "xnat:mrScanData",
+    "resources": "xnat:resourceCatalog",
+}
+
+# Collections that can be nested within each kind of object
+CHILDREN = {
+    "projects": ("subjects", "experiments", "resources"),
+    "subjects": ("experiments", "resources"),
+    "experiments": ("scans", "resources"),
+    "scans": ("resources",),
+    "resources": (),
+}
+
+custom_field_re = re.compile(r".*/fields/field\[name=([^\]]+)\]/field$")
+date_range_re = re.compile(r"(\d\d/\d\d/\d{4})-(\d\d/\d\d/\d{4})")
+range_re = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class Node(object):
+    """
+    An object in the mock archive (i.e. a project, subject, session, scan or
+    resource)
+    """
+
+    def __init__(self, kind, id_, parent=None, **fields):
+        self.kind = kind
+        self.id = id_
+        self.parent = parent
+        self.xsi_type = XSI_TYPES[kind]
+        self.fields = fields
+        self.custom_fields = {}
+        self.children = {c: OrderedDict() for c in CHILDREN[kind]}
+        # Only used by resources, the downloads of whole resources are cached
+        # until the files change (as they are the slowest requests to serve)
+        self.files = OrderedDict()
+        self.archives = {}
+
+    @property
+    def label(self):
+        return self.fields.get("label", self.id)
+
+    def find(self, kind, key):
+        "Finds a child by ID or label"
+        children = self.children[kind]
+        if key in children:
+            return children[key]
+        return next((c for c in children.values() if c.label == key), None)
+
+    def ancestor(self, kind):
+        node = self
+        while node is not None and node.kind != kind:
+            node = node.parent
+        return node
+
+
+class MockArchive(object):
+    """
+    The in-memory data of the mock server, which is filled with synthetic
+    projects by 'populate'
+    """
+
+    def __init__(self):
+        self.projects = OrderedDict()
+        self.subjects = {}
+        self.experiments = {}
+        self.lock = threading.RLock()
+        self._ids = Counter()
+
+    def populate(
+        self,
+        projects=1,
+        subjects=10,
+        sessions=2,
+        scans=4,
+        files=5,
+        file_size=2**20,
+        resource="DICOM",
+        seed=0,
+    ):
+        """
+        Adds synthetic projects to the archive, which are named 'MOCK001',
+        'MOCK002', etc. and contain subjects ('MOCK001_001', ...) and sessions
+        ('MOCK001_001_MR01', ...)
+
+        Parameters
+        ----------
+        projects : int
+            The number of projects to add
+        subjects : int
+            The number of subjects in each project
+        sessions : int
+            The number of sessions of each subject
+        scans : int
+            The number of scans in each session
+        files : int
+            The number of files in the resource of each scan
+        file_size : int
+            The size of each file (in bytes)
+        resource : str
+            The name of the resource of each scan
+        seed : int
+            Seed for the random contents of the files (all files have the same
+            contents to save memory, except for their first 16 bytes)
+        """
+        # Random so the files don't compress better than real data would
+        payload = random.Random(seed).getrandbits(file_size * 8)
+        payload = payload.to_bytes(file_size, "little")
+        with self.lock:
+            for p in range(len(self.projects) + 1, len(self.projects) + projects + 1):
+                project = self.add_project("MOCK{:03}".format(p))
+                for s in range(1, subjects + 1):
+                    subject = self.add(
+                        project, "subjects", "{}_{:03}".format(project.id, s)
+                    )
+                    for e in range(1, sessions + 1):
+                        session = self.add(
+                            subject,
+                            "experiments",
+                            "{}_MR{:02}".format(subject.label, e),
+                            date="2020-01-{:02}".format(e % 28 + 1),
+                        )
+                        for n in range(1, scans + 1):
+                            scan = self.add(
+                                session,
+                                "scans",
+                                str(n),
+                                type="scan{}".format(n),
+                            )
+                            res = self.add(scan, "resources", resource)
+                            for f in range(1, files + 1):
+                                name = "{}-{:04}.dcm".format(n, f)
+                                # Make each file unique so digests differ
+                                unique = hashlib.md5(
+                                    "{}/{}".format(scan.parent.id, name).encode()
+                                ).digest()
+                                res.files[name] = (unique + payload)[:file_size]
+        return self
+
+    def add_project(self, id_):
+        project = Node("projects", id_, name=id_, secondary_ID=id_)
+        self.projects[id_] = project
+        return project
+
+    def add(self, parent, kind, label, **fields):
+        """
+        Adds a subject, session, scan or resource to the parent, assigning
+        it an ID in the same way XNAT does
+        """
+        with self.lock:
+            if kind == "scans":
+                id_ = label
+                fields.setdefault("type", label)
+            else:
+                self._ids[kind] += 1
+                if kind == "resources":
+                    id_ = str(self._ids[kind])
+                else:
+                    id_ = "MOCK_{}{:05}".format(kind[0].upper(), self._ids[kind])
+            if kind == "resources":
+                fields["label"] = label
+            elif kind != "scans":
+                fields["label"] = label
+            project = parent.ancestor("projects")
+            if project is not None:
+                fields["project"] = project.id
+            node = Node(kind, id_, parent=parent, **fields)
+            if kind == "subjects":
+                self.subjects[id_] = node
+            elif kind == "experiments":
+                subject = parent.ancestor("subjects")
+                node.fields["subject_ID"] = subject.id
+                # Sessions are listed under both the subject and project
+                subject.children["experiments"][id_] = node
+                parent = project
+                self.experiments[id_] = node
+            parent.children[kind][id_] = node
+            return node
+
+    def remove(self, node):
+        with self.lock:
+            if node.kind == "experiments":
+                self.experiments.pop(node.id, None)
+                node.ancestor("subjects").children["experiments"].pop(node.id, None)
+                node.parent.children["experiments"].pop(node.id, None)
+            elif node.kind == "subjects":
+                self.subjects.pop(node.id, None)
+                node.parent.children["subjects"].pop(node.id, None)
+            elif node.kind == "projects":
+                self.projects.pop(node.id, None)
+            else:
+                node.parent.children[node.kind].pop(node.id, None)
+
+    def resolve(self, segments):
+        """
+        Resolves the segments of a REST path (after '/data') into the object
+        they refer to, plus the name of the collection and the key of the
+        object if they refer to a collection or a missing object
+
+        Returns
+        -------
+        node : Node | None
+            The last object in the path that exists
+        collection : str | None
+            The collection listed (or that the missing object belongs to)
+        key : str | None
+            The ID or label of the missing object (None for collections)
+        rest : list(str)
+            The remaining segments after 'files' (i.e. a path within a
+            resource)
+        """
+        if segments and segments[0] == "archive":
+            segments = segments[1:]
+        node = None
+        i = 0
+        while i < len(segments):
+            collection = segments[i]
+            if collection == "files" and node is not None:
+                return node, "files", None, segments[i + 1:]
+            key = segments[i + 1] if i + 1 < len(segments) else None
+            if node is None:
+                index = {
+                    "projects": self.projects,
+                    "subjects": self.subjects,
+                    "experiments": self.experiments,
+                }.get(collection)
+                if index is None:
+                    raise KeyError(collection)
+                child = None
+                if key is not None:
+                    child = index.get(key)
+                    if child is None and collection == "experiments":
+                        # Sessions can be looked up by label if unique
+                        matches = [e for e in index.values() if e.label == key]
+                        child = matches[0] if len(matches) == 1 else None
+            else:
+                if collection not in node.children:
+                    raise KeyError(collection)
+                child = node.find(collection, key) if key is not None else None
+            if key is None or child is None:
+                if key is not None and i + 2 < len(segments):
+                    raise KeyError(key)
+                return node, collection, key, []
+            node = child
+            i += 2
+        return node, None, None, []
+
+
+class MockXnatHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    server_version = "MockXNAT/" + XNAT_VERSION
+    # Otherwise responses are held back waiting for the client's ACK of the
+    # headers, when they are written separately to the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    @property
+    def archive(self):
+        return self.server.archive
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_HEAD(self):
+        self._dispatch("GET")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_POST(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        start = time.monotonic()
+        parts = urlsplit(self.path)
+        self.query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        self.segments = [unquote(s) for s in parts.path.split("/") if s]
+        self.sent = 0
+        self.received = 0
+        try:
+            body = self._read_body()
+            self._route(method, body)
+        except KeyError as e:
+            self._send_text("Not found: {}".format(e), status=404)
+        except (ValueError, tarfile.TarError, zipfile.BadZipFile) as e:
+            self._send_text("Bad request: {}".format(e), status=400)
+        self.server.record(
+            method, parts.path, self.sent, self.received, time.monotonic() - start
+        )
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = io.BytesIO()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                body.write(self.rfile.read(size))
+                self.rfile.readline()
+            data = body.getvalue()
+        else:
+            data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.received = len(data)
+        return data
+
+    def _route(self, method, body):
+        segments = self.segments
+        if not segments:
+            return self._send_text("<html>Mock XNAT</html>", "text/html")
+        if segments[0] == "xapi":
+            if segments[1:] == ["siteConfig", "buildInfo"]:
+                return self._send_json({"version": XNAT_VERSION})
+            if segments[1:] == ["schemas"]:
+                return self._send_json(["xnat"])
+            if segments[1:] == ["schemas", "xnat"]:
+                return self._send_text(SCHEMA, "application/xml")
+            raise KeyError(self.path)
+        if segments[0] != "data":
+            raise KeyError(self.path)
+        segments = segments[1:]
+        if segments == ["services", "auth"]:
+            jsession = uuid.uuid4().hex.upper()
+            self.server.sessions.add(jsession)
+            return self._send_text(jsession)
+        if segments == ["JSESSION"]:
+            if method == "DELETE":
+                self.server.sessions.discard(self._jsession())
+                return self._send_text("")
+            return self._send_text(self._jsession() or "")
+        if self._jsession() not in self.server.sessions:
+            return self._send_text(
+                "Login attempt failed. Please try again.", status=401
+            )
+        if segments == ["auth"]:
+            return self._send_text("User '{}' is logged in".format(self.server.user))
+        if segments == ["version"]:
+            raise KeyError("version")
+        if segments[:2] == ["search", "elements"]:
+            if len(segments) == 2:
+                rows = [{"ELEMENT_NAME": t} for t in sorted(set(XSI_TYPES.values()))]
+            else:
+                rows = [{"FIELD_ID": f} for f in ("ID", "LABEL", "PROJECT")]
+            return self._send_json(_result_set(rows))
+        with self.archive.lock:
+            node, collection, key, rest = self.archive.resolve(segments)
+            if method == "GET":
+                return self._get(node, collection, key, rest)
+            if method == "PUT":
+                return self._put(node, collection, key, rest, body)
+            return self._delete(node, collection, key, rest)
+
+    def _get(self, node, collection, key, rest):
+        if collection == "files":
+            if rest:
+                return self._send_file(node, "/".join(rest))
+            fmt = self.query.get("format")
+            if fmt in ("zip", "tar.gz"):
+                return self._send_archive(node, fmt)
+            return self._send_json(_result_set(self._file_rows(node)))
+        if key is not None:
+            raise KeyError(key)
+        if collection is not None:
+            return self._send_json(_result_set(self._list(node, collection)))
+        return self._send_json({"items": [_object_json(node)]})
+
+    def _put(self, node, collection, key, rest, body):
+        if collection == "files":
+            name = "/".join(rest)
+            extract = self.query.get("extract", "").lower() == "true"
+            node.archives.clear()
+            if extract and name.endswith((".tar", ".tar.gz", ".tgz", ".zip")):
+                _extract(node, name, body)
+            else:
+                if name in node.files and self.query.get("overwrite") != "true":
+                    return self._send_text("File already exists", status=409)
+                node.files[name] = body
+            return self._send_text("", status=200)
+        fields = {}
+        for xpath, value in self.query.items():
+            match = custom_field_re.match(xpath)
+            if match is not None:
+                fields[("custom", match.group(1))] = value
+            elif "/" in xpath:
+                fields[xpath.split("/")[-1]] = value
+        if key is not None:
+            if node is None:
+                if collection != "projects":
+                    raise KeyError(key)
+                node = self.archive.add_project(key)
+            else:
+                label = fields.pop("label", key)
+                if collection == "scans":
+                    label = fields.pop("ID", key)
+                node = self.archive.add(node, collection, label)
+                if collection == "resources" and "format" in self.query:
+                    node.fields["format"] = self.query["format"]
+        elif collection is not None:
+            raise ValueError("Cannot PUT to a listing")
+        for name, value in fields.items():
+            if isinstance(name, tuple):
+                node.custom_fields[name[1]] = value
+            elif name not in ("ID", "project", "subject_ID"):
+                node.fields[name] = value
+        return self._send_text(node.id, status=200)
+
+    def _delete(self, node, collection, key, rest):
+        if collection == "files" and rest:
+            node.archives.clear()
+            if node.files.pop("/".join(rest), None) is None:
+                raise KeyError("/".join(rest))
+        elif key is not None or collection is not None:
+            raise KeyError(key or collection)
+        else:
+            self.archive.remove(node)
+        self._send_text("")
+
+    def _list(self, node, collection):
+        if node is None:
+            index = {
+                "projects": self.archive.projects,
+                "subjects": self.archive.subjects,
+                "experiments": self.archive.experiments,
+            }[collection]
+            children = list(index.values())
+        else:
+            children = list(node.children[collection].values())
+        columns = [c for c in self.query.get("columns", "").split(",") if c]
+        rows = []
+        for child in children:
+            row = self._row(child, collection)
+            if not self._matches(row):
+                continue
+            for column in columns:
+                match = custom_field_re.match(column)
+                if match is not None:
+                    row[column] = child.custom_fields.get(match.group(1), "")
+            if "xnat:imagescandata/id" in columns and child.kind == "experiments":
+                # One row per scan (as a join on the scans of the session)
+                scans = list(child.children["scans"].values())
+                for scan in scans or [None]:
+                    scan_row = dict(row)
+                    scan_row["xnat:imagescandata/id"] = scan.id if scan else ""
+                    scan_row["xnat:imagescandata/type"] = (
+                        scan.fields.get("type", "") if scan else ""
+                    )
+                    rows.append(scan_row)
+            else:
+                rows.append(row)
+        return rows
+
+    def _row(self, node, collection):
+        uri = self._uri(node)
+        if collection == "projects":
+            return {
+                "ID": node.id,
+                "name": node.fields.get("name", node.id),
+                "secondary_ID": node.fields.get("secondary_ID", node.id),
+                "URI": uri,
+            }
+        if collection == "subjects":
+            return {
+                "ID": node.id,
+                "label": node.label,
+                "project": node.fields.get("project", ""),
+                "URI": uri,
+            }
+        if collection == "experiments":
+            return {
+                "ID": node.id,
+                "label": node.label,
+                "xsiType": node.xsi_type,
+                "date": node.fields.get("date", ""),
+                "project": node.fields.get("project", ""),
+                "subject_ID": node.fields.get("subject_ID", ""),
+                "URI": uri,
+            }
+        if collection == "scans":
+            return {
+                "ID": node.id,
+                "type": node.fields.get("type", ""),
+                "xsiType": node.xsi_type,
+                "xnat_imagescandata_id": node.id,
+                "URI": uri,
+            }
+        # Resource listings don't include the ID or URI (as in XNAT)
+        return {
+            "xnat_abstractresource_id": node.id,
+            "label": node.label,
+            "element_name": node.xsi_type,
+            "format": node.fields.get("format", ""),
+            "file_count": str(len(node.files)),
+            "file_size": str(sum(len(d) for d in node.files.values())),
+        }
+
+    def _matches(self, row):
+        for name, pattern in self.query.items():
+            if name in ("columns", "format") or name not in row:
+                continue
+            if name == "date":
+                match = date_range_re.match(pattern)
+                if match is not None:
+                    if not row["date"]:
+                        return False
+                    date = datetime.strptime(row["date"], "%Y-%m-%d")
+                    start, end = (
+                        datetime.strptime(d, "%m/%d/%Y") for d in match.groups()
+                    )
+                    if not start <= date <= end:
+                        return False
+                continue
+            if not fnmatch.fnmatchcase(row[name], pattern):
+                return False
+        return True
+
+    def _uri(self, node):
+        if node.kind == "projects":
+            return "/data/projects/" + node.id
+        if node.kind in ("subjects", "experiments"):
+            return "/data/{}/{}".format(node.kind, node.id)
+        return "{}/{}/{}".format(self._uri(node.parent), node.kind, node.id)
+
+    def _file_rows(self, resource):
+        uri = self._uri(resource)
+        return [
+            {
+                "Name": name.split("/")[-1],
+                "Size": str(len(data)),
+                "URI": "{}/files/{}".format(uri, name),
+                "digest": hashlib.md5(data).hexdigest(),
+                "collection": resource.label,
+                "file_tags": "",
+                "file_format": "",
+                "file_content": "",
+                "cat_ID": resource.id,
+            }
+            for name, data in resource.files.items()
+        ]
+
+    def _send_file(self, resource, name):
+        data = resource.files[name]
+        match = range_re.match(self.headers.get("Range", ""))
+        if match is not None and int(match.group(1)) < len(data):
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(data)
+            return self._send(
+                data[start:end],
+                "application/octet-stream",
+                status=206,
+                headers={
+                    "Content-Range": "bytes {}-{}/{}".format(start, end - 1, len(data))
+                },
+            )
+        self._send(data, "application/octet-stream")
+
+    def _send_archive(self, resource, fmt):
+        if fmt not in resource.archives:
+            resource.archives[fmt] = _archive(resource, fmt)
+        self._send(
+            resource.archives[fmt],
+            "application/zip" if fmt == "zip" else "application/x-gzip",
+        )
+
+    def _jsession(self):
+        for cookie in self.headers.get_all("Cookie") or []:
+            for part in cookie.split(";"):
+                name, _, value = part.strip().partition("=")
+                if name == "JSESSIONID":
+                    return value
+        return None
+
+    def _send_json(self, obj):
+        self._send(json.dumps(obj).encode("utf-8"), "application/json")
+
+    def _send_text(self, text, content_type="text/plain", status=200):
+        self._send(text.encode("utf-8"), content_type, status=status)
+
+    def _send(self, data, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if status == 200 and self.segments == ["data", "services", "auth"]:
+            self.send_header(
+                "Set-Cookie", "JSESSIONID={}; Path=/".format(data.decode("utf-8"))
+            )
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+        self.sent = len(data)
+
+
+def _result_set(rows):
+    return {"ResultSet": {"Result": rows, "totalRecords": str(len(rows))}}
+
+
+def _object_json(node):
+    data_fields = dict(node.fields)
+    data_fields["ID"] = node.id
+    if node.kind == "scans":
+        data_fields["xnat_imagescandata_id"] = node.id
+        data_fields["image_session_ID"] = node.parent.id
+    elif node.kind == "resources":
+        data_fields["xnat_abstractresource_id"] = node.id
+        data_fields["file_count"] = len(node.files)
+    children = []
+    if node.custom_fields:
+        children.append(
+            {
+                "field": "fields/field",
+                "items": [
+                    {
+                        "children": [],
+                        "meta": {"xsi:type": "xnat:experimentData_field"},
+                        "data_fields": {"name": name, "field": value},
+                    }
+                    for name, value in node.custom_fields.items()
+                ],
+            }
+        )
+    return {
+        "children": children,
+        "meta": {"xsi:type": node.xsi_type, "isHistory": False},
+        "data_fields": data_fields,
+    }
+
+
+def _archive(resource, fmt):
+    "Generates a zip or tar.gz archive of the files in a resource"
+    session = resource.ancestor("experiments")
+    scan = resource.ancestor("scans")
+    prefix = session.label if session is not None else resource.parent.label
+    if scan is not None:
+        prefix += "/scans/{}-{}".format(scan.id, scan.fields.get("type", ""))
+    prefix += "/resources/{}/files/".format(resource.label)
+    buf = io.BytesIO()
+    if fmt == "zip":
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as archive:
+            for name, data in resource.files.items():
+                archive.writestr(prefix + name, data)
+    else:
+        with tarfile.open(fileobj=buf, mode="w:gz", compresslevel=1) as archive:
+            for name, data in resource.files.items():
+                info = tarfile.TarInfo(prefix + name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _extract(resource, name, body):
+    "Extracts an uploaded archive into a resource (as XNAT does)"
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            for member in archive.infolist():
+                if not member.is_dir():
+                    resource.files[member.filename] = archive.read(member)
+    else:
+        with tarfile.open(fileobj=io.BytesIO(body), mode="r:*") as archive:
+            for member in archive:
+                if member.isfile():
+                    resource.files[member.name] = archive.extractfile(member).read()
+
+
+class MockXnatServer(ThreadingHTTPServer):
+    """
+    An HTTP server that stands in for XNAT (see the module docstring), which
+    accepts any user and password
+
+    Parameters
+    ----------
+    port : int
+        The port to listen on (0 picks a free port)
+    archive : MockArchive | None
+        The data served, empty by default
+    user : str
+        The user reported as logged in
+    verbose : bool
+        Whether to log each request
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, archive=None, user="mock", verbose=False):
+        super().__init__(("127.0.0.1", port), MockXnatHandler)
+        self.archive = archive if archive is not None else MockArchive()
+        self.user = user
+        self.verbose = verbose
+        self.sessions = set()
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def record(self, method, path, sent, received, duration):
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["requests_" + method] += 1
+            self.stats["bytes_sent"] += sent
+            self.stats["bytes_received"] += received
+            self.stats["busy_secs"] += duration
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats.clear()
+
+    def start(self):
+        "Serves requests in a background thread"
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--projects", type=int, default=1)
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=2)
+    parser.add_argument("--scans", type=int, default=4)
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--file_size", type=int, default=2**20)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    archive = MockArchive().populate(
+        projects=args.projects,
+        subjects=args.subjects,
+        sessions=args.sessions,
+        scans=args.scans,
+        files=args.files,
+        file_size=args.file_size,
+    )
+    server = MockXnatServer(port=args.port, archive=archive, verbose=args.verbose)
+    print("Serving mock XNAT at {}".format(server.url), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
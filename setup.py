@@ -21,16 +21,16 @@ setup(
                             'xnat-ls = xnatutils.ls_:cmd',
                             'xnat-varget = xnatutils.varget_:cmd',
                             'xnat-varput = xnatutils.varput_:cmd',
-                            'xnat-rename = xnatutils.rename_:cmd']},
+                            'xnat-rename = xnatutils.rename_:cmd',
+                            'xnat-daemon = xnatutils.daemon:cmd']},
     url='http://github.com/MonashBI/xnatutils',
     license='The MIT License (MIT)',
     description=(
         'A collection of scripts for downloading/uploading and listing '
         'data from XNAT repositories.'),
     long_description=open('README.rst').read(),
-    install_requires=['xnat>=0.6',
-                      'progressbar2>=3.16.0',
-                      'future>=0.16'],
+    install_requires=['xnat>=0.8',
+                      'progressbar2>=3.16.0'],
     python_requires='>=3.4',
     classifiers=[
         "Development Status :: 4 - Beta",
@@ -0,0 +1,417 @@
+import os.path
+import sys
+import time
+import subprocess as sp
+import tempfile
+from unittest import TestCase
+import xnat
+import xnatutils
+from types import SimpleNamespace
+from xnatutils.base import (
+    run_concurrently,
+    list_rows,
+    literal_prefix,
+    LabelMatcher,
+    calculate_checksum,
+    matching_sessions,
+    SESSION_SCAN_COLUMNS,
+    load_model,
+    defer_model,
+)
+from xnatutils.cache import MetadataCache, DigestCache, SessionCache, SchemaCache
+
+# The mock XNAT server used by the benchmarks
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks")
+)
+from mock_xnat import MockXnatServer  # noqa: E402
+
+
+class RunConcurrentlyTest(TestCase):
+
+    def test_results(self):
+        results = dict(run_concurrently(lambda x: x * 2, range(20), jobs=4))
+        self.assertEqual(results, {i: i * 2 for i in range(20)})
+
+    def test_sequential(self):
+        order = [i for i, _ in run_concurrently(lambda x: x, range(5))]
+        self.assertEqual(order, list(range(5)))
+
+    def test_error_propagates(self):
+        def func(x):
+            if x == 3:
+                raise ValueError(x)
+            time.sleep(0.01)
+            return x
+
+        with self.assertRaises(ValueError):
+            list(run_concurrently(func, range(10), jobs=2))
+
+
+class LabelMatcherTest(TestCase):
+
+    labels = ["P_01_MR01", "P_01_MR02", "P_02_MR01", "Q_01_MR01", "P_1"]
+
+    def test_filter(self):
+        matcher = LabelMatcher(["P_0.*_MR01", "Q_01_MR0[12]"])
+        self.assertEqual(
+            matcher.filter(self.labels), ["P_01_MR01", "P_02_MR01", "Q_01_MR01"]
+        )
+        self.assertFalse(matcher("P_01_MR01_extra"))
+
+    def test_no_prefix(self):
+        matcher = LabelMatcher([".*_MR02", "P_1"])
+        self.assertEqual(matcher.filter(self.labels), ["P_01_MR02", "P_1"])
+
+    def test_alternation_anchored(self):
+        self.assertEqual(LabelMatcher("P_1|Q_01").filter(self.labels), ["P_1"])
+
+    def test_backreferences(self):
+        labels = ["P_01_01", "P_01_02", "Q_02_02", "R_1"]
+        matcher = LabelMatcher(["R_(1)", r"P_(\d+)_\1", r"Q_(?P<n>\d+)_(?P=n)"])
+        self.assertEqual(matcher.filter(labels), ["P_01_01", "Q_02_02", "R_1"])
+        # Patterns that use the same group names
+        matcher = LabelMatcher([r"P_(?P<n>\d+)_01", r"Q_(?P<n>\d+)_02"])
+        self.assertEqual(matcher.filter(labels), ["P_01_01", "Q_02_02"])
+
+    def test_inline_flags(self):
+        matcher = LabelMatcher(["(?i)p_01_mr0[12]", "Q_01_MR01"])
+        self.assertEqual(
+            matcher.filter(self.labels), ["P_01_MR01", "P_01_MR02", "Q_01_MR01"]
+        )
+        self.assertFalse(matcher("q_01_mr01"))
+        # Comments in verbose patterns can't be scoped to the pattern
+        matcher = LabelMatcher(["(?x) P_1  # the only one", "(?i)q_.*"])
+        self.assertEqual(matcher.filter(self.labels), ["Q_01_MR01", "P_1"])
+
+
+class MockObject(SimpleNamespace):
+
+    __hash__ = object.__hash__
+
+
+class MockLogin(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.requests = []
+
+    def get_json(self, path, query=None):
+        self.requests.append(path)
+        self.query = query
+        columns = (query or {}).get("columns")
+        rows = self.rows.get("{}?{}".format(path, columns), self.rows.get(path))
+        return {"ResultSet": {"Result": rows}}
+
+    def create_object(self, uri, type_=None, id_=None, **fields):
+        return MockObject(uri=uri, id=id_, **fields)
+
+
+class MetadataCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "metadata.sqlite")
+        self.login = MockLogin(
+            {
+                "/data/projects/A/experiments": [{"ID": "E1", "label": "A_1"}],
+                "/data/projects/B/experiments": [{"ID": "E2", "label": "B_1"}],
+            }
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def cache(self, **kwargs):
+        return MetadataCache("https://xnat.test", "user", path=self.path, **kwargs)
+
+    def test_cached(self):
+        query = {"columns": "ID,label"}
+        cache = self.cache()
+        for _ in range(2):
+            rows = list_rows(
+                self.login, "/data/projects/A/experiments", query, cache=cache
+            )
+        self.assertEqual(rows, [{"ID": "E1", "label": "A_1"}])
+        self.assertEqual(len(self.login.requests), 1)
+        # Listings are shared between cache instances (i.e. separate runs)
+        list_rows(self.login, "/data/projects/A/experiments", query, cache=self.cache())
+        self.assertEqual(len(self.login.requests), 1)
+        # but not with other users
+        other = MetadataCache("https://xnat.test", "other", path=self.path)
+        self.assertIsNone(other.get("/data/projects/A/experiments", query))
+
+    def test_expiry_and_refresh(self):
+        list_rows(self.login, "/data/projects/A/experiments", cache=self.cache())
+        list_rows(self.login, "/data/projects/A/experiments", cache=self.cache(ttl=0))
+        list_rows(
+            self.login, "/data/projects/A/experiments", cache=self.cache(refresh=True)
+        )
+        self.assertEqual(len(self.login.requests), 3)
+
+    def test_invalidate(self):
+        cache = self.cache()
+        for project in "AB":
+            list_rows(self.login, "/data/projects/{}/experiments".format(project),
+                      cache=cache)
+        cache.invalidate("/data/projects/A")
+        self.assertIsNone(cache.get("/data/projects/A/experiments"))
+        self.assertIsNotNone(cache.get("/data/projects/B/experiments"))
+
+
+class MatchingSessionsTest(TestCase):
+
+    def setUp(self):
+        self.login = MockLogin(
+            {
+                "/data/projects/P/experiments": [
+                    {"ID": "E1", "label": "P_01_MR01", "date": "2018-01-10",
+                     "project": "P"},
+                    {"ID": "E2", "label": "P_01_MR02", "date": "2018-03-02",
+                     "project": "P"},
+                    {"ID": "E3", "label": "P_02_MR01", "date": "", "project": "P"},
+                ]
+            }
+        )
+
+    def test_literal_prefix(self):
+        self.assertEqual(literal_prefix("MRH000_.*_MR01"), "MRH000_")
+        self.assertEqual(literal_prefix("MR0[12]"), "MR0")
+        self.assertEqual(literal_prefix("AB?C"), "A")
+        self.assertEqual(literal_prefix("A_1|B_1"), "")
+
+    def test_query(self):
+        sessions = matching_sessions(
+            self.login, ["P_01_.*", "P_0.*_MR01"], project_id="P", after="2018-02-01"
+        )
+        self.assertEqual(self.login.query["label"], "P_0*")
+        self.assertEqual(self.login.query["date"], "02/01/2018-12/31/9999")
+        self.assertEqual([s.label for s in sessions], ["P_01_MR02"])
+
+    def test_with_scans(self):
+        scan_rows = []
+        for session_id, scans in (("E1", ["1", "2"]), ("E2", ["3"]), ("E3", [])):
+            for scan_id in scans or [""]:
+                scan_rows.append(
+                    {
+                        "ID": session_id,
+                        "xnat:imagescandata/id": scan_id,
+                        "xnat:imagescandata/type": "t1" if scan_id == "2" else "",
+                    }
+                )
+        self.login.rows[
+            "/data/projects/P/experiments?" + SESSION_SCAN_COLUMNS
+        ] = scan_rows
+        sessions = matching_sessions(
+            self.login, "P_.*", project_id="P", with_scans=["t1"]
+        )
+        self.assertEqual([s.id for s in sessions], ["E1"])
+        sessions = matching_sessions(
+            self.login, "P_.*", project_id="P", without_scans=["t1", "3"]
+        )
+        self.assertEqual([s.id for s in sessions], ["E3"])
+        # Session and scan listings are each retrieved in a single request
+        self.assertEqual(len(self.login.requests), 4)
+
+    def test_ids(self):
+        sessions = matching_sessions(self.login, ["E3", "P_01_MR01"], project_id="P")
+        self.assertNotIn("label", self.login.query)
+        self.assertEqual([s.id for s in sessions], ["E1", "E3"])
+
+
+class DigestCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = DigestCache(os.path.join(self.tmp_dir.name, "digests.sqlite"))
+        self.fname = os.path.join(self.tmp_dir.name, "data.bin")
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def write(self, data, mtime):
+        with open(self.fname, "wb") as f:
+            f.write(data)
+        os.utime(self.fname, ns=(mtime, mtime))
+
+    def test_cached(self):
+        self.write(b"aaaa", 10**18)
+        digest = calculate_checksum(self.fname, cache=self.cache)
+        # Same size and mtime so the cached digest is returned
+        self.write(b"bbbb", 10**18)
+        self.assertEqual(calculate_checksum(self.fname, cache=self.cache), digest)
+        self.write(b"bbbb", 10**18 + 1)
+        self.assertNotEqual(calculate_checksum(self.fname, cache=self.cache), digest)
+        self.assertEqual(
+            calculate_checksum(self.fname), calculate_checksum(self.fname, self.cache)
+        )
+
+    def test_recently_modified(self):
+        self.write(b"aaaa", time.time_ns())
+        calculate_checksum(self.fname, cache=self.cache)
+        self.assertIsNone(self.cache.get(os.stat(self.fname)))
+
+
+class LazyImportTest(TestCase):
+
+    def test_version_doesnt_import_xnat(self):
+        script = (
+            "import sys\n"
+            "from xnatutils.varget_ import cmd\n"
+            "try:\n"
+            "    cmd(['--version'])\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "import xnatutils\n"
+            "xnatutils.put_many\n"
+            "assert 'xnat.session' not in sys.modules\n"
+            "assert 'xnatutils.get_' not in sys.modules\n"
+        )
+        package_dir = os.path.dirname(os.path.dirname(xnatutils.__file__))
+        sp.check_call(
+            [sys.executable, "-c", script],
+            stdout=sp.DEVNULL,
+            env=dict(os.environ, PYTHONPATH=package_dir),
+        )
+
+
+class SessionCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "sessions.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cached(self):
+        cache = SessionCache(self.path)
+        self.assertIsNone(cache.get("https://xnat.test", "user"))
+        cache.put("https://xnat.test/", "user", "ABC123")
+        cache.put("https://xnat.test", "other", "DEF456")
+        self.assertEqual(
+            SessionCache(self.path).get("https://xnat.test", "user"), "ABC123"
+        )
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        cache.remove("https://xnat.test", "user")
+        self.assertIsNone(cache.get("https://xnat.test", "user"))
+        self.assertEqual(cache.get("https://xnat.test", "other"), "DEF456")
+
+    def test_expired(self):
+        SessionCache(self.path, ttl=-1).put("https://xnat.test", None, "ABC123")
+        self.assertIsNone(SessionCache(self.path).get("https://xnat.test", None))
+
+    def test_permissions(self):
+        cache = SessionCache(self.path)
+        cache.put("https://xnat.test", "user", "ABC123")
+        os.chmod(self.path, 0o644)
+        self.assertIsNone(cache.get("https://xnat.test", "user"))
+
+
+MODEL_SOURCE = """
+XNAT_CLASS_LOOKUP = {}
+
+
+class SubjectData(object):
+    __xsi_type__ = "xnat:subjectData"
+
+    @classmethod
+    def __register__(cls, target):
+        target["xnat:subjectData"] = cls
+"""
+
+
+class LoadModelTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.environ = dict(os.environ)
+        os.environ["XNATUTILS_CACHE_DIR"] = self.tmp_dir.name
+        self.login = SimpleNamespace(
+            server="https://xnat.test",
+            xnat_version="1.8.5",
+            XNAT_CLASS_LOOKUP={"xnat:prearchive": object},
+            classes=None,
+            source_code=None,
+        )
+        SchemaCache().put(
+            (self.login.server, "1.8.5", xnat.__version__, "True"),
+            {
+                "source": MODEL_SOURCE,
+                "registered": ["SubjectData"],
+                "display_fields": {"xnat:subjectData": ["label"]},
+            },
+        )
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.tmp_dir.cleanup()
+
+    def test_cached(self):
+        load_model(self.login)
+        cls = self.login.XNAT_CLASS_LOOKUP["xnat:subjectData"]
+        self.assertIs(self.login.classes.SubjectData, cls)
+        self.assertIs(self.login.classes.SESSION, self.login)
+        self.assertTrue(hasattr(cls, "label"))
+        self.assertIn("xnat:prearchive", self.login.XNAT_CLASS_LOOKUP)
+
+    def test_permissions(self):
+        cache = SchemaCache()
+        key = (self.login.server, "1.8.5", xnat.__version__, "True")
+        fname = cache._fname(key)
+        self.assertEqual(os.stat(fname).st_mode & 0o777, 0o600)
+        self.assertIsNotNone(cache.get(key))
+        # The cached source isn't executed if others could have modified it
+        os.chmod(fname, 0o622)
+        self.assertIsNone(cache.get(key))
+        os.chmod(fname, 0o600)
+        os.chmod(cache.path, 0o777)
+        self.assertIsNone(cache.get(key))
+        os.chmod(cache.path, 0o700)
+        self.assertIsNotNone(cache.get(key))
+
+    def test_deferred(self):
+        defer_model(self.login)
+        self.assertEqual(dict(self.login.XNAT_CLASS_LOOKUP), {"xnat:prearchive": object})
+        self.assertIn("xnat:subjectData", self.login.XNAT_CLASS_LOOKUP)
+        self.assertEqual(self.login.classes.SubjectData.__xsi_type__,
+                         "xnat:subjectData")
+
+
+class SharedSessionTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.environ = dict(os.environ)
+        os.environ["XNATUTILS_CACHE_DIR"] = self.tmp_dir.name
+        os.environ["XNATUTILS_NO_DAEMON"] = "1"
+        self.server = MockXnatServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.tmp_dir.cleanup()
+
+    def connect(self, **kwargs):
+        return xnatutils.connect(
+            server=self.server.url, user="mock", password="mock", **kwargs
+        )
+
+    def test_cached_session_not_logged_out(self):
+        for _ in range(3):
+            with self.connect(cache_session=True) as login:
+                self.assertIsInstance(login, xnat.session.XNATSession)
+                login.get_json("/data/projects")
+        # Logged in once and the session is reused by the later runs
+        self.assertEqual(self.server.stats["requests_PUT"], 1)
+        self.assertEqual(self.server.stats["requests_DELETE"], 0)
+        self.assertEqual(len(self.server.sessions), 1)
+
+    def test_logged_out_without_cache(self):
+        with self.connect(cache_session=False) as login:
+            login.get_json("/data/projects")
+        self.assertEqual(self.server.stats["requests_DELETE"], 1)
+        self.assertEqual(len(self.server.sessions), 0)
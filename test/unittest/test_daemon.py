@@ -0,0 +1,120 @@
+import os
+import sys
+import stat
+import time
+import tempfile
+import threading
+from unittest import TestCase
+from xnat.exceptions import XNATLoginFailedError
+import xnatutils
+from xnatutils.daemon import SessionBroker, request_jsession
+
+# The mock XNAT server used by the benchmarks
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks")
+)
+from mock_xnat import MockXnatServer  # noqa: E402
+
+
+class MockSession(object):
+
+    def __init__(self, jsession):
+        self.jsession = jsession
+        self.logged_in_user = "user"
+        self.expired = False
+
+    def get(self, path):
+        if self.expired:
+            raise XNATLoginFailedError("Session expired")
+
+    def disconnect(self):
+        pass
+
+
+class SessionBrokerTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "daemon.sock")
+        self.logins = []
+        self.broker = SessionBroker(
+            path=self.path, validate_interval=0, login=self.login
+        )
+        self.thread = threading.Thread(target=self.broker.serve_forever)
+        self.thread.start()
+        while not os.path.exists(self.path):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.broker.shutdown()
+        self.thread.join()
+        self.tmp_dir.cleanup()
+
+    def login(self, server, user, password):
+        self.logins.append((server, user, password))
+        return MockSession("JSESSION{}".format(len(self.logins)))
+
+    def test_reuse(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        for _ in range(3):
+            jsession = request_jsession(
+                "https://xnat.test", "user", "secret", path=self.path
+            )
+            self.assertEqual(jsession, "JSESSION1")
+        self.assertEqual(len(self.logins), 1)
+        # Sessions are held separately for each user
+        request_jsession("https://xnat.test", "other", "secret", path=self.path)
+        self.assertEqual(len(self.logins), 2)
+
+    def test_expired(self):
+        request_jsession("https://xnat.test", "user", "secret", path=self.path)
+        for session, _ in self.broker._sessions.values():
+            session.expired = True
+        jsession = request_jsession(
+            "https://xnat.test", "user", "secret", path=self.path
+        )
+        self.assertEqual(jsession, "JSESSION2")
+
+    def test_not_running(self):
+        self.assertIsNone(
+            request_jsession(
+                "https://xnat.test", path=os.path.join(self.tmp_dir.name, "none")
+            )
+        )
+
+
+class DaemonClientTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "daemon.sock")
+        self.environ = dict(os.environ)
+        os.environ.pop("XNATUTILS_NO_DAEMON", None)
+        os.environ.pop("XNATUTILS_CACHE_SESSION", None)
+        os.environ["XNATUTILS_CACHE_DIR"] = self.tmp_dir.name
+        os.environ["XNATUTILS_DAEMON_SOCKET"] = self.path
+        self.server = MockXnatServer().start()
+        self.broker = SessionBroker(path=self.path)
+        self.thread = threading.Thread(target=self.broker.serve_forever)
+        self.thread.start()
+        while not os.path.exists(self.path):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.broker.shutdown()
+        self.thread.join()
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.tmp_dir.cleanup()
+
+    def test_session_not_logged_out(self):
+        for _ in range(3):
+            with xnatutils.connect(
+                server=self.server.url, user="mock", password="mock"
+            ) as login:
+                login.get_json("/data/projects")
+        # The daemon logged in once and the clients didn't log its session out
+        self.assertEqual(self.server.stats["requests_PUT"], 1)
+        self.assertEqual(self.server.stats["requests_DELETE"], 0)
+        self.assertEqual(len(self.server.sessions), 1)
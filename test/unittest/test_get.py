@@ -1,10 +1,36 @@
+import sys
 import os
+import io
 import shutil
+import tarfile
 import tempfile
 import shutil
+import hashlib
+import time
+import threading
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
 from unittest import TestCase
-from xnatutils.get_ import get_from_xml
+from unittest.mock import patch
+from xnatutils.get_ import (
+    get_from_xml,
+    _extract_stream,
+    _sync_resource,
+    _ConversionPool,
+    _check_converters,
+    _download_to_target,
+    _download_file,
+)
 from xnatutils import get
+from xnatutils import get_ as get_module
+from xnatutils.exceptions import XnatUtilsUsageError
+import xnat
+
+# The mock XNAT server used by the benchmarks
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks"))
+from mock_xnat import MockArchive, MockXnatServer  # noqa: E402
 
 TEST_DATA_DIR = os.path.realpath(
     os.path.join(os.path.dirname(__file__), "..", "data"))
@@ -69,3 +95,362 @@ class XnatGetTest(TestCase):
         get_from_xml(os.path.join(TEST_DATA_DIR, 'noBIDS0020.xml'),
                      self.tmpdir)
         print(os.listdir(self.tmpdir))
+
+
+class PerFileDownloadTest(TestCase):
+
+    resource_uri = '/data/experiments/E01/scans/1/resources/DICOM'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unsafe_paths(self):
+        resource_uri = self.resource_uri
+        names = ['1.dcm', '..%2F..%2Fescaped.dcm', '%2Ftmp%2Fescaped.dcm']
+
+        class MockLogin(object):
+            def get_json(self, uri):
+                return {'ResultSet': {'Result': [
+                    {'URI': resource_uri + '/files/' + n, 'Size': '3',
+                     'digest': hashlib.md5(b'one').hexdigest()}
+                    for n in names]}}
+
+            def download_stream(self, uri, target_stream):
+                target_stream.write(b'one')
+
+        class MockResource(object):
+            uri = resource_uri
+            label = 'DICOM'
+            xnat_session = MockLogin()
+
+        target_dir = os.path.join(self.tmpdir, 'sub')
+        os.makedirs(target_dir)
+        _download_to_target(
+            MockResource(), None, SimpleNamespace(label='SESS01'),
+            target_dir, os.path.join(target_dir, '1-t1'), '1-t1', None,
+            None, False, 'per_file', 1, False)
+        # Files whose paths would be outside of the target directory are
+        # skipped
+        self.assertEqual(os.listdir(self.tmpdir), ['sub'])
+        self.assertEqual(os.listdir(os.path.join(target_dir, '1-t1')),
+                         ['1.dcm'])
+
+    def test_resume(self):
+        data = os.urandom(10000)
+        ranges = []
+
+        class MockResponse(object):
+            status_code = 206
+
+            def __init__(self, body):
+                self.body = body
+
+            def iter_content(self, chunk_size):
+                for i in range(0, len(self.body), chunk_size):
+                    yield self.body[i:i + chunk_size]
+
+        class MockInterface(object):
+            def get(self, url, headers=None, stream=False):
+                ranges.append(headers['Range'])
+                offset = int(headers['Range'][len('bytes='):-1])
+                return MockResponse(data[offset:])
+
+        class MockLogin(object):
+            interface = MockInterface()
+
+            def download_stream(self, uri, target_stream):
+                raise AssertionError('File was downloaded again')
+
+        class MockResource(object):
+            uri = self.resource_uri
+            xnat_session = MockLogin()
+
+            def external_uri(self):
+                return 'https://xnat.test' + self.uri
+
+        remote_file = SimpleNamespace(path='1.dcm', size=len(data),
+                                      digest=hashlib.md5(data).hexdigest())
+        # A file left truncated in the staging directory by an interrupted run
+        download_path = Path(self.tmpdir) / '1-t1.download' / '1.dcm'
+        download_path.parent.mkdir()
+        download_path.write_bytes(data[:4000])
+        _download_file(MockResource(), remote_file, download_path, resume=True)
+        self.assertEqual(ranges, ['bytes=4000-'])
+        self.assertEqual(download_path.read_bytes(), data)
+        # Complete files are kept without requesting them again
+        _download_file(MockResource(), remote_file, download_path, resume=True)
+        self.assertEqual(ranges, ['bytes=4000-'])
+
+
+class ConcurrentPerFileGetTest(TestCase):
+
+    session = 'MOCK001_001_MR01'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XNATUTILS_CACHE_DIR'] = os.path.join(self.tmpdir, 'cache')
+        os.environ['XNATUTILS_NO_DAEMON'] = '1'
+        self.archive = MockArchive().populate(subjects=1, sessions=1, scans=2,
+                                              files=8, file_size=1000)
+        self.server = MockXnatServer(archive=self.archive).start()
+        self.download_dir = os.path.join(self.tmpdir, 'download')
+        os.mkdir(self.download_dir)
+
+    def tearDown(self):
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def _get(self):
+        get(self.session, self.download_dir, method='per_file', file_jobs=4,
+            server=self.server.url, user='mock', password='mock')
+
+    def _remote_digests(self, scan):
+        session = self.archive.projects['MOCK001'].find(
+            'subjects', 'MOCK001_001').find('experiments', self.session)
+        resource = session.find('scans', scan).find('resources', 'DICOM')
+        return {n: hashlib.md5(d).hexdigest()
+                for n, d in resource.files.items()}
+
+    def _local_digests(self, path):
+        digests = {}
+        for name in os.listdir(path):
+            with open(os.path.join(path, name), 'rb') as f:
+                digests[name] = hashlib.md5(f.read()).hexdigest()
+        return digests
+
+    def test_get(self):
+        self._get()
+        session_dir = os.path.join(self.download_dir, self.session)
+        self.assertEqual(sorted(os.listdir(session_dir)),
+                         ['1-scan1', '2-scan2'])
+        for scan in ('1', '2'):
+            self.assertEqual(
+                self._local_digests(
+                    os.path.join(session_dir, '{0}-scan{0}'.format(scan))),
+                self._remote_digests(scan))
+
+    def test_failed_file(self):
+        download_file_attempt = get_module._download_file_attempt
+
+        def attempt(resource, remote_file, download_path, resume=False):
+            if remote_file.path == '1-0005.dcm':
+                # Fail part-way through writing the file
+                download_path.parent.mkdir(parents=True, exist_ok=True)
+                download_path.write_bytes(b'partial')
+                raise OSError('No space left on device')
+            return download_file_attempt(resource, remote_file, download_path,
+                                         resume=resume)
+
+        with patch.object(get_module, '_download_file_attempt', attempt):
+            with self.assertRaises(OSError):
+                self._get()
+        # Neither the other files of the resource nor the partial file are
+        # left behind
+        self.assertEqual(
+            os.listdir(os.path.join(self.download_dir, self.session)), [])
+
+
+class ExtractStreamTest(TestCase):
+
+    files = {
+        'sub/1.dcm': b'one',
+        '2.dcm': b'two' * 100000,
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_extract_stream(self):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for path, data in self.files.items():
+                info = tarfile.TarInfo(
+                    'SESS01/scans/1/resources/DICOM/files/' + path)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        data = archive.getvalue()
+
+        class MockSession(object):
+            def download_generator(self, uri, format=None, chunk_size=1024):
+                for i in range(0, len(data), 1000):
+                    yield data[i:i + 1000]
+
+        class MockResource(object):
+            uri = '/data/experiments/E01/scans/1/resources/DICOM'
+            xnat_session = MockSession()
+
+        _extract_stream(MockResource(), self.tmpdir)
+        for path, contents in self.files.items():
+            with open(os.path.join(self.tmpdir, path), 'rb') as f:
+                self.assertEqual(f.read(), contents)
+
+
+class DownloadToTargetTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing_files(self):
+        class MockResource(object):
+            uri = '/data/experiments/E01/scans/1/resources/DICOM'
+            label = 'DICOM'
+
+            def download_dir(self, target_dir):
+                raise xnat.exceptions.XNATResponseError(
+                    'Invalid status for response from XNATSession for url '
+                    '{} (status 404):\n'.format(self.uri),
+                    response=SimpleNamespace(url=self.uri, status_code=404,
+                                             text=''))
+
+        # As before downloads were run concurrently, resources without any
+        # files aren't treated as failed downloads
+        self.assertTrue(_download_to_target(
+            MockResource(), None, SimpleNamespace(label='SESS01'),
+            self.tmpdir, os.path.join(self.tmpdir, '1-t1'), '1-t1', None,
+            None, False, 'zip', 1, False))
+
+
+class SyncTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sync(self):
+        remote = {'1.dcm': b'one', '2.dcm': b'two'}
+        downloaded = []
+        resource_uri = '/data/experiments/E01/scans/1/resources/DICOM'
+
+        class MockLogin(object):
+            def get_json(self, uri):
+                return {'ResultSet': {'Result': [
+                    {'URI': resource_uri + '/files/' + n,
+                     'Size': str(len(d)),
+                     'digest': hashlib.md5(d).hexdigest()}
+                    for n, d in remote.items()]}}
+
+            def download_stream(self, uri, target_stream):
+                name = uri.split('/')[-1]
+                downloaded.append(name)
+                target_stream.write(remote[name])
+
+        class MockResource(object):
+            uri = resource_uri
+            label = 'DICOM'
+            xnat_session = MockLogin()
+
+        class MockSession(object):
+            label = 'SESS01'
+
+        target_path = os.path.join(self.tmpdir, '1-t1')
+        sync = partial(_sync_resource, MockResource(), MockSession(),
+                       self.tmpdir, target_path, 1)
+        sync(False)
+        self.assertEqual(sorted(downloaded), ['1.dcm', '2.dcm'])
+        # Only the changed file should be downloaded again
+        del downloaded[:]
+        remote['2.dcm'] = b'changed'
+        del remote['1.dcm']
+        sync(True)
+        self.assertEqual(downloaded, ['2.dcm'])
+        self.assertEqual(os.listdir(target_path), ['2.dcm'])
+        with open(os.path.join(target_path, '2.dcm'), 'rb') as f:
+            self.assertEqual(f.read(), b'changed')
+
+    def test_unsafe_paths(self):
+        resource_uri = '/data/experiments/E01/scans/1/resources/DICOM'
+        names = ['1.dcm', '..%2F..%2Fescaped.dcm', '%2Ftmp%2Fescaped.dcm']
+        downloaded = []
+
+        class MockLogin(object):
+            def get_json(self, uri):
+                return {'ResultSet': {'Result': [
+                    {'URI': resource_uri + '/files/' + n, 'Size': '3',
+                     'digest': hashlib.md5(b'one').hexdigest()}
+                    for n in names]}}
+
+            def download_stream(self, uri, target_stream):
+                downloaded.append(uri.split('/files/')[-1])
+                target_stream.write(b'one')
+
+        class MockResource(object):
+            uri = resource_uri
+            label = 'DICOM'
+            xnat_session = MockLogin()
+
+        target_path = os.path.join(self.tmpdir, 'sub', '1-t1')
+        os.makedirs(target_path)
+        _sync_resource(MockResource(), SimpleNamespace(label='SESS01'),
+                       os.path.dirname(target_path), target_path, 1, False)
+        # Files whose paths would be outside of the target directory are
+        # skipped
+        self.assertEqual(downloaded, ['1.dcm'])
+        self.assertEqual(os.listdir(self.tmpdir), ['sub'])
+
+
+class ConversionPoolTest(TestCase):
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        pending = []
+        peak = []
+
+        def convert():
+            time.sleep(0.01)
+            with lock:
+                pending.pop()
+
+        with _ConversionPool(jobs=2, max_pending=3) as pool:
+            for _ in range(10):
+                pool.throttle()
+                with lock:
+                    pending.append(None)
+                    peak.append(len(pending))
+                pool.submit(convert)
+        self.assertFalse(pending)
+        self.assertLessEqual(max(peak), 3)
+
+    def test_error_propagates(self):
+        def convert():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            with _ConversionPool(jobs=2) as pool:
+                pool.submit(convert)
+
+    def test_error_stops_downloads(self):
+        def convert():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            with _ConversionPool(jobs=1) as pool:
+                pool.submit(convert)
+                # The next download shouldn't be started once a conversion
+                # has failed
+                time.sleep(0.05)
+                pool.throttle()
+                self.fail("throttle didn't raise the conversion error")
+
+    def test_missing_converter(self):
+        dicom = SimpleNamespace(label='DICOM')
+        with self.assertRaises(XnatUtilsUsageError):
+            _check_converters([dicom], 'nifti_gz',
+                              converter='no-such-converter')
+        # Resources already in the requested format aren't converted
+        _check_converters([SimpleNamespace(label='NIFTI_GZ')], 'nifti_gz',
+                          converter='no-such-converter')
+        _check_converters([dicom], None)
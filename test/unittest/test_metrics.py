@@ -0,0 +1,161 @@
+import os.path
+import json
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+from unittest import TestCase
+import requests
+from xnatutils import metrics
+from xnatutils.metrics import RequestMetrics, endpoint_pattern
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status = 404 if self.path.startswith("/data/missing") else 200
+        body = b"x" * 1000
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            # Chunked upload
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                self.rfile.read(size + 2)
+                if not size:
+                    break
+        else:
+            self.rfile.read(int(length))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class EndpointPatternTest(TestCase):
+
+    def test_patterns(self):
+        self.assertEqual(
+            endpoint_pattern(
+                "https://xnat.test/data/experiments/E1/scans/1/resources/DICOM/"
+                "files/sub/dir/1.dcm?format=json"
+            ),
+            "/data/experiments/{experiment}/scans/{scan}/resources/{resource}/"
+            "files/{path}",
+        )
+        self.assertEqual(
+            endpoint_pattern("https://xnat.test/xnat/data/projects/P/experiments"),
+            "/data/projects/{project}/experiments",
+        )
+        self.assertEqual(
+            endpoint_pattern("http://localhost/xapi/schemas/xnat"),
+            "/xapi/schemas/{schema}",
+        )
+        self.assertEqual(
+            endpoint_pattern("http://localhost/data/experiments/E1/resources/R/files"),
+            "/data/experiments/{experiment}/resources/{resource}/files",
+        )
+
+
+class RequestMetricsTest(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.login = SimpleNamespace(interface=requests.Session())
+        self.metrics = RequestMetrics(command="xnat-test")
+        self.metrics.instrument(self.login)
+        # Instrumenting twice doesn't record requests twice
+        self.metrics.instrument(self.login)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.login.interface.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def make_requests(self):
+        session = self.login.interface
+        for scan in ("1", "2"):
+            session.get(self.url + "/data/experiments/E1/scans/" + scan).content
+        with session.get(self.url + "/data/missing", stream=True) as response:
+            for _ in response.iter_content(100):
+                pass
+        session.put(self.url + "/data/experiments/E1/resources/R/files/a", b"y" * 10)
+        session.put(
+            self.url + "/data/experiments/E1/resources/R/files/b",
+            (b"z" * 5 for _ in range(3)),
+        )
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            session.get("http://127.0.0.1:1/data/projects")
+
+    def test_recorded(self):
+        self.make_requests()
+        endpoints = {k: v for k, v in self.metrics.endpoints()}
+        scans = endpoints["GET", "/data/experiments/{experiment}/scans/{scan}"]
+        self.assertEqual(scans.requests, 2)
+        self.assertEqual(scans.statuses, {200: 2})
+        self.assertEqual(scans.received_bytes, 2000)
+        self.assertEqual(sum(scans.latency_counts), 2)
+        missing = endpoints["GET", "/data/missing"]
+        self.assertEqual(missing.statuses, {404: 1})
+        self.assertEqual(missing.received_bytes, 1000)
+        files = endpoints[
+            "PUT", "/data/experiments/{experiment}/resources/{resource}/files/{path}"
+        ]
+        self.assertEqual(files.requests, 2)
+        self.assertEqual(files.sent_bytes, 25)
+        self.assertEqual(endpoints["GET", "/data/projects"].errors, 1)
+
+    def test_output(self):
+        self.make_requests()
+        self.metrics.retry("GET", self.url + "/data/experiments/E1/scans/1")
+        json_path = os.path.join(self.tmp_dir.name, "metrics.json")
+        prom_path = os.path.join(self.tmp_dir.name, "metrics.prom")
+        self.metrics.write(json_path)
+        self.metrics.write(prom_path)
+        with open(json_path) as f:
+            data = json.load(f)
+        self.assertEqual(data["command"], "xnat-test")
+        self.assertEqual(data["totals"]["requests"], 6)
+        self.assertEqual(data["totals"]["retries"], 1)
+        self.assertEqual(data["totals"]["received_bytes"], 3000)
+        with open(prom_path) as f:
+            prom = f.read()
+        labels = (
+            'command="xnat-test",method="GET",'
+            'endpoint="/data/experiments/{experiment}/scans/{scan}"'
+        )
+        self.assertIn(
+            "xnatutils_http_requests_total{" + labels + ',status="200"} 2', prom
+        )
+        self.assertIn("xnatutils_http_retries_total{" + labels + "} 1", prom)
+        self.assertIn(
+            "xnatutils_http_request_duration_seconds_bucket{"
+            + labels
+            + ',le="+Inf"} 2',
+            prom,
+        )
+        self.assertIn("# TYPE xnatutils_http_request_duration_seconds histogram", prom)
+
+    def test_start_stop(self):
+        path = os.path.join(self.tmp_dir.name, "metrics.json")
+        self.assertIsNone(metrics.start_metrics(None))
+        login = SimpleNamespace(interface=requests.Session())
+        active = metrics.start_metrics(path, command="xnat-test")
+        metrics.instrument(login)
+        login.interface.get(self.url + "/data/projects").content
+        metrics.stop_metrics(active, path)
+        self.assertIsNone(metrics.active())
+        with open(path) as f:
+            self.assertEqual(json.load(f)["totals"]["requests"], 1)
+        login.interface.close()
@@ -2,8 +2,26 @@ import sys
 import tempfile
 import os.path
 import logging
+import shutil
+import hashlib
+import io
+import gzip
+import zlib
+import tarfile
 from unittest import TestCase
-from xnatutils import put, connect
+from unittest.mock import patch
+import requests
+import xnat
+from xnatutils import put, put_many, connect
+from xnatutils import put_ as put_module
+from xnatutils.exceptions import XnatUtilsUsageError
+from xnatutils.put_ import (
+    _upload_changes, read_manifest, _tar_stream, ParallelGzipCompressor)
+
+# The mock XNAT server used by the benchmarks
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks"))
+from mock_xnat import MockArchive, MockXnatServer  # noqa: E402
 
 logger = logging.getLogger('xnat-utils')
 # logger.setLevel(logging.WARNING)
@@ -101,3 +119,197 @@ class XnatPutTest(TestCase):
     def subject(self):
         return self.xnat_login.classes.SubjectData(
             label=self.subject_id, parent=self.project)
+
+
+class UploadChangesTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_upload_changes(self):
+        resource_uri = '/data/experiments/E01/scans/1/resources/EXT'
+        remote = {'same.txt': b'same', 'changed.txt': b'old',
+                  'removed.txt': b'removed'}
+        local = {'same.txt': b'same', 'changed.txt': b'new',
+                 'sub dir/added.txt': b'added'}
+        for name, data in local.items():
+            path = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        deleted_uris = []
+        uploaded_paths = []
+
+        class MockLogin(object):
+            def get_json(self, uri):
+                return {'ResultSet': {'Result': [
+                    {'URI': resource_uri + '/files/' + n,
+                     'Size': str(len(d)),
+                     'digest': hashlib.md5(d).hexdigest()}
+                    for n, d in remote.items()]}}
+
+            def delete(self, uri):
+                deleted_uris.append(uri)
+
+        class MockResource(object):
+            uri = resource_uri
+            xnat_session = MockLogin()
+
+            def upload(self, path, remotepath, overwrite=False):
+                if overwrite:
+                    uploaded_paths.append(remotepath)
+
+        uploaded, deleted = _upload_changes(MockResource(), self.tmpdir)
+        self.assertEqual(uploaded, ['changed.txt', 'sub dir/added.txt'])
+        self.assertEqual(uploaded_paths, uploaded)
+        self.assertEqual(deleted, ['removed.txt'])
+        self.assertEqual(deleted_uris, [resource_uri + '/files/removed.txt'])
+
+
+class ReadManifestTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_manifest(self):
+        manifest_path = os.path.join(self.tmpdir, 'manifest.csv')
+        with open(manifest_path, 'w') as f:
+            f.write('session,scan,files,resource\n'
+                    'PROJ_S01_MR01,t1,t1.nii.gz,\n'
+                    'PROJ_S01_MR01,dwi,dwi.nii.gz; dwi.bval ;dwi.bvec,nifti_gz\n')
+        rows = read_manifest(manifest_path)
+        self.assertEqual(rows[0], {
+            'session': 'PROJ_S01_MR01', 'scan': 't1',
+            'files': [os.path.join(self.tmpdir, 't1.nii.gz')]})
+        self.assertEqual(rows[1]['resource_name'], 'nifti_gz')
+        self.assertEqual(
+            rows[1]['files'],
+            [os.path.join(self.tmpdir, f)
+             for f in ('dwi.nii.gz', 'dwi.bval', 'dwi.bvec')])
+
+
+class PutManyTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XNATUTILS_CACHE_DIR'] = os.path.join(self.tmpdir, 'cache')
+        os.environ['XNATUTILS_NO_DAEMON'] = '1'
+        archive = MockArchive().populate(subjects=1, sessions=1, scans=1,
+                                         files=1, file_size=10)
+        self.server = MockXnatServer(archive=archive).start()
+        self.files = []
+        for name in ('1.dcm', '2.dcm'):
+            self.files.append(os.path.join(self.tmpdir, name))
+            with open(self.files[-1], 'wb') as f:
+                f.write(name.encode())
+
+    def tearDown(self):
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_errors_recorded(self):
+        errors = {
+            'reset': requests.exceptions.ConnectionError('reset'),
+            'rejected': xnat.exceptions.XNATUploadError(
+                'Upload failed after 5 attempts! Status code 400'),
+            'unreadable': PermissionError('denied'),
+        }
+        upload_dirs = []
+        upload_dataset = put_module._upload_dataset
+
+        def upload(login, xsession, scan, filenames, local_dir, *args,
+                   **kwargs):
+            upload_dirs.append(local_dir)
+            if scan in errors:
+                raise errors[scan]
+            return upload_dataset(login, xsession, scan, filenames,
+                                  local_dir, *args, **kwargs)
+
+        rows = [{'session': 'MOCK001_001_MR01', 'scan': scan,
+                 'files': self.files, 'resource_name': 'DICOM'}
+                for scan in ('reset', 'uploaded', 'rejected', 'unreadable')]
+        with patch.object(put_module, '_upload_dataset', upload):
+            results = put_many(rows, jobs=2, server=self.server.url,
+                               user='mock', password='mock')
+        # The failed uploads don't stop the others
+        self.assertEqual(
+            [(row['scan'], error) for row, error in results],
+            [('reset', errors['reset']), ('uploaded', None),
+             ('rejected', errors['rejected']),
+             ('unreadable', errors['unreadable'])])
+        # The temporary directories the files were collected into are removed
+        self.assertEqual(len(upload_dirs), 4)
+        self.assertFalse(any(os.path.exists(d) for d in upload_dirs))
+
+    def test_invalid_options(self):
+        tmp_root = os.path.join(self.tmpdir, 'tmp')
+        os.mkdir(tmp_root)
+        with patch.object(tempfile, 'tempdir', tmp_root):
+            with self.assertRaises(XnatUtilsUsageError):
+                put('MOCK001_001_MR01', 't1', *self.files,
+                    resource_name='DICOM', incremental=True,
+                    server=self.server.url, user='mock', password='mock')
+        # The options are checked before the files are collected
+        self.assertEqual(os.listdir(tmp_root), [])
+
+
+class TarStreamTest(TestCase):
+
+    files = {'empty.txt': b'', 'sub dir/data.bin': os.urandom(5000),
+             'sub dir/' + 'x' * 120 + '.dat': b'long name'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, data in self.files.items():
+            path = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tar_stream(self):
+        for compress, jobs, mode in ((True, 1, 'r:gz'), (True, 4, 'r:gz'),
+                                     (False, None, 'r:')):
+            chunks = list(_tar_stream(self.tmpdir, compress=compress,
+                                      chunk_size=1000, compress_jobs=jobs))
+            # Empty chunks would end a chunked request body early
+            self.assertTrue(all(chunks))
+            with tarfile.open(fileobj=io.BytesIO(b''.join(chunks)),
+                              mode=mode) as tar:
+                self.assertEqual(
+                    {m.name: tar.extractfile(m).read()
+                     for m in tar.getmembers()}, self.files)
+
+
+class ParallelGzipCompressorTest(TestCase):
+
+    def test_members(self):
+        data = os.urandom(2500) + b'\0' * 10000
+        compressor = ParallelGzipCompressor(jobs=3, block_size=1000)
+        compressed = b''.join(
+            [compressor.compress(data[i:i + 700])
+             for i in range(0, len(data), 700)] + [compressor.flush()])
+        self.assertEqual(gzip.decompress(compressed), data)
+        # Each block is compressed into a separate member
+        num_members = 0
+        while compressed:
+            decompressor = zlib.decompressobj(31)
+            decompressor.decompress(compressed)
+            compressed = decompressor.unused_data
+            num_members += 1
+        self.assertEqual(num_members, 13)
+
+    def test_empty(self):
+        compressor = ParallelGzipCompressor(jobs=2)
+        self.assertEqual(gzip.decompress(compressor.flush()), b'')
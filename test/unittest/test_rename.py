@@ -0,0 +1,69 @@
+from unittest import TestCase
+import requests
+from xnatutils.rename_ import rename_many
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class MockLogin(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.requests = []
+        self.puts = []
+        self.failing = set()
+
+    def get_json(self, path, query=None):
+        self.requests.append(path)
+        return {'ResultSet': {'Result': self.rows[path]}}
+
+    def put(self, uri, query=None):
+        if uri in self.failing:
+            raise requests.exceptions.ConnectionError('reset')
+        self.puts.append(uri)
+
+
+class RenameManyTest(TestCase):
+
+    def setUp(self):
+        self.login = MockLogin({
+            '/data/projects/PROJ/experiments': [
+                {'ID': 'E{}'.format(i), 'label': 'PROJ_S{:02}_MR01'.format(i)}
+                for i in range(4)]})
+
+    def test_rename(self):
+        mapping = [('PROJ_S0{}_MR01'.format(i), 'PROJ_S0{}_MRPT01'.format(i))
+                   for i in range(3)]
+        results = rename_many(mapping, jobs=2, connection=self.login)
+        self.assertEqual(results[0], ('PROJ_S00_MR01', 'PROJ_S00_MRPT01',
+                                      'E0', None))
+        self.assertEqual(len(self.login.requests), 1)
+        self.assertEqual(sorted(self.login.puts), [
+            '/data/experiments/E{0}?label=PROJ_S0{0}_MRPT01'.format(i)
+            for i in range(3)])
+
+    def test_dry_run(self):
+        results = rename_many({'PROJ_S01_MR01': 'PROJ_S01_MR02'},
+                              dry_run=True, connection=self.login)
+        self.assertEqual(results, [('PROJ_S01_MR01', 'PROJ_S01_MR02', 'E1',
+                                    None)])
+        self.assertEqual(self.login.puts, [])
+
+    def test_collisions(self):
+        for mapping in ({'PROJ_S00_MR01': 'PROJ_S03_MR01'},
+                        {'PROJ_S00_MR01': 'PROJ_X', 'PROJ_S01_MR01': 'PROJ_X'},
+                        {'PROJ_S09_MR01': 'PROJ_S09_MR02'},
+                        {'PROJ_S00_MR01': 'PROJ S00'}):
+            with self.assertRaises(XnatUtilsUsageError):
+                rename_many(mapping, connection=self.login)
+        self.assertEqual(self.login.puts, [])
+
+    def test_connection_error(self):
+        self.login.failing.add('/data/experiments/E1?label=PROJ_S01_MRPT01')
+        mapping = [('PROJ_S0{}_MR01'.format(i), 'PROJ_S0{}_MRPT01'.format(i))
+                   for i in range(3)]
+        results = rename_many(mapping, jobs=2, connection=self.login)
+        # The other sessions are still renamed
+        self.assertIsInstance(results[1][3],
+                              requests.exceptions.ConnectionError)
+        self.assertEqual([r[3] for r in results[::2]], [None, None])
+        self.assertEqual(len(self.login.puts), 2)
@@ -0,0 +1,158 @@
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+from unittest import TestCase
+import requests
+import xnat
+from xnatutils.base import resize_connection_pool
+from xnatutils.retry import RetryPolicy, CircuitBreaker
+
+
+def response_error(status):
+    return xnat.exceptions.XNATResponseError(
+        "Invalid status (status {})".format(status),
+        response=SimpleNamespace(url="http://xnat.test", status_code=status, text=""),
+    )
+
+
+class Flaky(object):
+    "Raises the given errors in turn before succeeding"
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+class Unavailable(BaseHTTPRequestHandler):
+    "Responds to every request with 503 (Service Unavailable)"
+
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RetryPolicyTest(TestCase):
+
+    def policy(self, **kwargs):
+        kwargs.setdefault("backoff", 0)
+        return RetryPolicy(**kwargs)
+
+    def test_retried(self):
+        func = Flaky(
+            requests.exceptions.ConnectionError("reset"),
+            response_error(503),
+            ConnectionResetError(),
+            xnat.exceptions.XNATUploadError("Status code 502, response text"),
+        )
+        self.assertEqual(self.policy().call(func), "done")
+        self.assertEqual(func.calls, 5)
+
+    def test_not_retryable(self):
+        for error in (response_error(404), ValueError("bad")):
+            func = Flaky(error)
+            with self.assertRaises(type(error)):
+                self.policy().call(func)
+            self.assertEqual(func.calls, 1)
+
+    def test_attempts_exhausted(self):
+        func = Flaky(*(response_error(504) for _ in range(3)))
+        with self.assertRaises(xnat.exceptions.XNATResponseError):
+            self.policy(attempts=3).call(func)
+        self.assertEqual(func.calls, 3)
+        func = Flaky(response_error(500))
+        self.assertEqual(self.policy(statuses=[500]).call(func), "done")
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=1, max_backoff=5)
+        for retry, limit in ((0, 1), (1, 2), (2, 4), (3, 5), (10, 5)):
+            for _ in range(20):
+                self.assertLessEqual(policy.delay(retry), limit)
+
+    def test_urllib3_retry(self):
+        retry = RetryPolicy(attempts=3).urllib3_retry()
+        self.assertEqual(retry.total, 2)
+        self.assertTrue(retry.is_retry("GET", 503))
+        self.assertFalse(retry.is_retry("GET", 500))
+        # Bodies of PUT requests may be streams that can't be sent again
+        self.assertFalse(retry.is_retry("PUT", 503))
+
+    def test_requests_sent(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Unavailable)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/data/projects".format(server.server_port)
+        login = SimpleNamespace(interface=requests.Session())
+        policy = self.policy(attempts=3, breaker_threshold=None)
+        resize_connection_pool(login, retry_policy=policy)
+
+        def get():
+            response = login.interface.get(url)
+            if response.status_code != 200:
+                raise response_error(response.status_code)
+
+        try:
+            # Requests made outside of an operation are retried by the pool
+            self.assertEqual(login.interface.get(url).status_code, 503)
+            self.assertEqual(Unavailable.requests, 3)
+            # and those within one aren't retried by the pool as well
+            Unavailable.requests = 0
+            with self.assertRaises(xnat.exceptions.XNATResponseError):
+                policy.call(get)
+            self.assertLessEqual(Unavailable.requests, 3)
+        finally:
+            login.interface.close()
+            server.shutdown()
+            server.server_close()
+
+
+class CircuitBreakerTest(TestCase):
+
+    def test_pause(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=0.1)
+        for _ in range(2):
+            breaker.failure()
+        self.assertFalse(breaker.paused)
+        breaker.failure()
+        self.assertTrue(breaker.paused)
+        start = time.monotonic()
+        breaker.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        # Failing again straight after the pause pauses for twice as long
+        breaker.failure()
+        self.assertGreater(breaker._paused_until - time.monotonic(), 0.15)
+        breaker.wait()
+        breaker.success()
+        for _ in range(2):
+            breaker.failure()
+        self.assertFalse(breaker.paused)
+
+    def test_shared_by_policy(self):
+        policy = RetryPolicy(
+            attempts=2, backoff=0, breaker_threshold=2, breaker_cooldown=0.1
+        )
+        errors = (requests.exceptions.ConnectionError() for _ in range(2))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            policy.call(Flaky(*errors))
+        self.assertTrue(policy.breaker.paused)
+        start = time.monotonic()
+        self.assertEqual(policy.call(Flaky()), "done")
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(threshold=None)
+        for _ in range(10):
+            breaker.failure()
+        self.assertFalse(breaker.paused)
@@ -0,0 +1,51 @@
+import io
+import csv
+from unittest import TestCase
+from xnatutils.varget_ import varget_many, write_table
+
+
+class MockLogin(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.requests = []
+
+    def get_json(self, path, query=None):
+        self.requests.append((path, query))
+        return {'ResultSet': {'Result': self.rows[path]}}
+
+
+class VargetManyTest(TestCase):
+
+    def setUp(self):
+        field = 'xnat:experimentdata/fields/field[name={}]/field'
+        self.login = MockLogin({
+            '/data/projects/PROJ/experiments': [
+                {'ID': 'E{}'.format(i), 'label': 'PROJ_S{:02}_MR01'.format(i),
+                 field.format('age'): str(20 + i),
+                 field.format('group'): 'control' if i % 2 else ''}
+                for i in range(5)]})
+
+    def test_pattern(self):
+        rows = varget_many('PROJ_S0[1-3]_MR01', ['age', 'group'],
+                           default='n/a', connection=self.login)
+        self.assertEqual(rows, [
+            {'label': 'PROJ_S01_MR01', 'age': '21', 'group': 'control'},
+            {'label': 'PROJ_S02_MR01', 'age': '22', 'group': 'n/a'},
+            {'label': 'PROJ_S03_MR01', 'age': '23', 'group': 'control'}])
+        # All values are retrieved in a single columnar request
+        self.assertEqual(len(self.login.requests), 1)
+        path, query = self.login.requests[0]
+        self.assertIn('xnat:experimentData/fields/field[name=group]/field',
+                      query['columns'])
+
+    def test_ids_and_csv(self):
+        rows = varget_many(['PROJ_S04_MR01', 'E0'], 'age',
+                           datatype='session', project_id='PROJ',
+                           connection=self.login)
+        self.assertEqual([r['label'] for r in rows],
+                         ['PROJ_S00_MR01', 'PROJ_S04_MR01'])
+        out = io.StringIO()
+        write_table(rows, ['age'], out)
+        out.seek(0)
+        self.assertEqual(list(csv.DictReader(out)), rows)
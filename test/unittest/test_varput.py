@@ -0,0 +1,124 @@
+import os.path
+import tempfile
+from unittest import TestCase
+import requests
+from xnatutils.varput_ import varput_many, read_table
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class MockLogin(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.requests = []
+        self.puts = []
+        self.failing = set()
+
+    def get_json(self, path, query=None):
+        self.requests.append((path, query))
+        return {'ResultSet': {'Result': self.rows[path]}}
+
+    def put(self, uri, query=None):
+        if uri in self.failing:
+            raise requests.exceptions.ConnectionError('reset')
+        self.puts.append((uri, query))
+
+
+class VarputManyTest(TestCase):
+
+    def setUp(self):
+        field = 'xnat:experimentdata/fields/field[name={}]/field'
+        self.login = MockLogin({
+            '/data/projects/PROJ/experiments': [
+                {'ID': 'E{}'.format(i), 'label': 'PROJ_S{:02}_MR01'.format(i),
+                 'xsiType': 'xnat:mrSessionData',
+                 field.format('age'): str(20 + i),
+                 field.format('group'): ''}
+                for i in range(3)]})
+
+    def test_combined_and_skipped(self):
+        results = varput_many(
+            [('PROJ_S00_MR01', 'age', 20), ('PROJ_S00_MR01', 'group', ''),
+             ('PROJ_S01_MR01', 'age', '31'),
+             ('PROJ_S01_MR01', 'group', 'control'),
+             ('E2', 'group', 'patient')],
+            jobs=2, datatype='session', project_id='PROJ',
+            connection=self.login)
+        self.assertEqual([r for _, r in results],
+                         [False, False, True, True, True])
+        self.assertEqual(len(self.login.requests), 1)
+        # The fields of each session are set in a single request
+        self.assertEqual(sorted(self.login.puts), [
+            ('/data/projects/PROJ/experiments/E1', {
+                'xsiType': 'xnat:mrSessionData',
+                'xnat:mrSessionData/fields/field[name=age]/field': '31',
+                'xnat:mrSessionData/fields/field[name=group]/field':
+                    'control'}),
+            ('/data/projects/PROJ/experiments/E2', {
+                'xsiType': 'xnat:mrSessionData',
+                'xnat:mrSessionData/fields/field[name=group]/field':
+                    'patient'})])
+
+
+    def test_literal_ids(self):
+        self.login.rows['/data/projects/PROJ/experiments'][1]['label'] = (
+            'PROJ_S01x1')
+        self.login.rows['/data/projects/PROJ/experiments'][2]['label'] = (
+            'PROJ_S01.1')
+        results = varput_many([('PROJ_S01.1', 'age', '40')],
+                              datatype='session', project_id='PROJ',
+                              connection=self.login)
+        self.assertEqual([r for _, r in results], [True])
+        self.assertEqual([uri for uri, _ in self.login.puts],
+                         ['/data/projects/PROJ/experiments/E2'])
+
+    def test_label_and_id(self):
+        results = varput_many(
+            [('PROJ_S01_MR01', 'age', '40'), ('E1', 'group', 'control'),
+             ('E1', 'age', '41')],
+            datatype='session', project_id='PROJ', connection=self.login)
+        self.assertIsInstance(results[0][1], XnatUtilsUsageError)
+        self.assertEqual(results[1][1], True)
+        self.assertIs(results[2][1], results[0][1])
+        self.assertEqual(self.login.puts, [
+            ('/data/projects/PROJ/experiments/E1', {
+                'xsiType': 'xnat:mrSessionData',
+                'xnat:mrSessionData/fields/field[name=group]/field':
+                    'control'})])
+
+    def test_connection_error(self):
+        self.login.failing.add('/data/projects/PROJ/experiments/E1')
+        results = varput_many(
+            [('PROJ_S01_MR01', 'age', '40'), ('E2', 'age', '42')], jobs=2,
+            datatype='session', project_id='PROJ', connection=self.login)
+        self.assertIsInstance(results[0][1],
+                              requests.exceptions.ConnectionError)
+        self.assertEqual(results[1][1], True)
+
+
+class ReadTableTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'table.csv')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        return read_table(self.path)
+
+    def test_long(self):
+        self.assertEqual(
+            self.read('id,variable,value\nP_01,age,30\nP_01,group,\n'),
+            [{'id': 'P_01', 'variable': 'age', 'value': '30'},
+             {'id': 'P_01', 'variable': 'group', 'value': ''}])
+
+    def test_wide(self):
+        self.assertEqual(
+            self.read('record_id,age,group\nP_01,30,\nP_02,41,control\n'),
+            [{'id': 'P_01', 'variable': 'age', 'value': '30'},
+             {'id': 'P_02', 'variable': 'age', 'value': '41'},
+             {'id': 'P_02', 'variable': 'group', 'value': 'control'}])
@@ -18,10 +18,43 @@ limitations under the License.
 """
 
 from .version_ import __version__  # noqa
-from .base import connect, set_logger  # noqa
-from .ls_ import ls  # noqa
-from .get_ import get, get_from_xml  # noqa
-from .put_ import put  # noqa
-from .rename_ import rename  # noqa
-from .varget_ import varget  # noqa
-from .varput_ import varput  # noqa
+
+# The commands are only imported when they are first accessed, so that importing
+# the package (or running one of the console scripts) doesn't import all of
+# them and their dependencies
+_lazy_attrs = {
+    "connect": "base",
+    "set_logger": "base",
+    "ls": "ls_",
+    "get": "get_",
+    "get_from_xml": "get_",
+    "put": "put_",
+    "put_many": "put_",
+    "rename": "rename_",
+    "rename_many": "rename_",
+    "varget": "varget_",
+    "varget_many": "varget_",
+    "varput": "varput_",
+    "varput_many": "varput_",
+    "RetryPolicy": "retry",
+}
+
+__all__ = ["__version__"] + list(_lazy_attrs)
+
+
+def __getattr__(name):
+    try:
+        module_name = _lazy_attrs[name]
+    except KeyError:
+        raise AttributeError(
+            "module '{}' has no attribute '{}'".format(__name__, name)
+        ) from None
+    from importlib import import_module
+
+    value = getattr(import_module("." + module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attrs))
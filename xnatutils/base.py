@@ -1,4 +1,4 @@
-from past.builtins import basestring
+import sys
 import argparse
 import os.path
 import pathlib
@@ -7,11 +7,17 @@ import errno
 from datetime import datetime
 import stat
 import getpass
-from builtins import input
-from operator import attrgetter
+import hashlib
+import functools
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import attrgetter, itemgetter
+from collections import namedtuple, defaultdict
 from netrc import netrc
-import xnat
-from xnat.exceptions import XNATResponseError
+import uuid
+import threading
+import importlib.util
+from io import StringIO
 from .exceptions import (
     XnatUtilsLookupError,
     XnatUtilsUsageError,
@@ -19,10 +25,41 @@ from .exceptions import (
     XnatUtilsNoMatchingSessionsException,
     XnatUtilsSkippedAllSessionsException,
     XnatUtilsError,
+    XnatUtilsDigestCheckFailedError,
+    XnatUtilsException,
 )
 import warnings
 import logging
 from .version_ import __version__
+from .cache import MetadataCache, SessionCache, SchemaCache, DEFAULT_CACHE_TTL
+from .daemon import request_jsession
+from . import metrics as _metrics
+
+
+def lazy_import(name):
+    """
+    Returns the module with the given name, deferring the actual import until
+    one of its attributes is first accessed. Used for heavy modules (i.e.
+    XnatPy and requests) that aren't needed by every command (e.g. when just
+    printing the help or version)
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '{}'".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+xnat = lazy_import("xnat")
+requests = lazy_import("requests")
 
 logger = logging.getLogger("xnat-utils")
 
@@ -62,6 +99,20 @@ session_modality_re = re.compile(r"\w+_\w+_([A-Z]+)\d+")
 
 server_name_re = re.compile(r"(https?://)?([\w\-\.:]+).*")
 
+# Constructs whose meaning depends on the numbering or naming of the groups
+# in a pattern (backreferences, named groups and conditionals), which would
+# change if the pattern was combined with others
+group_reference_re = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(")
+
+# Inline flags at the start of a pattern (e.g. '(?i)'), which apply to the
+# whole expression so need to be scoped to the pattern when it is combined
+global_flags_re = re.compile(r"\(\?([aiLmsux]+)\)")
+
+HASH_CHUNK_SIZE = 2**20
+
+# The default pool size of requests.adapters.HTTPAdapter
+DEFAULT_CONNECTION_POOL_SIZE = 10
+
 
 def connect(
     server=None,
@@ -72,6 +123,10 @@ def connect(
     use_netrc=True,
     failures=0,
     password=None,
+    use_daemon=True,
+    cache_session=None,
+    lazy_model=False,
+    cache_schema=None,
 ):
     """
     Opens a connection to an XNAT instance
@@ -103,13 +158,33 @@ def connect(
     password : str
         Password provided to login. Will be ignored unless 'user' and 'server'
         are not also provided
+    use_daemon : bool
+        Whether to reuse a session held by the session daemon (see
+        'xnat-daemon') if it is running instead of logging in
+    cache_session : bool | None
+        Whether to save the session in a cache file (readable by the user
+        only) and reuse it in subsequent runs until it expires instead of
+        logging in each time. Defaults to whether the XNATUTILS_CACHE_SESSION
+        environment variable is set
+    lazy_model : bool
+        Whether to defer building the classes of the server's data model
+        (i.e. 'login.classes') until they are first used, for commands that
+        mostly don't need them
+    cache_schema : bool | None
+        Whether to load the classes of the server's data model from the
+        on-disk cache (readable by the user only) instead of downloading and
+        parsing the server's schemas. Defaults to whether the
+        XNATUTILS_CACHE_SCHEMA environment variable is set
     Returns
     -------
     connection : xnat.Session
         A XnatPy session
     """
     if connection is not None:
+        _metrics.instrument(connection)
         return WrappedXnatSession(connection)
+    if cache_schema is None:
+        cache_schema = bool(os.environ.get("XNATUTILS_CACHE_SCHEMA"))
 
     if server is None:
         server = os.environ.get("XNAT_HOST")
@@ -178,11 +253,39 @@ def connect(
             server = "http://" + server
     else:
         netrc_match = True  # disable the save
+    # Sessions from the daemon or cache can't be used when a new alias token
+    # needs to be issued and saved
+    reuse_session = not (use_netrc and not netrc_match)
+    if use_daemon and reuse_session:
+        connection = _reuse_session(
+            server,
+            request_jsession(server, user=user, password=password),
+            loglevel,
+            logger,
+        )
+        if connection is not None:
+            return _setup_session(_keep_session(connection), lazy_model, cache_schema)
+    if cache_session is None:
+        cache_session = bool(os.environ.get("XNATUTILS_CACHE_SESSION"))
+    session_cache = SessionCache() if cache_session else None
+    if session_cache is not None and reuse_session:
+        jsession = session_cache.get(server, user)
+        connection = _reuse_session(server, jsession, loglevel, logger)
+        if connection is not None:
+            session_cache.put(server, user, jsession)
+            return _setup_session(_keep_session(connection), lazy_model, cache_schema)
+        elif jsession is not None:
+            session_cache.remove(server, user)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         try:
             connection = xnat.connect(
-                server, loglevel=loglevel, logger=logger, user=user, password=password
+                server,
+                loglevel=loglevel,
+                logger=logger,
+                user=user,
+                password=password,
+                no_parse_model=True,
             )
         except (ValueError, KeyError):  # Login failed
             if password is None:
@@ -216,6 +319,8 @@ def connect(
                     connection=connection,
                     use_netrc=use_netrc,
                     failures=failures + 1,
+                    lazy_model=lazy_model,
+                    cache_schema=cache_schema,
                 )
             else:
                 raise XnatUtilsUsageError(
@@ -238,7 +343,215 @@ def connect(
                     "To prevent this from happening in the future pass "
                     "the '--no_netrc' or '-n' option".format(server, netrc_path)
                 )
-    return connection
+            if session_cache is not None:
+                session_cache.put(server, user, connection.jsession)
+                _keep_session(connection)
+    return _setup_session(connection, lazy_model, cache_schema)
+
+
+def _reuse_session(server, jsession, loglevel, logger):
+    """
+    Connects to the server using an existing session (i.e. one held by the
+    session daemon or cached from a previous run), returning None if the
+    session is no longer valid
+    """
+    if jsession is None:
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            return xnat.connect(
+                server,
+                loglevel=loglevel,
+                logger=logger,
+                jsession=jsession,
+                no_parse_model=True,
+            )
+        except (
+            xnat.exceptions.XNATError,
+            requests.exceptions.RequestException,
+        ) as e:
+            logger.debug("Could not reuse session with %s, logging in: %s", server, e)
+    return None
+
+
+def _keep_session(login):
+    """
+    Stops a session that is shared with other runs (i.e. held by the session
+    daemon or saved in the session cache) from being logged out on the server
+    when it is disconnected, e.g. on exit of a 'with connect()' block or when
+    it is garbage collected. Only the local connections are closed instead
+    """
+    login.__class__ = _shared_session_class(type(login))
+    return login
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_session_class(cls):
+    class SharedXnatSession(cls):
+        def disconnect(self):
+            # Skip XNATSession.disconnect, which sends DELETE /data/JSESSION
+            super(xnat.session.XNATSession, self).disconnect()
+
+    return SharedXnatSession
+
+
+def _setup_session(login, lazy_model, cache_schema):
+    _metrics.instrument(login)
+    if lazy_model:
+        defer_model(login, use_cache=cache_schema)
+    else:
+        load_model(login, use_cache=cache_schema)
+    return login
+
+
+def load_model(login, extension_types=True, use_cache=True):
+    """
+    Builds the classes of the data model of the XNAT server (i.e.
+    'login.classes') for a session opened with 'no_parse_model=True',
+    reusing the classes generated from the server's schemas in a previous run
+    if they are cached on disk
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The XNAT session to build the classes for
+    extension_types : bool
+        Whether to include the datatypes of the server's plugins
+    use_cache : bool
+        Whether to load (and save) the generated classes from the on-disk
+        schema cache
+    """
+    cache = SchemaCache() if use_cache else None
+    key = (login.server, login.xnat_version, xnat.__version__, str(extension_types))
+    model = cache.get(key) if cache is not None else None
+    cached = model is not None
+    if not cached:
+        logger.debug("Building data model of %s from its schemas", login.server)
+        parser, _ = xnat.build_parser(login, extension_types=extension_types)
+        source = StringIO()
+        parser.write(code_file=source)
+        model = {
+            "source": source.getvalue(),
+            # The same classes as registered by xnat.build_model
+            "registered": [
+                cls.writer.python_name
+                for cls in parser.class_list.values()
+                if not (
+                    cls.name is None
+                    or (cls.base_class is not None and cls.base_class.startswith("xs:"))
+                )
+            ],
+            "display_fields": None,
+        }
+    module_name = "xnat.generated.model_{}".format(uuid.uuid4().hex)
+    loader = xnat.StringLoader(model["source"])
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader(module_name, loader)
+    )
+    loader.exec_module(module)
+    for name in model["registered"]:
+        cls = getattr(module, name, None)
+        if cls is not None:
+            cls.__register__(module.XNAT_CLASS_LOOKUP)
+    module.SESSION = login
+    dict.update(login.XNAT_CLASS_LOOKUP, module.XNAT_CLASS_LOOKUP)
+    login.classes = module
+    login.source_code = model["source"]
+    if model["display_fields"] is None:
+        model["display_fields"] = _display_fields(login)
+    # Add the display fields of each datatype to the classes so they can be
+    # used in searches (as xnat.search.inject_search_fields does)
+    for datatype, names in model["display_fields"].items():
+        cls = dict.get(login.XNAT_CLASS_LOOKUP, datatype)
+        if cls is not None:
+            for name in names:
+                setattr(
+                    cls, name, xnat.search.DisplayFieldSearchField(cls, name, "xs:string")
+                )
+    if cache is not None and not cached:
+        cache.put(key, model)
+
+
+def _display_fields(login):
+    fields = {}
+    for datatype in login.inspect.datatypes():
+        if not dict.__contains__(login.XNAT_CLASS_LOOKUP, datatype):
+            continue
+        try:
+            fields[datatype] = [
+                f.split("/")[-1] for f in login.inspect.datafields(datatype)
+            ]
+        except xnat.exceptions.XNATResponseError as e:
+            logger.info("Could not retrieve display fields for %s: %s", datatype, e)
+    return fields
+
+
+def defer_model(login, extension_types=True, use_cache=True):
+    """
+    Defers building the classes of the data model of the XNAT server (see
+    'load_model') until they are first used, either via 'login.classes' or
+    when XnatPy looks up the class of an object
+    """
+    lookup = _LazyClassLookup(
+        login.XNAT_CLASS_LOOKUP,
+        lambda: load_model(login, extension_types=extension_types, use_cache=use_cache),
+    )
+    login.XNAT_CLASS_LOOKUP = lookup
+    login.classes = _LazyClasses(login, lookup)
+
+
+class _LazyClassLookup(dict):
+    """
+    A class lookup (i.e. 'XNAT_CLASS_LOOKUP') that builds the data model the
+    first time it is accessed
+    """
+
+    def __init__(self, items, load):
+        super().__init__(items)
+        self._load = load
+        self._loaded = False
+        self._loading = False
+        self._lock = threading.RLock()
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            # Accesses from within load_model (in the same thread) use the
+            # classes loaded so far
+            if self._loaded or self._loading:
+                return
+            self._loading = True
+            try:
+                self._load()
+            finally:
+                self._loading = False
+            self._loaded = True
+
+    def __getitem__(self, key):
+        self.ensure_loaded()
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.ensure_loaded()
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self.ensure_loaded()
+        return super().get(key, default)
+
+
+class _LazyClasses(object):
+    "Stands in for 'login.classes' until the data model is built"
+
+    def __init__(self, login, lookup):
+        self._login = login
+        self._lookup = lookup
+
+    def __getattr__(self, name):
+        self._lookup.ensure_loaded()
+        return getattr(self._login.classes, name)
 
 
 def write_netrc(netrc_path, servers):
@@ -278,7 +591,7 @@ def get_resource_name(filename):
 
 def is_regex(ids):
     "Checks to see if string contains special characters"
-    if isinstance(ids, basestring):
+    if isinstance(ids, str):
         ids = [ids]
     return not all(re.match(r"^\w+$", i) for i in ids)
 
@@ -286,7 +599,7 @@ def is_regex(ids):
 def list_results(login, path, attr):
     try:
         response = login.get_json("/data/archive/" + "/".join(path))
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         match = re.search(r"\(status (\d+)\)", str(e))
         if match:
             status_code = int(match.group(1))
@@ -304,6 +617,73 @@ def list_results(login, path, attr):
     return results
 
 
+RemoteFile = namedtuple("RemoteFile", ["path", "size", "digest"])
+
+
+def list_resource_files(resource):
+    """
+    Lists the files stored in a resource along with their sizes and MD5
+    digests, as recorded in the XNAT catalog (i.e. a single request to the
+    '/files' endpoint of the resource)
+
+    Parameters
+    ----------
+    resource : xnat.classes.AbstractResource
+        The resource to list the files of
+
+    Returns
+    -------
+    list(RemoteFile)
+        The files in the resource, where the path is relative to the resource
+        and URL-encoded (as required to request it from the server)
+    """
+    response = resource.xnat_session.get_json(resource.uri + "/files")
+    files = []
+    for row in response["ResultSet"]["Result"]:
+        path = re.sub(r"^.*/resources/[^/]+/files/", "", row["URI"], 1)
+        size = row.get("Size")
+        files.append(
+            RemoteFile(
+                path,
+                int(size) if size not in (None, "") else None,
+                row.get("digest") or None,
+            )
+        )
+    return files
+
+
+def calculate_checksum(fname, cache=None):
+    """
+    Calculates the MD5 digest of a file (as stored by XNAT)
+
+    Parameters
+    ----------
+    fname : str
+        Path to the file
+    cache : DigestCache | None
+        A cache to read the digest from if the file hasn't changed since it
+        was last calculated (and save it to otherwise)
+    """
+    try:
+        if cache is not None:
+            stat = os.stat(fname)
+            digest = cache.get(stat)
+            if digest is not None:
+                return digest
+        file_hash = hashlib.md5()
+        with open(fname, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                file_hash.update(chunk)
+        digest = file_hash.hexdigest()
+    except OSError:
+        raise XnatUtilsDigestCheckFailedError(
+            "Could not check digest of '{}' ".format(fname)
+        )
+    if cache is not None:
+        cache.put(fname, stat, digest)
+    return digest
+
+
 def _unpack_response(response_part, types):
     if isinstance(response_part, dict):
         if "children" in response_part:
@@ -331,33 +711,302 @@ def _unpack_response(response_part, types):
     return unpacked
 
 
-def matching_subjects(base, subject_ids, project_id=None):
-    if isinstance(subject_ids, basestring):
-        subject_ids = [subject_ids]
-    if project_id is not None:
+SUBJECT_COLUMNS = "ID,label,project"
+SESSION_COLUMNS = "ID,label,xsiType,date,project,subject_ID"
+SCAN_COLUMNS = "ID,type,xsiType"
+SESSION_SCAN_COLUMNS = "ID,xnat:imagescandata/id,xnat:imagescandata/type"
+# Characters that end the literal prefix of a regular expression
+REGEX_SPECIAL_CHARS = ".^$*+?{}[]\\|()"
+# Bounds used for open-ended date ranges in REST queries
+MIN_QUERY_DATE = datetime(1900, 1, 1).date()
+MAX_QUERY_DATE = datetime(9999, 12, 31).date()
+
+
+def list_rows(login, path, query=None, cache=None):
+    """
+    Lists the rows of a REST listing (i.e. the 'ResultSet' of the JSON
+    response), reading them from the metadata cache if one is provided and the
+    listing hasn't expired
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The XNAT session to retrieve the listing with
+    path : str
+        The REST path of the listing, e.g. '/data/projects/MYPROJ/experiments'
+    query : dict
+        Query parameters to pass with the request (e.g. 'columns')
+    cache : MetadataCache | None
+        The cache to read the listing from and save it to
+
+    Returns
+    -------
+    list(dict)
+        The rows of the listing
+    """
+    rows = cache.get(path, query) if cache is not None else None
+    if rows is None:
         try:
-            base = base.projects[project_id]
-        except KeyError:
-            raise XnatUtilsKeyError(
-                project_id, "No project named '{}'".format(project_id)
+            rows = login.get_json(path, query=query)["ResultSet"]["Result"]
+        except xnat.exceptions.XNATResponseError as e:
+            if _response_status(e) == 404:
+                raise XnatUtilsLookupError(path)
+            raise
+        if cache is not None:
+            cache.put(path, query, rows)
+    return rows
+
+
+def create_objects(login, path, rows, xsi_type=None):
+    """
+    Creates XnatPy objects from the rows of a REST listing. The columns of the
+    rows are cached in the objects so that accessing them doesn't require
+    another request to the server (other attributes are loaded on demand).
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The XNAT session to create the objects in
+    path : str
+        The REST path the rows were listed from
+    rows : list(dict)
+        The rows of the listing
+    xsi_type : str | None
+        The XSI type of the objects, if not included in the rows
+    """
+    objects = []
+    for row in rows:
+        fields = {
+            k: (v if v != "" else None)
+            for k, v in row.items()
+            if k not in ("ID", "URI", "xsiType")
+        }
+        objects.append(
+            login.create_object(
+                "{}/{}".format(path, row["ID"]),
+                type_=row.get("xsiType", xsi_type),
+                id_=row["ID"],
+                **fields,
             )
+        )
+    return objects
+
+
+def _response_status(error):
+    match = re.search(r"\(status (\d+)\)", str(error))
+    return int(match.group(1)) if match else None
+
+
+def open_metadata_cache(
+    login,
+    use_cache=False,
+    refresh_cache=False,
+    cache_ttl=DEFAULT_CACHE_TTL,
+    clear_cache=False,
+):
+    """
+    Opens the on-disk metadata cache for the server and user of the login if
+    requested (returns None otherwise)
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The XNAT session the listings are retrieved with
+    use_cache : bool
+        Whether to read listings from the cache
+    refresh_cache : bool
+        Whether to fetch all listings used from the server again and update
+        them in the cache (implies 'use_cache')
+    cache_ttl : float
+        The number of seconds cached listings are used for before being
+        fetched again
+    clear_cache : bool
+        Remove all listings cached for the server and user before starting
+    """
+    if not (use_cache or refresh_cache or clear_cache):
+        return None
+    cache = MetadataCache.for_login(login, ttl=cache_ttl, refresh=refresh_cache)
+    if clear_cache:
+        cache.invalidate()
+        if not (use_cache or refresh_cache):
+            cache.close()
+            return None
+    return cache
+
+
+def matching_projects(login, cache=None):
+    path = "/data/projects"
+    rows = list_rows(login, path, {"columns": "ID,name,secondary_ID"}, cache=cache)
+    return sorted(
+        create_objects(login, path, rows, xsi_type="xnat:projectData"),
+        key=attrgetter("id"),
+    )
+
+
+def literal_prefix(pattern):
+    """
+    Returns the literal characters at the start of a regular expression (i.e.
+    the prefix every string matched by the pattern will start with), which can
+    be passed to XNAT as a wildcard query to filter listings on the server
+
+    Parameters
+    ----------
+    pattern : str
+        The regular expression
+
+    Returns
+    -------
+    str
+        The literal prefix of the pattern (empty if there isn't one)
+    """
+    if "|" in pattern:
+        # Alternatives could start with different prefixes
+        return ""
+    prefix = ""
+    for char in pattern:
+        if char in REGEX_SPECIAL_CHARS:
+            # Quantifiers apply to the preceding character
+            if char in "*?{":
+                prefix = prefix[:-1]
+            break
+        prefix += char
+    return prefix
+
+
+class LabelMatcher(object):
+    """
+    Matches labels (of subjects, sessions, scans, etc...) against a set of
+    regular expressions, any one of which has to match the whole label.
+
+    The patterns are compiled once into a single alternation (or separately
+    if they refer to their own groups, e.g. with backreferences, or can't be
+    combined), and when filtering many labels only those starting with one of the literal
+    prefixes of the patterns (found by bisecting the sorted labels) are
+    checked against it.
+
+    Parameters
+    ----------
+    patterns : str | list(str)
+        The regular expression(s) to match the labels with
+    """
+
+    def __init__(self, patterns):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+        self._regexes = None
+        if not any(group_reference_re.search(p) for p in self.patterns):
+            alternation = "|".join(_scope_flags(p) for p in self.patterns)
+            try:
+                self._regexes = [re.compile(alternation)]
+            except re.error:
+                # E.g. comments in verbose patterns, which would swallow the
+                # closing bracket of the scope
+                pass
+        if self._regexes is None:
+            self._regexes = [re.compile(p) for p in self.patterns]
+        prefixes = sorted(set(literal_prefix(p) for p in self.patterns))
+        # Drop prefixes that are covered by a shorter prefix
+        self._prefixes = []
+        for prefix in prefixes:
+            if not self._prefixes or not prefix.startswith(self._prefixes[-1]):
+                self._prefixes.append(prefix)
+
+    def __call__(self, label):
+        return label is not None and any(r.fullmatch(label) for r in self._regexes)
+
+    def filter(self, items, key=None):
+        """
+        Returns the items whose labels are matched, in their original order
+
+        Parameters
+        ----------
+        items : iterable
+            The items (or labels) to filter
+        key : callable | None
+            Function that returns the label of an item (the items are the
+            labels if not provided)
+        """
+        items = list(items)
+        labels = [key(i) if key is not None else i for i in items]
+        if self._prefixes == [""]:
+            candidates = range(len(items))
+        else:
+            index = sorted((l, i) for i, l in enumerate(labels) if l is not None)
+            sorted_labels = [l for l, _ in index]
+            candidates = []
+            for prefix in self._prefixes:
+                pos = bisect_left(sorted_labels, prefix)
+                while pos < len(index) and sorted_labels[pos].startswith(prefix):
+                    candidates.append(index[pos][1])
+                    pos += 1
+            candidates.sort()
+        return [items[i] for i in candidates if self(labels[i])]
+
+
+def _scope_flags(pattern):
+    """
+    Wraps a pattern in a non-capturing group so it can be combined with
+    others, turning any inline flags at its start into flags of the group
+    """
+    flags = ""
+    match = global_flags_re.match(pattern)
+    while match is not None:
+        flags += match.group(1)
+        pattern = pattern[match.end():]
+        match = global_flags_re.match(pattern)
+    return "(?{}:{})".format(flags, pattern)
+
+
+def _in_date_range(date, before, after):
+    if not date:
+        return False
+    date = datetime.strptime(date[:10], "%Y-%m-%d").date()
+    return not (
+        (before is not None and date > before) or (after is not None and date < after)
+    )
+
+
+def matching_subjects(base, subject_ids, project_id=None, cache=None):
+    login = base
+    if isinstance(subject_ids, str):
+        subject_ids = [subject_ids]
+
+    def list_subjects(path):
+        rows = list_rows(login, path, {"columns": SUBJECT_COLUMNS}, cache=cache)
+        return create_objects(login, path, rows, xsi_type="xnat:subjectData")
+
+    if project_id is not None:
+        path = "/data/projects/{}/subjects".format(project_id)
+    else:
+        path = "/data/subjects"
     if not subject_ids:
         if project_id is None:
             raise XnatUtilsUsageError(
                 'project_id ("-p") must be provided to use empty IDs string'
             )
-        subjects = base.subjects.values()
+        try:
+            subjects = list_subjects(path)
+        except XnatUtilsLookupError:
+            raise XnatUtilsKeyError(
+                project_id, "No project named '{}'".format(project_id)
+            )
     elif is_regex(subject_ids):
-        subjects = [
-            s
-            for s in base.subjects.values()
-            if any(re.match(i + "$", s.label) for i in subject_ids)
-        ]
+        try:
+            subjects = LabelMatcher(subject_ids).filter(
+                list_subjects(path), key=attrgetter("label")
+            )
+        except XnatUtilsLookupError:
+            raise XnatUtilsKeyError(
+                project_id, "No project named '{}'".format(project_id)
+            )
     else:
         subjects = set()
         for id_ in subject_ids:
             try:
-                subjects.update(base.projects[id_].subjects.values())
+                subjects.update(
+                    list_subjects("/data/projects/{}/subjects".format(id_))
+                )
             except XnatUtilsLookupError:
                 raise XnatUtilsKeyError(
                     id_, "No project named '{}' (that you have access to)".format(id_)
@@ -375,6 +1024,7 @@ def matching_sessions(
     after=None,
     project_id=None,
     subject_id=None,
+    cache=None,
 ):
     """
     Parameters
@@ -405,57 +1055,48 @@ def matching_sessions(
     subject_id : str
         The subject ID to retrieve the sessions from. Requires project_id to
         also be supplied
+    cache : MetadataCache | None
+        A cache to read the session and scan listings from (and save them to)
+        instead of always requesting them from the server
     """
-    if isinstance(session_ids, basestring):
+    if isinstance(session_ids, str):
         session_ids = [session_ids]
-    if isinstance(before, basestring):
+    if isinstance(before, str):
         before = datetime.strptime(before, "%Y-%m-%d").date()
-    if isinstance(after, basestring):
+    if isinstance(after, str):
         after = datetime.strptime(after, "%Y-%m-%d").date()
-    if isinstance(with_scans, basestring):
+    if isinstance(with_scans, str):
         with_scans = [with_scans]
     elif with_scans is None:
         with_scans = ()
-    if isinstance(without_scans, basestring):
+    if isinstance(without_scans, str):
         without_scans = [without_scans]
     elif without_scans is None:
         without_scans = ()
 
     def valid(session):
-        if before is not None and session.date > before:
-            return False
-        if after is not None and session.date < after:
-            return False
         if with_scans or without_scans:
             scans = [
-                (s.type if s.type is not None else s.id) for s in session.scans.values()
+                (type_ if type_ is not None else id_)
+                for id_, type_ in scans_of_sessions[session.id]
             ]
-            for scan_type in with_scans:
-                if not any(re.match(scan_type + "$", s) for s in scans):
-                    return False
-            for scan_type in without_scans:
-                if any(re.match(scan_type + "$", s) for s in scans):
+            for matcher in with_scans_matchers:
+                if not any(matcher(s) for s in scans):
                     return False
+            if without_scans_matcher is not None and any(
+                without_scans_matcher(s) for s in scans
+            ):
+                return False
         return True
 
+    with_scans_matchers = [LabelMatcher(p) for p in with_scans]
+    without_scans_matcher = LabelMatcher(without_scans) if without_scans else None
+
     if project_id is not None:
-        try:
-            base = login.projects[project_id]
-        except KeyError:
-            raise XnatUtilsKeyError(
-                project_id, "No project named '{}'".format(project_id)
-            )
-        else:
-            if subject_id is not None:
-                try:
-                    base = base.subjects[subject_id]
-                except KeyError:
-                    raise XnatUtilsKeyError(
-                        subject_id,
-                        "No subject named '{}' in project '{}'".format(
-                            subject_id, project_id
-                        ),
-                    )
+        path = "/data/projects/{}".format(project_id)
+        if subject_id is not None:
+            path += "/subjects/{}".format(subject_id)
+        path += "/experiments"
     else:
         if subject_id is not None:
             raise XnatUtilsUsageError(
@@ -463,27 +1104,60 @@ def matching_sessions(
                     subject_id
                 )
             )
-        base = login
+        path = "/data/experiments"
+    # Filter the sessions on the server as far as possible so only the
+    # candidate rows are returned, the patterns are then matched exactly below
+    query = {"columns": SESSION_COLUMNS}
+    if session_ids and is_regex(session_ids):
+        prefix = os.path.commonprefix([literal_prefix(i) for i in session_ids])
+        if prefix:
+            query["label"] = prefix + "*"
+    if before is not None or after is not None:
+        query["date"] = "{}-{}".format(
+            (after if after is not None else MIN_QUERY_DATE).strftime("%m/%d/%Y"),
+            (before if before is not None else MAX_QUERY_DATE).strftime("%m/%d/%Y"),
+        )
+    try:
+        rows = list_rows(login, path, query, cache=cache)
+    except XnatUtilsLookupError:
+        if subject_id is not None:
+            raise XnatUtilsKeyError(
+                subject_id,
+                "No subject named '{}' in project '{}'".format(
+                    subject_id, project_id
+                ),
+            )
+        raise XnatUtilsKeyError(
+            project_id, "No project named '{}'".format(project_id)
+        )
+    if before is not None or after is not None:
+        rows = [r for r in rows if _in_date_range(r.get("date"), before, after)]
     if not session_ids:
         if project_id is None:
             raise XnatUtilsUsageError(
                 'project_id ("-p") must be provided to use empty IDs string'
             )
-        sessions = set(base.experiments.values())
     elif is_regex(session_ids):
-        sessions = set(
-            s
-            for s in base.experiments.values()
-            if any(re.match(i + "$", s.label) for i in session_ids)
-        )
+        rows = LabelMatcher(session_ids).filter(rows, key=itemgetter("label"))
     else:
-        sessions = set()
+        selected = []
         for id_ in session_ids:
-            try:
-                session = base.experiments[id_]
-            except KeyError:
+            matches = [r for r in rows if r["ID"] == id_] or [
+                r for r in rows if r["label"] == id_
+            ]
+            if not matches:
                 raise XnatUtilsKeyError(id_, "No session named '{}'".format(id_))
-            sessions.add(session)
+            elif len(matches) > 1:
+                raise XnatUtilsKeyError(
+                    id_,
+                    "Multiple sessions named '{}', please provide the project "
+                    "ID to distinguish between them".format(id_),
+                )
+            selected.extend(matches)
+        rows = selected
+    sessions = set(create_objects(login, path, rows))
+    if with_scans or without_scans:
+        scans_of_sessions = session_scans(login, sessions, cache=cache)
     filtered = [s for s in sessions if valid(s)]
     if not filtered:
         raise XnatUtilsNoMatchingSessionsException(
@@ -504,7 +1178,63 @@ def matching_sessions(
     return sorted(filtered, key=attrgetter("label"))
 
 
-def matching_scans(session, scan_types, match_id=True):
+def session_scans(login, sessions, cache=None):
+    """
+    Lists the IDs and types of the scans in each of the given sessions. The
+    scans of all sessions in a project are retrieved in a single request
+    (instead of one request per session), falling back to listing the scans
+    of each session separately for sessions that aren't included.
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The XNAT session to retrieve the listings with
+    sessions : list(xnat.classes.ImageSessionData)
+        The sessions to list the scans of
+    cache : MetadataCache | None
+        A cache to read the listings from (and save them to)
+
+    Returns
+    -------
+    dict[str, list(tuple(str, str))]
+        The (ID, type) pairs of the scans in each session, keyed by session ID
+    """
+    by_project = defaultdict(set)
+    for session in sessions:
+        by_project[session.project].add(session.id)
+    scans = {}
+    for project_id, session_ids in by_project.items():
+        if project_id is None:
+            continue
+        try:
+            rows = list_rows(
+                login,
+                "/data/projects/{}/experiments".format(project_id),
+                {"columns": SESSION_SCAN_COLUMNS},
+                cache=cache,
+            )
+        except XnatUtilsLookupError:
+            continue
+        # One row is returned per scan (or a single row with empty scan
+        # columns for sessions without any scans)
+        for row in rows:
+            if row["ID"] not in session_ids:
+                continue
+            scan_list = scans.setdefault(row["ID"], [])
+            scan_id = row.get("xnat:imagescandata/id")
+            if scan_id:
+                scan_list.append(
+                    (scan_id, row.get("xnat:imagescandata/type") or None)
+                )
+    for session in sessions:
+        if session.id not in scans:
+            scans[session.id] = [
+                (s.id, s.type) for s in matching_scans(session, None, cache=cache)
+            ]
+    return scans
+
+
+def matching_scans(session, scan_types, match_id=True, cache=None):
     def label(scan):
         if scan.type is not None:
             label = scan.type
@@ -514,11 +1244,16 @@ def matching_scans(session, scan_types, match_id=True):
             label = ""
         return label
 
-    matches = session.scans.values()
+    path = session.uri + "/scans"
+    matches = create_objects(
+        session.xnat_session,
+        path,
+        list_rows(
+            session.xnat_session, path, {"columns": SCAN_COLUMNS}, cache=cache
+        ),
+    )
     if scan_types is not None:
-        matches = (
-            s for s in matches if any(re.match(i + "$", label(s)) for i in scan_types)
-        )
+        matches = LabelMatcher(scan_types).filter(matches, key=label)
     return sorted(matches, key=label)
 
 
@@ -560,11 +1295,89 @@ class WrappedXnatSession(object):
         pass
 
 
+def resize_connection_pool(
+    login, size=DEFAULT_CONNECTION_POOL_SIZE, retry_policy=None
+):
+    """
+    Resizes the pool of HTTP connections held by the underlying requests
+    session so that concurrent workers don't have to wait for (or discard)
+    connections to the server, and sets how the requests sent through it are
+    retried
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The XNAT session to resize the connection pool of
+    size : int
+        The maximum number of connections to keep open to the server
+    retry_policy : RetryPolicy | None
+        How requests that fail with transient errors are retried (see
+        'xnatutils.retry'). Not retried if None
+    """
+    if size <= DEFAULT_CONNECTION_POOL_SIZE and retry_policy is None:
+        return
+    size = max(size, DEFAULT_CONNECTION_POOL_SIZE)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=size,
+        pool_maxsize=size,
+        max_retries=(retry_policy.urllib3_retry() if retry_policy is not None else 0),
+    )
+    login.interface.mount("https://", adapter)
+    login.interface.mount("http://", adapter)
+
+
+def item_errors():
+    """
+    Returns the errors that only prevent a single item of a batch (e.g. a row
+    of a manifest) from being processed, which are recorded against the item
+    instead of aborting the whole batch. The connection errors raised by
+    requests are also OSErrors
+    """
+    return (
+        XnatUtilsException,
+        xnat.exceptions.XNATResponseError,
+        xnat.exceptions.XNATUploadError,
+        OSError,
+    )
+
+
+def run_concurrently(func, items, jobs=1):
+    """
+    Applies 'func' to each of the items using a pool of worker threads,
+    yielding (item, result) pairs as the calls complete. If one of the calls
+    raises an exception, the pending items are cancelled and the exception is
+    re-raised once the calls already in flight have finished.
+
+    Parameters
+    ----------
+    func : callable
+        The function to apply to each item
+    items : iterable
+        The items to apply the function to
+    jobs : int
+        The number of worker threads to use. If <= 1 the items are processed
+        in order in the calling thread
+    """
+    if jobs is None or jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
 def remove_ignore_errors(path):
     try:
         os.remove(path)
     except OSError as e:
-        if e.errno != errno.EEXIST:
+        if e.errno != errno.ENOENT:
             raise
 
 
@@ -603,6 +1416,43 @@ def base_parser(description):
     return parser
 
 
+def add_cache_args(parser):
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=False,
+        help=(
+            "Read project/subject/session/scan listings from a local cache "
+            "(stored in ~/.cache/xnatutils) instead of requesting them from "
+            "the server each time"
+        ),
+    )
+    parser.add_argument(
+        "--refresh_cache",
+        action="store_true",
+        default=False,
+        help=(
+            "Fetch the listings used from the server again and update them in "
+            "the local cache (implies '--cache')"
+        ),
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=DEFAULT_CACHE_TTL,
+        help=(
+            "The number of seconds cached listings are used for before they "
+            "are fetched from the server again (default %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--clear_cache",
+        action="store_true",
+        default=False,
+        help="Remove all listings cached for the server and user",
+    )
+
+
 def add_default_args(parser):
     parser.add_argument(
         "--user",
@@ -642,6 +1492,29 @@ def add_default_args(parser):
             "~/.netrc. Useful if using a public account"
         ),
     )
+    parser.add_argument(
+        "--metrics_out",
+        "--metrics-out",
+        type=str,
+        default=None,
+        help=(
+            "Record the number of requests made to the server, the bytes "
+            "transferred and the latency of the responses for each endpoint "
+            "and save them to this file at the end of the run (e.g. for "
+            "Prometheus' textfile collector)"
+        ),
+    )
+    parser.add_argument(
+        "--metrics_format",
+        type=str,
+        default=None,
+        choices=_metrics.metrics_formats,
+        help=(
+            "The format to save the metrics in, guessed from the extension of "
+            "the output file if not provided ('.prom' for prometheus, json "
+            "otherwise)"
+        ),
+    )
 
 
 def set_logger(level=logging.INFO):
@@ -0,0 +1,395 @@
+import os
+import os.path
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from urllib.parse import urlencode
+
+logger = logging.getLogger("xnat-utils")
+
+# How long cached listings are used for before they are fetched again (secs)
+DEFAULT_CACHE_TTL = 3600
+
+
+def cache_dir():
+    """
+    Returns the directory the xnatutils caches are stored in, which is
+    $XNATUTILS_CACHE_DIR if set, otherwise 'xnatutils' within $XDG_CACHE_HOME
+    (~/.cache by default). The directory is created (readable by the user
+    only) if it doesn't exist
+    """
+    path = os.environ.get("XNATUTILS_CACHE_DIR")
+    if path is None:
+        path = os.path.join(
+            os.environ.get(
+                "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+            ),
+            "xnatutils",
+        )
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+class MetadataCache(object):
+    """
+    A persistent, on-disk cache of the listings (projects, subjects, sessions
+    and scans) retrieved from an XNAT server, stored in a SQLite database so
+    that they can be reused between runs and processes.
+
+    Each listing (i.e. REST path + query) is stored separately for each
+    server and user and expires 'ttl' seconds after it was fetched, so only
+    the listings that are requested are refreshed instead of the whole
+    catalog being rebuilt.
+
+    Parameters
+    ----------
+    server : str
+        The URI of the XNAT server the listings are retrieved from
+    user : str
+        The user the listings are retrieved as (different users can have
+        access to different projects)
+    ttl : float
+        The number of seconds after which a cached listing is fetched again
+    refresh : bool
+        Whether to ignore the listings currently in the cache, fetching them
+        again and replacing the cached versions
+    path : str
+        Path to the SQLite database to store the cache in. Defaults to
+        'metadata.sqlite' in the xnatutils cache directory
+    """
+
+    def __init__(self, server, user, ttl=DEFAULT_CACHE_TTL, refresh=False,
+                 path=None):
+        if path is None:
+            path = os.path.join(cache_dir(), "metadata.sqlite")
+        self.server = server
+        self.user = user if user is not None else ""
+        self.ttl = ttl
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS listings ("
+                "server TEXT, user TEXT, uri TEXT, fetched REAL, rows TEXT, "
+                "PRIMARY KEY (server, user, uri))"
+            )
+
+    @classmethod
+    def for_login(cls, login, **kwargs):
+        """
+        Opens the cache for the server and user of an XNAT session
+        """
+        return cls(login.server, login.logged_in_user, **kwargs)
+
+    def get(self, path, query=None):
+        """
+        Returns the cached rows of a listing, or None if the listing isn't in
+        the cache or has expired
+        """
+        if self.refresh:
+            return None
+        with self._lock:
+            entry = self._db.execute(
+                "SELECT fetched, rows FROM listings WHERE server=? AND user=? "
+                "AND uri=?",
+                (self.server, self.user, self._uri(path, query)),
+            ).fetchone()
+        if entry is None or entry[0] + self.ttl < time.time():
+            return None
+        return json.loads(entry[1])
+
+    def put(self, path, query, rows):
+        """
+        Saves (or replaces) the rows of a listing in the cache
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                (
+                    self.server,
+                    self.user,
+                    self._uri(path, query),
+                    time.time(),
+                    json.dumps(rows),
+                ),
+            )
+
+    def invalidate(self, path=None):
+        """
+        Removes the cached listings of the server/user, or only those under
+        the given REST path if provided
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM listings WHERE server=? AND user=? AND uri LIKE ?",
+                (self.server, self.user, (path or "") + "%"),
+            )
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def _uri(path, query):
+        if not query:
+            return path
+        return path + "?" + urlencode(sorted(query.items()))
+
+
+class DigestCache(object):
+    """
+    A persistent, on-disk cache of the MD5 digests of local files, so that
+    unchanged files don't need to be hashed again each time they are uploaded
+    and checked.
+
+    Digests are keyed by the device and inode of the file and are only reused
+    while its size and modification time (in ns) are unchanged. The cache is
+    stored in a SQLite database (in WAL mode) so it can be shared safely by
+    several processes on the same host.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database to store the cache in. Defaults to
+        'digests.sqlite' in the xnatutils cache directory
+    """
+
+    # Files modified more recently than this (in secs) aren't cached, as
+    # they could be modified again without their mtime changing on
+    # filesystems with coarse timestamps
+    MIN_AGE = 2.0
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(cache_dir(), "digests.sqlite")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+                "digest TEXT, PRIMARY KEY (device, inode))"
+            )
+
+    def get(self, stat):
+        """
+        Returns the cached digest of the file with the given stat result, or
+        None if it isn't cached or has changed since it was
+        """
+        with self._lock:
+            entry = self._db.execute(
+                "SELECT size, mtime_ns, digest FROM digests WHERE device=? AND "
+                "inode=?",
+                (stat.st_dev, stat.st_ino),
+            ).fetchone()
+        if entry is None or tuple(entry[:2]) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return entry[2]
+
+    def put(self, fname, stat, digest):
+        """
+        Saves the digest of a file, calculated after its stat result was
+        read. Not saved if the file has changed since then (or was modified
+        too recently to tell)
+        """
+        try:
+            current = os.stat(fname)
+        except OSError:
+            return
+        if (
+            (current.st_dev, current.st_ino, current.st_size, current.st_mtime_ns)
+            != (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            or time.time() - current.st_mtime < self.MIN_AGE
+        ):
+            return
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, digest),
+            )
+
+    def close(self):
+        self._db.close()
+
+
+class SessionCache(object):
+    """
+    A cache of the IDs of the sessions (JSESSIONID cookies) logged into XNAT
+    servers, so that they can be reused by later runs instead of logging in
+    each time. The cache file is only readable by the user and is ignored if
+    its permissions have been changed.
+
+    Each session is assumed to expire 'ttl' seconds after it was last used
+    (XNAT's default session timeout is 15 mins), after which it isn't tried.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file to store the cache in. Defaults to
+        'sessions.json' in the xnatutils cache directory
+    ttl : float
+        The number of seconds after its last use that a session is assumed
+        to have expired
+    """
+
+    DEFAULT_TTL = 900
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        if path is None:
+            path = os.path.join(cache_dir(), "sessions.json")
+        self.path = path
+        self.ttl = ttl
+
+    def get(self, server, user):
+        """
+        Returns the ID of the cached session for the server and user, or None
+        if there isn't one or it has expired
+        """
+        entry = self._load().get(self._key(server, user))
+        if entry is None or entry["expires"] < time.time():
+            return None
+        return entry["jsession"]
+
+    def put(self, server, user, jsession):
+        """
+        Saves (or renews) the session for the server and user
+        """
+        sessions = self._load()
+        now = time.time()
+        # Drop expired sessions so they don't accumulate
+        sessions = {k: v for k, v in sessions.items() if v["expires"] >= now}
+        sessions[self._key(server, user)] = {
+            "jsession": jsession,
+            "expires": now + self.ttl,
+        }
+        self._save(sessions)
+
+    def remove(self, server, user):
+        sessions = self._load()
+        if sessions.pop(self._key(server, user), None) is not None:
+            self._save(sessions)
+
+    def _load(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return {}
+        with os.fdopen(fd) as f:
+            if not _is_private(os.fstat(f.fileno())):
+                logger.warning(
+                    "Ignoring cached sessions in %s as it is accessible by other "
+                    "users",
+                    self.path,
+                )
+                return {}
+            try:
+                return json.load(f)
+            except ValueError:
+                return {}
+
+    def _save(self, sessions):
+        # Write to a temporary file created with user-only permissions and
+        # then move it into place so the file is never partially written or
+        # readable by others
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(sessions, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _key(server, user):
+        return "{} {}".format(server.rstrip("/"), user if user is not None else "")
+
+
+class SchemaCache(object):
+    """
+    A cache of the Python classes generated by XnatPy from the data model
+    (XSD schemas) of XNAT servers, so that the schemas don't need to be
+    downloaded and parsed each time a connection is made.
+
+    The generated source code is stored (along with the classes to register
+    and the display fields of each datatype) in a separate file for each
+    server, XNAT version and XnatPy version, and is regenerated after 'ttl'
+    seconds in case plugins have been added to the server. As the cached
+    source code is executed when it is loaded, the files are only readable by
+    the user and are ignored if their permissions (or those of the directory
+    they are in) have been changed.
+
+    Parameters
+    ----------
+    path : str
+        Directory to store the cached models in. Defaults to 'schemas' in the
+        xnatutils cache directory
+    ttl : float
+        The number of seconds after which a cached model is regenerated
+    """
+
+    DEFAULT_TTL = 7 * 24 * 3600
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        if path is None:
+            path = os.path.join(cache_dir(), "schemas")
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+
+    def get(self, key):
+        """
+        Returns the cached model for the key (a tuple of strings), or None if
+        it isn't cached or has expired
+        """
+        fname = self._fname(key)
+        try:
+            fd = os.open(fname, os.O_RDONLY)
+        except OSError:
+            return None
+        with os.fdopen(fd) as f:
+            info = os.fstat(f.fileno())
+            if info.st_mtime + self.ttl < time.time():
+                return None
+            try:
+                private = _is_private(info) and _is_private(os.stat(self.path))
+            except OSError:
+                return None
+            if not private:
+                logger.warning(
+                    "Ignoring cached data model in %s as it is accessible by other "
+                    "users",
+                    fname,
+                )
+                return None
+            try:
+                return json.load(f)
+            except ValueError:
+                return None
+
+    def put(self, key, model):
+        """
+        Saves a model (a JSON-serialisable dict) in the cache
+        """
+        fname = self._fname(key)
+        tmp_fname = "{}.{}.tmp".format(fname, os.getpid())
+        fd = os.open(tmp_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(model, f)
+        os.replace(tmp_fname, fname)
+
+    def _fname(self, key):
+        digest = hashlib.sha256("\n".join(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest + ".json")
+
+
+def _is_private(info):
+    """
+    Whether a file (or directory), given its stat info, is owned by the user
+    and not accessible by anyone else
+    """
+    return not (
+        info.st_mode & 0o077 or (hasattr(os, "getuid") and info.st_uid != os.getuid())
+    )
@@ -0,0 +1,309 @@
+import os
+import os.path
+import sys
+import json
+import time
+import socket
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+import socketserver
+from .cache import cache_dir
+from .version_ import __version__
+
+logger = logging.getLogger("xnat-utils")
+
+# How often the sessions held by the daemon are checked with the server before
+# being handed out (secs)
+DEFAULT_VALIDATE_INTERVAL = 60
+
+# How long clients wait for the daemon to respond before connecting directly
+# (secs)
+CLIENT_TIMEOUT = 30
+
+# Maximum size of a request sent to the daemon (bytes)
+MAX_REQUEST_SIZE = 2**16
+
+
+def socket_path():
+    """
+    Returns the path of the Unix socket the session daemon listens on, which
+    is $XNATUTILS_DAEMON_SOCKET if set, otherwise 'daemon.sock' within
+    $XDG_RUNTIME_DIR/xnatutils (or the xnatutils cache directory if
+    $XDG_RUNTIME_DIR isn't set)
+    """
+    path = os.environ.get("XNATUTILS_DAEMON_SOCKET")
+    if path is not None:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir is not None:
+        directory = os.path.join(runtime_dir, "xnatutils")
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    else:
+        directory = cache_dir()
+    return os.path.join(directory, "daemon.sock")
+
+
+def request_jsession(server, user=None, password=None, path=None):
+    """
+    Asks the session daemon (if it is running) for the ID of an authenticated
+    session (JSESSIONID) with the server, which the daemon logs into the
+    first time it is requested and keeps alive between commands.
+
+    Parameters
+    ----------
+    server : str
+        URI of the XNAT server
+    user : str | None
+        The user to log in as (read from the ~/.netrc by the daemon if None)
+    password : str | None
+        The password or alias-token secret of the user
+    path : str | None
+        Path to the socket of the daemon. Defaults to 'socket_path()'
+
+    Returns
+    -------
+    str | None
+        The session ID, or None if the daemon isn't running or couldn't log
+        into the server
+    """
+    if os.environ.get("XNATUTILS_NO_DAEMON") or not hasattr(socket, "AF_UNIX"):
+        return None
+    if path is None:
+        path = socket_path()
+    if not os.path.exists(path):
+        return None
+    request = {"server": server, "user": user, "password": password}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline().decode("utf-8"))
+    except (OSError, ValueError) as e:
+        logger.debug("Could not get session from daemon at %s: %s", path, e)
+        return None
+    if "error" in response:
+        logger.debug("Session daemon could not log in: %s", response["error"])
+        return None
+    return response.get("jsession")
+
+
+class SessionBroker(object):
+    """
+    Holds authenticated (and kept alive) XnatPy sessions for each server and
+    user that is requested, so that short-lived commands can reuse them via
+    their session IDs instead of logging in each time. The session IDs are
+    handed out over a Unix socket that only the user running the daemon can
+    connect to.
+
+    Parameters
+    ----------
+    path : str | None
+        Path of the Unix socket to listen on. Defaults to 'socket_path()'
+    validate_interval : float
+        How often (in secs) a held session is checked with the server before
+        its ID is handed out again
+    login : callable
+        Function used to log into a server, taking the server URI, user and
+        password (defaults to 'xnat.connect')
+    """
+
+    def __init__(
+        self, path=None, validate_interval=DEFAULT_VALIDATE_INTERVAL, login=None
+    ):
+        if path is None:
+            path = socket_path()
+        if login is None:
+            login = self._login
+        self.path = path
+        self.validate_interval = validate_interval
+        self.login = login
+        self._sessions = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def jsession(self, server, user=None, password=None):
+        """
+        Returns the ID of a valid session with the server for the user,
+        logging in again if the held session has expired
+        """
+        key = (
+            server.rstrip("/"),
+            user,
+            hashlib.sha256((password or "").encode("utf-8")).hexdigest(),
+        )
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # Only needed by the daemon, so not imported by commands that use it
+        from xnat.exceptions import XNATError
+        from requests.exceptions import RequestException
+
+        with lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                session, checked = entry
+                if time.time() - checked < self.validate_interval:
+                    return session.jsession
+                try:
+                    session.get("/data/JSESSION")
+                except (XNATError, RequestException):
+                    logger.info("Session with %s has expired", server)
+                    self._sessions.pop(key)
+                    session.disconnect()
+                else:
+                    self._sessions[key] = (session, time.time())
+                    return session.jsession
+            session = self.login(server, user, password)
+            self._sessions[key] = (session, time.time())
+            logger.info("Logged into %s as %s", server, session.logged_in_user)
+            return session.jsession
+
+    def serve_forever(self):
+        """
+        Listens for requests on the socket until 'shutdown' is called (or the
+        process is interrupted)
+        """
+        if os.path.exists(self.path):
+            if self._alive():
+                raise RuntimeError(
+                    "Session daemon is already running on {}".format(self.path)
+                )
+            # Left behind by a daemon that didn't shut down cleanly
+            os.remove(self.path)
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                broker._handle(self.request, self.rfile, self.wfile)
+
+        # Only allow the user to connect to the socket
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(umask)
+        self._server.daemon_threads = True
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            for session, _ in self._sessions.values():
+                session.disconnect()
+            self._sessions.clear()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+    def _handle(self, sock, rfile, wfile):
+        if not self._same_user(sock):
+            response = {"error": "Connections are only accepted from the same user"}
+        else:
+            try:
+                request = json.loads(rfile.readline(MAX_REQUEST_SIZE).decode("utf-8"))
+                response = {
+                    "jsession": self.jsession(
+                        request["server"],
+                        request.get("user"),
+                        request.get("password"),
+                    )
+                }
+            except Exception as e:  # Reported back to the client instead
+                logger.warning("Could not provide session: %s", e)
+                response = {"error": "{}: {}".format(type(e).__name__, e)}
+        wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    def _alive(self):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(self.path)
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def _same_user(sock):
+        # Only supported on Linux, elsewhere the permissions of the socket
+        # are relied on
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True
+        creds = sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", creds)
+        return uid == os.getuid()
+
+    @staticmethod
+    def _login(server, user, password):
+        import xnat
+
+        # The daemon doesn't use the data model of the server so it isn't
+        # loaded
+        return xnat.connect(
+            server,
+            user=user,
+            password=password,
+            loglevel="ERROR",
+            logger=logger,
+            no_parse_model=True,
+        )
+
+
+description = """
+Runs a local daemon that holds authenticated sessions with XNAT servers, so
+that xnat-utils commands run while it is running can reuse them instead of
+logging in each time. This saves the netrc lookup and login round-trips when
+running many short commands (e.g. in shell pipelines).
+
+The sessions are provided over a Unix socket that only the current user can
+connect to. Commands connect directly if the daemon isn't running (or the
+XNATUTILS_NO_DAEMON environment variable is set).
+
+    $ xnat-daemon &
+"""
+
+
+def parser():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Path of the socket to listen on (default: {})".format(socket_path()),
+    )
+    parser.add_argument(
+        "--validate_interval",
+        type=float,
+        default=DEFAULT_VALIDATE_INTERVAL,
+        help=(
+            "How often (in secs) held sessions are checked with the server "
+            "before being reused"
+        ),
+    )
+    parser.add_argument(
+        "--loglevel",
+        type=str,
+        default="info",
+        help="The level of logging printed to the console",
+    )
+    parser.add_argument(
+        "--version", "-V", action="version", version="%(prog)s " + __version__
+    )
+    return parser
+
+
+def cmd(argv=sys.argv[1:]):
+    args = parser().parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+    broker = SessionBroker(path=args.socket, validate_interval=args.validate_interval)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
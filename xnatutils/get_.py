@@ -1,17 +1,25 @@
 import sys
+import io
 import os.path
-from pathlib import Path
+import json
+import tarfile
+from pathlib import Path, PurePosixPath
 from collections import defaultdict
 import subprocess as sp
 from glob import glob
 from functools import reduce
 from operator import add
 import errno
+import itertools
 import re
 import logging
 import shutil
+import threading
+import tempfile
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
 from xml.etree import ElementTree
-from xnat.exceptions import XNATResponseError
 from .base import (
     sanitize_re,
     skip_resources,
@@ -20,6 +28,8 @@ from .base import (
     is_regex,
     base_parser,
     add_default_args,
+    add_cache_args,
+    open_metadata_cache,
     print_response_error,
     print_usage_error,
     print_info_message,
@@ -27,6 +37,19 @@ from .base import (
     matching_sessions,
     matching_scans,
     connect,
+    resize_connection_pool,
+    run_concurrently,
+    list_resource_files,
+    calculate_checksum,
+    remove_ignore_errors,
+    xnat,
+)
+from .metrics import start_metrics, stop_metrics
+from .retry import (
+    RetryPolicy,
+    NO_RETRIES,
+    add_retry_args,
+    retry_policy_from_args,
 )
 from .exceptions import (
     XnatUtilsUsageError,
@@ -34,11 +57,24 @@ from .exceptions import (
     XnatUtilsSkippedAllSessionsException,
     XnatUtilsException,
 )
+from .cache import DEFAULT_CACHE_TTL
 
 
 logger = logging.getLogger("xnat-utils")
 
 
+DOWNLOAD_CHUNK_SIZE = 524288
+
+# Name of the file the files downloaded with 'sync' are recorded in, saved in
+# each session (or subject) directory
+SYNC_MANIFEST_NAME = ".xnat-manifest.json"
+
+download_methods = ("zip", "per_file", "tgz_stream")
+
+# Matches the path of a file within a resource from the path of a member in a
+# downloaded archive, i.e. <session>/scans/<scan>/resources/<resource>/files/
+archive_member_re = re.compile(r"^(?:[^/]+/)*?resources/[^/]+/files/(.+)$")
+
 conv_choices = ["nifti", "nifti_gz", "mrtrix", "mrtrix_gz"]
 converter_choices = ("dcm2niix", "mrconvert")
 
@@ -61,6 +97,17 @@ def get(
     subject_id=None,
     match_scan_id=True,
     method="zip",
+    jobs=1,
+    file_jobs=1,
+    convert_jobs=None,
+    resume=False,
+    sync=False,
+    prune=False,
+    use_cache=False,
+    refresh_cache=False,
+    cache_ttl=DEFAULT_CACHE_TTL,
+    clear_cache=False,
+    retry_policy=None,
     **kwargs,
 ):
     """
@@ -178,11 +225,64 @@ def get(
         located at $HOME/.netrc
     method : str
         the method used to download the files from XNAT. Can be one of
-        ["zip", "per_file"], "zip" by default.
+        ["zip", "per_file", "tgz_stream"], "zip" by default. "tgz_stream"
+        extracts the files from a gzipped tar stream as they are received
+        instead of saving the archive to disk first
+    jobs : int
+        The number of resources to download concurrently, 1 by default
+    file_jobs : int
+        The number of files within each resource to download concurrently when
+        using the "per_file" method, 1 by default. Note that the total number
+        of simultaneous connections to the server can be up to
+        jobs * file_jobs
+    convert_jobs : int | None
+        The number of conversions (see 'convert_to') to run at the same time.
+        Conversions run in the background while the remaining resources are
+        downloaded. Defaults to the number of CPU cores
+    resume : bool
+        Whether to continue downloads left unfinished by a previous run
+        instead of starting them again. Files in the staging ('.download')
+        directories that match the size and digest recorded on the server are
+        kept and truncated files are continued where possible. Only applies
+        to the "per_file" method. Without it, the files of failed downloads are
+        removed
+    sync : bool
+        Whether to bring previously downloaded sessions up to date with the
+        server instead of downloading them again. The names, sizes and digests
+        of the downloaded files are recorded in a manifest file in each
+        session directory and only new or changed files are downloaded on
+        subsequent runs. Cannot be used with 'convert_to', 'strip_name' or
+        'skip_downloaded'
+    prune : bool
+        Whether to delete local files that have been deleted from the server
+        since the last sync (only applicable with 'sync')
+    use_cache : bool
+        Read the session and scan listings from a local on-disk cache, only
+        requesting them from the server if they aren't cached or have expired
+    refresh_cache : bool
+        Request the listings from the server and update them in the cache
+    cache_ttl : float
+        The number of seconds cached listings are used for
+    clear_cache : bool
+        Remove all cached listings for the server and user before starting
+    retry_policy : RetryPolicy | None
+        How requests and file downloads that fail with transient errors (e.g.
+        connection resets or 503 responses) are retried (see
+        'xnatutils.retry'). Files downloaded with the "per_file" method are
+        continued where the failed attempt left off. Defaults to
+        RetryPolicy()
     """
     # Convert scan string to list of scan strings if only one provided
     if isinstance(scans, str):
         scans = [scans]
+    _check_resume_method(resume, method)
+    _check_sync_options(sync, convert_to, strip_name)
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    if sync and skip_downloaded:
+        raise XnatUtilsUsageError(
+            "'sync' and 'skip_downloaded' options cannot be used together"
+        )
     if skip_downloaded:
         skip = [
             d
@@ -199,6 +299,14 @@ def get(
             "--skip_downloaded was provided".format(session)
         )
     with connect(**kwargs) as login:
+        resize_connection_pool(login, jobs * file_jobs, retry_policy=retry_policy)
+        cache = open_metadata_cache(
+            login,
+            use_cache=use_cache,
+            refresh_cache=refresh_cache,
+            cache_ttl=cache_ttl,
+            clear_cache=clear_cache,
+        )
         matched_sessions = matching_sessions(
             login,
             session,
@@ -209,10 +317,15 @@ def get(
             skip=skip,
             before=before,
             after=after,
+            cache=cache,
         )
-        downloaded_resources = defaultdict(list)
+        # Collect the resources to download before fetching any of them, so
+        # they can be distributed between the download workers
+        tasks = []
         for session in matched_sessions:
-            for scan in matching_scans(session, scans, match_id=match_scan_id):
+            for scan in matching_scans(
+                session, scans, match_id=match_scan_id, cache=cache
+            ):
                 resources = []
                 suffix = False
                 if resource_name is not None:
@@ -254,21 +367,45 @@ def get(
                         continue
                     if len(resource_names) > 1:
                         suffix = True
-                    for resource_name in resource_names:
-                        resources.append(scan.resources[resource_name])
+                    for scan_resource_name in resource_names:
+                        resources.append(scan.resources[scan_resource_name])
                 for resource in resources:
-                    _download_resource(
-                        resource,
-                        scan,
-                        session,
-                        download_dir,
-                        subject_dirs,
-                        convert_to,
-                        converter,
-                        strip_name,
-                        suffix=suffix,
-                        method=method,
-                    )
+                    tasks.append((resource, scan, session, suffix))
+        _check_converters([t[0] for t in tasks], convert_to, converter)
+
+        def download(task):
+            resource, scan, session, suffix = task
+            try:
+                return _download_resource(
+                    resource,
+                    scan,
+                    session,
+                    download_dir,
+                    subject_dirs,
+                    convert_to,
+                    converter,
+                    strip_name,
+                    suffix=suffix,
+                    method=method,
+                    file_jobs=file_jobs,
+                    resume=resume,
+                    sync=sync,
+                    prune=prune,
+                    conversions=conversions,
+                    retry_policy=retry_policy,
+                )
+            except XnatUtilsMissingResourceException as e:
+                logger.warning("%s, skipping", e)
+                return False
+
+        downloaded_resources = defaultdict(list)
+        with (
+            _ConversionPool(convert_jobs) if convert_to else nullcontext()
+        ) as conversions:
+            for (resource, _, session, _), was_downloaded in run_concurrently(
+                download, tasks, jobs=jobs
+            ):
+                if was_downloaded:
                     downloaded_resources[session.label].append(resource.uri)
     if not downloaded_resources:
         logger.warning(
@@ -294,6 +431,13 @@ def get_from_xml(
     subject_dirs=False,
     strip_name=False,
     method="zip",
+    jobs=1,
+    file_jobs=1,
+    convert_jobs=None,
+    resume=False,
+    sync=False,
+    prune=False,
+    retry_policy=None,
     **kwargs,
 ):
     """
@@ -349,14 +493,52 @@ def get_from_xml(
         located at $HOME/.netrc
     method : str
         the method used to download the files from XNAT. Can be one of
-        ["per_file", "tar_memory", "tgz_memory", "tar_file", "tgz_file"],
-        "tgz_file" by default.
+        ["zip", "per_file", "tgz_stream"], "zip" by default. "tgz_stream"
+        extracts the files from a gzipped tar stream as they are received
+        instead of saving the archive to disk first
+    jobs : int
+        The number of resources to download concurrently, 1 by default
+    file_jobs : int
+        The number of files within each resource to download concurrently when
+        using the "per_file" method, 1 by default. Note that the total number
+        of simultaneous connections to the server can be up to
+        jobs * file_jobs
+    convert_jobs : int | None
+        The number of conversions (see 'convert_to') to run at the same time.
+        Conversions run in the background while the remaining resources are
+        downloaded. Defaults to the number of CPU cores
+    resume : bool
+        Whether to continue downloads left unfinished by a previous run
+        instead of starting them again. Files in the staging ('.download')
+        directories that match the size and digest recorded on the server are
+        kept and truncated files are continued where possible. Only applies
+        to the "per_file" method. Without it, the files of failed downloads are
+        removed
+    sync : bool
+        Whether to bring previously downloaded sessions up to date with the
+        server instead of downloading them again. The names, sizes and digests
+        of the downloaded files are recorded in a manifest file in each
+        session directory and only new or changed files are downloaded on
+        subsequent runs. Cannot be used with 'convert_to', 'strip_name' or
+        'skip_downloaded'
+    prune : bool
+        Whether to delete local files that have been deleted from the server
+        since the last sync (only applicable with 'sync')
+    retry_policy : RetryPolicy | None
+        How requests and file downloads that fail with transient errors are
+        retried (see 'get'). Defaults to RetryPolicy()
     """
+    _check_resume_method(resume, method)
+    _check_sync_options(sync, convert_to, strip_name)
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
     with open(xml_file_path) as f:
         tree = ElementTree.parse(f)
     root = tree.getroot()
     downloaded = []
     with connect(**kwargs) as login:
+        resize_connection_pool(login, jobs * file_jobs, retry_policy=retry_policy)
+        tasks = []
         for entry in root.iter("{http://nrg.wustl.edu/catalog}entry"):
             uri = "/data/" + entry.attrib["URI"][1:]
             resource = login.create_object(
@@ -369,7 +551,12 @@ def get_from_xml(
                 scan = login.create_object(re.match(r".*/scans/[^/]+", uri).group(0))
             else:
                 scan = None
-            _download_resource(
+            tasks.append((resource, scan, session))
+        _check_converters([t[0] for t in tasks], convert_to, converter)
+
+        def download(task):
+            resource, scan, session = task
+            return _download_resource(
                 resource,
                 scan,
                 session,
@@ -379,8 +566,22 @@ def get_from_xml(
                 converter,
                 strip_name,
                 method=method,
+                file_jobs=file_jobs,
+                resume=resume,
+                sync=sync,
+                prune=prune,
+                conversions=conversions,
+                retry_policy=retry_policy,
             )
-            downloaded.append(resource.uri)
+
+        with (
+            _ConversionPool(convert_jobs) if convert_to else nullcontext()
+        ) as conversions:
+            for (resource, _, _), was_downloaded in run_concurrently(
+                download, tasks, jobs=jobs
+            ):
+                if was_downloaded:
+                    downloaded.append(resource.uri)
     logger.info("Successfully downloaded %s resources", len(downloaded))
     return downloaded
 
@@ -408,6 +609,12 @@ def _download_resource(
     strip_name,
     suffix=False,
     method="zip",
+    file_jobs=1,
+    resume=False,
+    sync=False,
+    prune=False,
+    conversions=None,
+    retry_policy=NO_RETRIES,
 ):
     if scan is not None:
         scan_label = scan.id
@@ -443,38 +650,104 @@ def _download_resource(
     if suffix:
         target_path += "-" + resource.label
     target_path += target_ext
+    if conversions is not None:
+        conversions.throttle()
+    # Resources that map onto the same target path (e.g. when sessions are
+    # grouped into subject directories) are downloaded one at a time
+    with _target_path_lock(target_path):
+        if sync:
+            return _sync_resource(
+                resource,
+                session,
+                target_dir,
+                target_path,
+                file_jobs,
+                prune,
+                retry_policy=retry_policy,
+            )
+        return _download_to_target(
+            resource,
+            scan,
+            session,
+            target_dir,
+            target_path,
+            scan_label,
+            convert_to,
+            converter,
+            strip_name,
+            method,
+            file_jobs,
+            resume,
+            conversions=conversions,
+            retry_policy=retry_policy,
+        )
+
+
+def _download_to_target(
+    resource,
+    scan,
+    session,
+    target_dir,
+    target_path,
+    scan_label,
+    convert_to,
+    converter,
+    strip_name,
+    method,
+    file_jobs,
+    resume,
+    conversions=None,
+    retry_policy=NO_RETRIES,
+):
     tmp_dir = target_path + ".download"
     # Download the scan from XNAT
     print("Downloading {}: {}-{}".format(session.label, scan_label, resource.label))
     try:
         if method == "zip":
-            resource.download_dir(tmp_dir)
+            retry_policy.call(
+                lambda: resource.download_dir(tmp_dir), url=resource.uri + "/files"
+            )
             # Extract the relevant data from the download dir and move to
             # target location
             src_path = glob(tmp_dir + "/**/files", recursive=True)[0]
         elif method == "per_file":
-            for file in resource.files:
-                download_path = Path(tmp_dir) / file
-                download_path.parent.mkdir(parents=True, exist_ok=True)
-                with open(download_path, "wb") as f:
-                    resource.xnat_session.download_stream(
-                        uri=resource.uri + f"/files/{file}", target_stream=f
-                    )
+
+            def download_file(remote_file):
+                _download_file(
+                    resource,
+                    remote_file,
+                    Path(tmp_dir) / unquote(remote_file.path),
+                    resume=resume,
+                    retry_policy=retry_policy,
+                )
+
+            remote_files = retry_policy.call(
+                lambda: list_resource_files(resource), url=resource.uri + "/files"
+            )
+            remote_files = _safe_remote_files(remote_files)
+            for _ in run_concurrently(download_file, remote_files, jobs=file_jobs):
+                pass
+            src_path = tmp_dir
+        elif method == "tgz_stream":
+            retry_policy.call(
+                lambda: _extract_stream(resource, tmp_dir), url=resource.uri + "/files"
+            )
             src_path = tmp_dir
         else:
             raise XnatUtilsUsageError(
-                f"Unrecognised download method '{method}', can be 'zip' or "
-                "'separate_files'"
+                f"Unrecognised download method '{method}', can be one of "
+                "'{}'".format("', '".join(download_methods))
             )
 
     except KeyError as e:
+        _discard_staging(tmp_dir, resume)
         raise XnatUtilsMissingResourceException(
             resource.label,
             session.label,
             scan_label,
             available=[r.label for r in scan.resources],
         ) from e
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         # Check for 404 status
         try:
             status = int(re.match(r".*\(status (\d+)\).*", str(e)).group(1))
@@ -487,7 +760,11 @@ def _download_resource(
                 return True
         except Exception:  # pylint: disable=broad-except
             pass
+        _discard_staging(tmp_dir, resume)
         raise e
+    except BaseException:
+        _discard_staging(tmp_dir, resume)
+        raise
     # Remove existing files/dirs at target_path before redownloading
     if os.path.exists(target_path):
         if os.path.isdir(target_path):
@@ -509,82 +786,520 @@ def _download_resource(
                 shutil.move(file_src_path, file_target_path)
         else:
             shutil.move(src_path, target_path)
-    else:
-        # Convert or move downloaded dir/files to target path
-        mrconvert = dcm2niix = None
-        if convert_to is not None:
-            if converter is None:
-                if convert_to in ("nifti", "nifti_gz") and resource.label == "DICOM":
-                    converter = "dcm2niix"
-                else:
-                    converter = "mrconvert"
-            if converter == "dcm2niix":
-                dcm2niix = find_executable("dcm2niix")
-                if dcm2niix is None:
-                    raise XnatUtilsUsageError(
-                        "Selected converter 'dcm2niix' is not available, "
-                        "please make sure it is installed and on your "
-                        "path"
-                    )
-            elif converter == "mrconvert":
-                mrconvert = find_executable("mrconvert")
-                if mrconvert is None:
-                    raise XnatUtilsUsageError(
-                        "Selected converter 'mrconvert' is not available, "
-                        "please make sure it is installed and on your "
-                        "path"
+    elif conversions is not None:
+        # Hand the downloaded files over to the conversion pool so the next
+        # resource can be downloaded while they are converted. They are moved
+        # out of the staging directory first so it can be reused straight away
+        staging_dir = tempfile.mkdtemp(
+            prefix="." + os.path.basename(target_path) + ".convert-", dir=target_dir
+        )
+        staged_path = os.path.join(staging_dir, "files")
+        shutil.move(src_path, staged_path)
+
+        def convert():
+            try:
+                with _target_path_lock(target_path):
+                    _convert(
+                        resource,
+                        scan,
+                        session,
+                        target_dir,
+                        target_path,
+                        scan_label,
+                        staged_path,
+                        convert_to,
+                        converter,
                     )
-            else:
-                assert False
-        try:
-            if converter == "dcm2niix":
-                # convert between dicom and nifti using dcm2niix.
-                # mrconvert can do this as well but there have been
-                # some problems losing TR from the dicom header.
-                zip_opt = "y" if convert_to == "nifti_gz" else "n"
-                convert_cmd = '{} -z {} -o "{}" -f "{}" "{}"'.format(
-                    dcm2niix,
-                    zip_opt,
-                    target_dir,
-                    (scan_label if scan is not None else resource.label),
-                    src_path,
-                )
-                sp.check_call(convert_cmd, shell=True)
-            elif converter == "mrconvert":
-                # If dcm2niix format is not installed or another is
-                # required use mrconvert instead.
-                sp.check_call(
-                    '{} "{}" "{}"'.format(mrconvert, src_path, target_path), shell=True
+            except Exception:
+                # Keep the downloaded data so it doesn't need to be
+                # downloaded again
+                logger.warning(
+                    "Conversion of %s:%s failed, the downloaded files have been "
+                    "kept in %s",
+                    session.label,
+                    scan_label,
+                    staged_path,
                 )
+                raise
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        conversions.submit(convert)
+    else:
+        _convert(
+            resource,
+            scan,
+            session,
+            target_dir,
+            target_path,
+            scan_label,
+            src_path,
+            convert_to,
+            converter,
+        )
+    # Clean up download dir
+    if Path(tmp_dir).exists():
+        shutil.rmtree(tmp_dir)
+    return True
+
+
+def _discard_staging(tmp_dir, resume):
+    """
+    Removes the files of a failed download from the staging directory, unless
+    they are kept so the download can be resumed (see 'resume')
+    """
+    if not resume:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _convert(
+    resource,
+    scan,
+    session,
+    target_dir,
+    target_path,
+    scan_label,
+    src_path,
+    convert_to,
+    converter,
+):
+    """
+    Converts the downloaded files of a resource to the requested format,
+    moving them to the target directory unconverted if the conversion fails
+    """
+    mrconvert = dcm2niix = None
+    converter = _select_converter(resource.label, convert_to, converter)
+    if converter == "dcm2niix":
+        dcm2niix = find_executable("dcm2niix")
+        if dcm2niix is None:
+            raise XnatUtilsUsageError(
+                "Selected converter 'dcm2niix' is not available, "
+                "please make sure it is installed and on your "
+                "path"
+            )
+    elif converter == "mrconvert":
+        mrconvert = find_executable("mrconvert")
+        if mrconvert is None:
+            raise XnatUtilsUsageError(
+                "Selected converter 'mrconvert' is not available, "
+                "please make sure it is installed and on your "
+                "path"
+            )
+    else:
+        assert False
+    try:
+        if converter == "dcm2niix":
+            # convert between dicom and nifti using dcm2niix.
+            # mrconvert can do this as well but there have been
+            # some problems losing TR from the dicom header.
+            zip_opt = "y" if convert_to == "nifti_gz" else "n"
+            convert_cmd = '{} -z {} -o "{}" -f "{}" "{}"'.format(
+                dcm2niix,
+                zip_opt,
+                target_dir,
+                (scan_label if scan is not None else resource.label),
+                src_path,
+            )
+            sp.check_call(convert_cmd, shell=True)
+        elif converter == "mrconvert":
+            # If dcm2niix format is not installed or another is
+            # required use mrconvert instead.
+            sp.check_call(
+                '{} "{}" "{}"'.format(mrconvert, src_path, target_path), shell=True
+            )
+        else:
+            if resource.label == "DICOM" and convert_to in ("nifti", "nifti_gz"):
+                msg = "either dcm2niix or "
             else:
-                if resource.label == "DICOM" and convert_to in ("nifti", "nifti_gz"):
-                    msg = "either dcm2niix or "
-                else:
-                    msg = ""
-                raise XnatUtilsUsageError(
-                    "Please install {} mrconvert to convert between {}"
-                    "and {} formats".format(msg, resource.label.lower(), convert_to)
+                msg = ""
+            raise XnatUtilsUsageError(
+                "Please install {} mrconvert to convert between {}"
+                "and {} formats".format(msg, resource.label.lower(), convert_to)
+            )
+    except sp.CalledProcessError as e:
+        shutil.move(
+            src_path,
+            os.path.join(
+                target_dir,
+                (scan_label if scan is not None else resource.label)
+                + get_extension(resource.label),
+            ),
+        )
+        logger.warning(
+            "Could not convert %s:%s to %s format (%s)",
+            session.label,
+            scan.type,
+            convert_to,
+            e.output.strip() if e.output is not None else "",
+        )
+
+
+def _select_converter(resource_label, convert_to, converter=None):
+    """
+    Returns the tool used to convert a resource to the requested format if
+    one isn't provided
+    """
+    if converter is not None:
+        return converter
+    if convert_to in ("nifti", "nifti_gz") and resource_label == "DICOM":
+        return "dcm2niix"
+    return "mrconvert"
+
+
+def _check_converters(resources, convert_to, converter=None):
+    """
+    Checks that the tools needed to convert the resources to the requested
+    format are installed, before any of them are downloaded
+    """
+    if not convert_to:
+        return
+    converters = set(
+        _select_converter(r.label, convert_to, converter)
+        for r in resources
+        if convert_to.upper() != r.label
+    )
+    for name in sorted(converters):
+        if shutil.which(name) is None:
+            raise XnatUtilsUsageError(
+                "Selected converter '{}' is not available, please make sure it "
+                "is installed and on your path".format(name)
+            )
+
+
+class _ConversionPool(object):
+    """
+    Runs the conversions of downloaded resources in the background, so that
+    downloads and conversions overlap. Up to 'jobs' converter processes are
+    run at a time, and downloads wait (see 'throttle') while 'max_pending'
+    conversions are already queued or running, bounding the amount of
+    unconverted data on disk.
+
+    Used as a context manager, which waits for all conversions to finish on
+    exit and re-raises the first error raised by any of them. Once a
+    conversion has failed, 'throttle' raises its error so that no more
+    resources are downloaded.
+    """
+
+    def __init__(self, jobs=None, max_pending=None):
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if max_pending is None:
+            max_pending = 2 * jobs
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+        self._max_pending = max_pending
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._futures = []
+        self._error = None
+
+    def throttle(self):
+        """
+        Blocks until there is room in the queue for another conversion, or
+        raises the error of a conversion that has failed
+        """
+        with self._condition:
+            while self._pending >= self._max_pending and self._error is None:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+
+    def submit(self, func):
+        with self._condition:
+            self._pending += 1
+        future = self._executor.submit(func)
+        future.add_done_callback(self._done)
+        self._futures.append(future)
+
+    def _done(self, future):
+        with self._condition:
+            self._pending -= 1
+            if self._error is None and not future.cancelled():
+                self._error = future.exception()
+            self._condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=True)
+        if exc_type is None:
+            for future in self._futures:
+                future.result()
+
+
+def _extract_stream(resource, target_dir):
+    """
+    Streams the files of a resource from the server as a gzipped tar archive
+    and extracts them into the target directory as they arrive, stripping the
+    leading '<session>/scans/<scan>/resources/<resource>/files' directories
+    from the member paths so the archive is never written to disk
+    """
+    chunks = resource.xnat_session.download_generator(
+        resource.uri + "/files", format="tar.gz", chunk_size=DOWNLOAD_CHUNK_SIZE
+    )
+    stream = io.BufferedReader(_ChunkReader(chunks), DOWNLOAD_CHUNK_SIZE)
+    with tarfile.open(fileobj=stream, mode="r|gz") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            match = archive_member_re.match(member.name)
+            parts = _safe_parts(match.group(1) if match else member.name)
+            if parts is None:
+                logger.warning(
+                    "Skipping archive member with unsafe path '%s'", member.name
                 )
-        except sp.CalledProcessError as e:
-            shutil.move(
-                src_path,
-                os.path.join(
-                    target_dir,
-                    (scan_label if scan is not None else resource.label)
-                    + get_extension(resource.label),
-                ),
+                continue
+            extract_path = Path(target_dir).joinpath(*parts)
+            extract_path.parent.mkdir(parents=True, exist_ok=True)
+            with archive.extractfile(member) as src, open(extract_path, "wb") as f:
+                shutil.copyfileobj(src, f, DOWNLOAD_CHUNK_SIZE)
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Wraps an iterator of byte chunks (e.g. a streamed response) in a readable
+    file-like object
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        num_bytes = min(len(buffer), len(self._buffer))
+        buffer[:num_bytes] = self._buffer[:num_bytes]
+        self._buffer = self._buffer[num_bytes:]
+        return num_bytes
+
+
+def _sync_resource(
+    resource,
+    session,
+    target_dir,
+    target_path,
+    file_jobs,
+    prune,
+    retry_policy=NO_RETRIES,
+):
+    """
+    Brings a previously downloaded resource up to date with the server, only
+    downloading the files that are new or whose size/digest has changed since
+    they were recorded in the manifest of the download directory
+    """
+    name = os.path.basename(target_path)
+    remote_files = _safe_remote_files(
+        retry_policy.call(
+            lambda: list_resource_files(resource), url=resource.uri + "/files"
+        )
+    )
+    with _manifest_lock:
+        recorded = _load_manifest(target_dir).get(name, {}).get("files", {})
+    if os.path.isfile(target_path):
+        os.remove(target_path)
+
+    def up_to_date(remote_file):
+        record = recorded.get(remote_file.path)
+        local_path = Path(target_path) / unquote(remote_file.path)
+        return (
+            record is not None
+            and record["size"] == remote_file.size
+            and record["digest"] == remote_file.digest
+            and local_path.exists()
+            and local_path.stat().st_size == remote_file.size
+        )
+
+    def download_file(remote_file):
+        # Files without a record may have been left over from an interrupted
+        # sync so can be resumed, whereas files changed on the server can't
+        _download_file(
+            resource,
+            remote_file,
+            Path(target_path) / unquote(remote_file.path),
+            resume=(remote_file.path not in recorded),
+            retry_policy=retry_policy,
+        )
+
+    changed = [f for f in remote_files if not up_to_date(f)]
+    print(
+        "Syncing {}: {}-{} ({} of {} files new or changed)".format(
+            session.label,
+            name,
+            resource.label,
+            len(changed),
+            len(remote_files),
+        )
+    )
+    for _ in run_concurrently(download_file, changed, jobs=file_jobs):
+        pass
+    removed = set(recorded) - set(f.path for f in remote_files)
+    if prune:
+        for path in removed:
+            # The manifest is a local file that could have been edited
+            if _safe_parts(unquote(path)) is not None:
+                remove_ignore_errors(os.path.join(target_path, unquote(path)))
+        if removed:
+            logger.info(
+                "Removed %s files from %s that were deleted from the server",
+                len(removed),
+                target_path,
             )
+    elif removed:
+        logger.warning(
+            "%s files in %s have been deleted from the server, pass 'prune' "
+            "to remove them",
+            len(removed),
+            target_path,
+        )
+    with _manifest_lock:
+        manifest = _load_manifest(target_dir)
+        manifest[name] = {
+            "uri": resource.uri,
+            "files": {
+                f.path: {"size": f.size, "digest": f.digest} for f in remote_files
+            },
+        }
+        _save_manifest(target_dir, manifest)
+    return True
+
+
+def _load_manifest(target_dir):
+    try:
+        with open(os.path.join(target_dir, SYNC_MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_manifest(target_dir, manifest):
+    manifest_path = os.path.join(target_dir, SYNC_MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+_manifest_lock = threading.Lock()
+
+
+def _check_sync_options(sync, convert_to, strip_name):
+    if sync and (convert_to is not None or strip_name):
+        raise XnatUtilsUsageError(
+            "'sync' option cannot be used with 'convert_to' or 'strip_name' "
+            "as the files are stored as they are on the server"
+        )
+
+
+def _safe_parts(path):
+    """
+    Splits the path of a file within a resource into its parts, returning None
+    if it is absolute or contains '..' components (i.e. could be used to write
+    outside of the target directory)
+    """
+    parts = PurePosixPath(path).parts
+    if not parts or parts[0] == "/" or ".." in parts:
+        return None
+    return parts
+
+
+def _safe_remote_files(remote_files):
+    "Drops the remote files with unsafe paths (see '_safe_parts')"
+    safe = []
+    for remote_file in remote_files:
+        if _safe_parts(unquote(remote_file.path)) is None:
+            logger.warning("Skipping file with unsafe path '%s'", remote_file.path)
+        else:
+            safe.append(remote_file)
+    return safe
+
+
+def _check_resume_method(resume, method):
+    if resume and method != "per_file":
+        logger.warning(
+            "Partially downloaded resources can only be resumed with the "
+            "'per_file' method, resources downloaded with the '%s' method will "
+            "be downloaded again from the start",
+            method,
+        )
+
+
+def _download_file(
+    resource, remote_file, download_path, resume=False, retry_policy=NO_RETRIES
+):
+    """
+    Downloads a single file of a resource. If 'resume' is set, a file left
+    over from a previous attempt is kept if its size and digest match the
+    catalog entry, or continued with a HTTP Range request if it was truncated.
+    Attempts that are retried after a transient error (see 'retry_policy')
+    always continue the file where the failed attempt left off
+    """
+    attempts = itertools.count()
+    retry_policy.call(
+        lambda: _download_file_attempt(
+            resource, remote_file, download_path, resume=(next(attempts) > 0 or resume)
+        ),
+        url=resource.uri + "/files/" + remote_file.path,
+    )
+
+
+def _download_file_attempt(resource, remote_file, download_path, resume=False):
+    download_path.parent.mkdir(parents=True, exist_ok=True)
+    offset = 0
+    if resume and download_path.exists():
+        offset = download_path.stat().st_size
+        if remote_file.size is None or offset > remote_file.size:
+            offset = 0
+        elif offset == remote_file.size:
+            if _digest_matches(download_path, remote_file):
+                logger.debug("Keeping previously downloaded '%s'", download_path)
+                return
+            offset = 0
+    if offset:
+        response = resource.xnat_session.interface.get(
+            resource.external_uri() + "/files/" + remote_file.path,
+            headers={"Range": "bytes={}-".format(offset)},
+            stream=True,
+        )
+        # Servers that don't support ranges return the whole file (200)
+        if response.status_code == 206:
+            with open(download_path, "ab") as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            if _digest_matches(download_path, remote_file):
+                logger.debug("Resumed download of '%s'", download_path)
+                return
             logger.warning(
-                "Could not convert %s:%s to %s format (%s)",
-                session.label,
-                scan.type,
-                convert_to,
-                e.output.strip() if e.output is not None else "",
+                "Digest of resumed download '%s' doesn't match the server, "
+                "downloading it again",
+                download_path,
             )
-    # Clean up download dir
-    if Path(tmp_dir).exists():
-        shutil.rmtree(tmp_dir)
-    return True
+        else:
+            response.close()
+    with open(download_path, "wb") as f:
+        resource.xnat_session.download_stream(
+            uri=resource.uri + "/files/" + remote_file.path,
+            target_stream=f,
+        )
+
+
+def _digest_matches(path, remote_file):
+    return remote_file.digest is None or (
+        calculate_checksum(path) == remote_file.digest
+    )
+
+
+def _target_path_lock(target_path):
+    with _target_path_locks_guard:
+        return _target_path_locks[target_path]
+
+
+_target_path_locks = defaultdict(threading.Lock)
+_target_path_locks_guard = threading.Lock()
 
 
 def _get_subject_from_session(session):
@@ -656,6 +1371,11 @@ by providing the '--convert_to' option and specifying the desired format.
 
     $ xnat-get TEST001_001_MR01 --scan 'ep2d_diff.*' --convert_to nifti_gz
 
+Large downloads can be sped up by downloading several resources at once with
+the '--jobs' option, e.g.
+
+    $ xnat-get 'MRH017_.*' --project MRH017 --jobs 8
+
 User credentials can be stored in a ~/.netrc file so that they don't need to be
 entered each time a command is run. If a new user provided or netrc doesn't
 exist the tool will ask whether to create a ~/.netrc file with the given
@@ -832,12 +1552,74 @@ def parser():
         "-m",
         type=str,
         default="zip",
-        choices=["zip", "per_file"],
+        choices=download_methods,
         help=(
             "the method used to download the files from XNAT. "
-            "Can be one of ['zip'], 'tgz_file' by default."
+            "Can be one of '{}', 'zip' by default. 'tgz_stream' extracts "
+            "the files as they are received instead of saving the archive "
+            "to disk first".format("', '".join(download_methods))
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        "-J",
+        type=int,
+        default=1,
+        help=("The number of resources to download concurrently"),
+    )
+    parser.add_argument(
+        "--file_jobs",
+        type=int,
+        default=1,
+        help=(
+            "The number of files within each resource to download "
+            "concurrently when using the 'per_file' method. Note that the "
+            "total number of connections to the server can be up to "
+            "jobs * file_jobs"
+        ),
+    )
+    parser.add_argument(
+        "--convert_jobs",
+        type=int,
+        default=None,
+        help=(
+            "The number of conversions (see '--convert_to') to run at the same "
+            "time, in the background while the remaining scans are downloaded. "
+            "Defaults to the number of CPU cores"
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help=(
+            "Continue downloads left unfinished by a previous run (e.g. one "
+            "that was interrupted) instead of starting them again. Only "
+            "applies to the 'per_file' method"
+        ),
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        default=False,
+        help=(
+            "Bring previously downloaded sessions up to date with the server, "
+            "only downloading files that are new or have changed since the "
+            "last sync (as recorded in a manifest file in each session "
+            "directory)"
+        ),
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        default=False,
+        help=(
+            "Delete local files that have been deleted from the server since "
+            "the last sync (only applicable with '--sync')"
         ),
     )
+    add_cache_args(parser)
+    add_retry_args(parser)
     add_default_args(parser)
     return parser
 
@@ -847,6 +1629,7 @@ def cmd(argv=sys.argv[1:]):
     args = parser().parse_args(argv)
 
     set_logger(args.loglevel)
+    metrics = start_metrics(args.metrics_out)
 
     if args.target is None:
         download_dir = os.getcwd()
@@ -866,6 +1649,13 @@ def cmd(argv=sys.argv[1:]):
                 strip_name=args.strip_name,
                 server=args.server,
                 method=args.method,
+                jobs=args.jobs,
+                file_jobs=args.file_jobs,
+                convert_jobs=args.convert_jobs,
+                resume=args.resume,
+                retry_policy=retry_policy_from_args(args),
+                sync=args.sync,
+                prune=args.prune,
                 use_netrc=(not args.no_netrc),
             )
         else:
@@ -883,6 +1673,17 @@ def cmd(argv=sys.argv[1:]):
                 strip_name=args.strip_name,
                 server=args.server,
                 method=args.method,
+                jobs=args.jobs,
+                file_jobs=args.file_jobs,
+                convert_jobs=args.convert_jobs,
+                resume=args.resume,
+                retry_policy=retry_policy_from_args(args),
+                sync=args.sync,
+                prune=args.prune,
+                use_cache=args.cache,
+                refresh_cache=args.refresh_cache,
+                cache_ttl=args.cache_ttl,
+                clear_cache=args.clear_cache,
                 use_netrc=(not args.no_netrc),
                 match_scan_id=(not args.dont_match_scan_id),
                 skip_downloaded=args.skip_downloaded,
@@ -893,7 +1694,9 @@ def cmd(argv=sys.argv[1:]):
             )
     except XnatUtilsUsageError as e:
         print_usage_error(e)
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    finally:
+        stop_metrics(metrics, args.metrics_out, args.metrics_format)
@@ -1,20 +1,21 @@
-from past.builtins import basestring
 import sys
-from operator import attrgetter
 import logging
 from .base import (
-    connect, is_regex, matching_subjects, matching_sessions,
-    base_parser, add_default_args, print_response_error, print_usage_error,
-    print_info_message, set_logger)
-from xnat.exceptions import XNATResponseError
+    connect, is_regex, matching_projects, matching_subjects,
+    matching_sessions, matching_scans, session_scans, open_metadata_cache,
+    base_parser, add_default_args, add_cache_args, print_response_error,
+    print_usage_error, print_info_message, set_logger, xnat)
 from .exceptions import XnatUtilsUsageError, XnatUtilsException
+from .cache import DEFAULT_CACHE_TTL
+from .metrics import start_metrics, stop_metrics
 
 logger = logging.getLogger('xnat-utils')
 
 
 def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
        return_attr=None, before=None, after=None, project_id=None,
-       subject_id=None, **kwargs):
+       subject_id=None, use_cache=False, refresh_cache=False,
+       cache_ttl=DEFAULT_CACHE_TTL, clear_cache=False, **kwargs):
     """
     Displays available projects, subjects, sessions and scans from an XNAT instance.
 
@@ -82,6 +83,15 @@ def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
     subject_id : str | None
         The ID of the subject to list the sessions/scans. Requires that
         project ID is also supplied.
+    use_cache : bool
+        Read the listings from a local on-disk cache, only requesting them
+        from the server if they aren't cached or have expired
+    refresh_cache : bool
+        Request the listings from the server and update them in the cache
+    cache_ttl : float
+        The number of seconds cached listings are used for
+    clear_cache : bool
+        Remove all cached listings for the server and user before listing
     user : str
         The user to connect to the server with
     loglevel : str
@@ -127,7 +137,7 @@ def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
                 "repositories with matching naming conventions "
                 "(e.g. Monash University). To suppress this message provide "
                 "the \"datatype\" (\"-d\") flag", xnat_id)
-            if isinstance(xnat_id, basestring):
+            if isinstance(xnat_id, str):
                 num_underscores = xnat_id.count('_')
             else:
                 nu_list = [i.count('_') for i in xnat_id]
@@ -159,26 +169,40 @@ def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
             raise XnatUtilsUsageError(msg.format('after'))
 
     with connect(**kwargs) as login:
+        cache = open_metadata_cache(
+            login, use_cache=use_cache, refresh_cache=refresh_cache,
+            cache_ttl=cache_ttl, clear_cache=clear_cache)
         if datatype == 'project':
-            matches = sorted(login.projects.values(),
-                             key=attrgetter('id'))
+            matches = matching_projects(login, cache=cache)
             return_attr = 'id' if return_attr is None else return_attr
         elif datatype == 'subject':
-            matches = matching_subjects(login, xnat_id, project_id=project_id)
+            matches = matching_subjects(login, xnat_id, project_id=project_id,
+                                        cache=cache)
             return_attr = 'label' if return_attr is None else return_attr
         elif datatype == 'session':
             matches = matching_sessions(
                 login, xnat_id, with_scans=with_scans,
                 without_scans=without_scans, project_id=project_id,
-                subject_id=subject_id, before=before, after=after)
+                subject_id=subject_id, before=before, after=after,
+                cache=cache)
             return_attr = 'label' if return_attr is None else return_attr
         elif datatype == 'scan':
-            matches = set()
-            for session in matching_sessions(login, xnat_id,
-                                             project_id=project_id,
-                                             subject_id=subject_id):
-                matches |= set(session.scans.values())
+            sessions = matching_sessions(login, xnat_id,
+                                         project_id=project_id,
+                                         subject_id=subject_id, cache=cache)
             return_attr = 'type' if return_attr is None else return_attr
+            if return_attr in ('type', 'id'):
+                # Read the scan IDs/types from the bulk listing instead of
+                # creating the scan objects for each session
+                index = 1 if return_attr == 'type' else 0
+                return sorted(
+                    s[index]
+                    for scans in session_scans(login, sessions,
+                                               cache=cache).values()
+                    for s in scans if s[index] is not None)
+            matches = set()
+            for session in sessions:
+                matches |= set(matching_scans(session, None, cache=cache))
         else:
             assert False
         if return_attr:
@@ -265,6 +289,7 @@ def parser():
     parser.add_argument('--after', '-a', default=None, type=str,
                         help=("Only select sessions after this date "
                               "(in Y-m-d format, e.g. 2018-02-27)"))
+    add_cache_args(parser)
     add_default_args(parser)
     return parser
 
@@ -274,6 +299,7 @@ def cmd(argv=sys.argv[1:]):
     args = parser().parse_args(argv)
 
     set_logger(args.loglevel)
+    metrics = start_metrics(args.metrics_out)
 
     try:
         print('\n'.join(ls(args.id_or_regex, datatype=args.datatype,
@@ -282,11 +308,16 @@ def cmd(argv=sys.argv[1:]):
                            server=args.server, project_id=args.project,
                            subject_id=args.subject,
                            return_attr=args.return_attr, before=args.before,
-                           after=args.after,
+                           after=args.after, use_cache=args.cache,
+                           refresh_cache=args.refresh_cache,
+                           cache_ttl=args.cache_ttl,
+                           clear_cache=args.clear_cache,
                            use_netrc=(not args.no_netrc))))
     except XnatUtilsUsageError as e:
         print_usage_error(e)
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    finally:
+        stop_metrics(metrics, args.metrics_out, args.metrics_format)
@@ -0,0 +1,483 @@
+import os
+import os.path
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+logger = logging.getLogger("xnat-utils")
+
+# Upper bounds of the buckets of the latency histograms (secs), the same as
+# the default buckets of the Prometheus client libraries
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+metrics_formats = ("json", "prometheus")
+
+# Segments of REST paths that are followed by the ID (or label) of an object,
+# which is replaced by a placeholder in the endpoint patterns so requests to
+# the same endpoint are grouped together
+ID_SEGMENTS = {
+    "projects": "{project}",
+    "subjects": "{subject}",
+    "experiments": "{experiment}",
+    "scans": "{scan}",
+    "resources": "{resource}",
+    "assessors": "{assessor}",
+    "reconstructions": "{reconstruction}",
+    "schemas": "{schema}",
+    "elements": "{datatype}",
+    "users": "{user}",
+}
+
+rest_root_re = re.compile(r"/(data|xapi|REST)(/|$)")
+
+_active = None
+
+
+def endpoint_pattern(url):
+    """
+    Returns the REST endpoint of a URL, with the IDs of objects and the paths
+    of files replaced by placeholders, e.g.
+    '/data/experiments/{experiment}/scans/{scan}/resources/{resource}/files'
+    for the listing of files in a scan resource
+    """
+    path = urlsplit(url).path
+    # Strip the path that the server is hosted at (if any)
+    match = rest_root_re.search(path)
+    if match is not None:
+        path = path[match.start():]
+    segments = path.strip("/").split("/")
+    pattern = []
+    placeholder = None
+    for i, segment in enumerate(segments):
+        if placeholder is not None:
+            pattern.append(placeholder)
+            placeholder = None
+        elif segment == "files" and i + 1 < len(segments):
+            pattern.extend(["files", "{path}"])
+            break
+        else:
+            pattern.append(segment)
+            placeholder = ID_SEGMENTS.get(segment)
+    return "/" + "/".join(pattern)
+
+
+class EndpointMetrics(object):
+    "The requests made to an endpoint with a given HTTP method"
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = {}
+        self.errors = 0
+        self.retries = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        # Number of requests in each latency bucket (the last is for
+        # requests that took longer than the largest bucket)
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def observe_latency(self, secs):
+        self.latency_counts[bisect_left(LATENCY_BUCKETS, secs)] += 1
+        self.latency_sum += secs
+
+    def cumulative_buckets(self):
+        "The number of requests that took <= each bucket, as in Prometheus"
+        buckets = []
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.latency_counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+class RequestMetrics(object):
+    """
+    Records the number of HTTP requests made to XNAT servers by the sessions
+    it is attached to (see 'instrument'), along with the bytes transferred,
+    the latency of the responses and the number of retries, for each endpoint
+    and method.
+
+    The latency of a request is the time from when it is sent until the
+    headers of the response are received (i.e. excluding the time taken to
+    download the body of streamed responses). The received bytes are counted
+    as the bodies of the responses are read. The requests made by XnatPy to
+    log in, before the session is returned, are not included.
+
+    Parameters
+    ----------
+    command : str | None
+        The name of the command the requests are made by, which is included
+        in the output. Defaults to the name of the running script
+    """
+
+    def __init__(self, command=None):
+        if command is None:
+            command = os.path.basename(sys.argv[0]) if sys.argv[0] else "python"
+        self.command = command
+        self.started = time.time()
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def instrument(self, login):
+        """
+        Attaches the metrics to a XnatPy session, so that all requests made
+        through it are recorded
+
+        Parameters
+        ----------
+        login : xnat.Session
+            The session to record the requests of
+        """
+        session = login.interface
+        if getattr(session, "_xnatutils_metrics", None) is self:
+            return
+        # Only needed once connected, so not imported by commands that don't
+        import requests
+
+        send = session.send
+        metrics = self
+
+        def instrumented_send(request, **kwargs):
+            if (
+                request.body is not None
+                and not isinstance(request.body, (bytes, str, _CountingIterator))
+                and not hasattr(request.body, "read")
+            ):
+                # Chunked (streamed) bodies are counted as they are sent
+                request.body = _CountingIterator(
+                    request.body, metrics._key(request), metrics
+                )
+            try:
+                return send(request, **kwargs)
+            except requests.exceptions.RequestException:
+                with metrics._lock:
+                    stats = metrics._stats(metrics._key(request))
+                    stats.requests += 1
+                    stats.errors += 1
+                    stats.sent_bytes += _body_size(request)
+                raise
+
+        session.send = instrumented_send
+        session.hooks["response"].append(self._record_response)
+        session._xnatutils_metrics = self
+
+    def retry(self, method, url, count=1):
+        "Records that a request was retried (i.e. by the caller)"
+        with self._lock:
+            self._stats((method.upper(), endpoint_pattern(url))).retries += count
+
+    def endpoints(self):
+        """
+        Returns the metrics of each endpoint, sorted by the number of requests
+        (most first)
+
+        Returns
+        -------
+        list(tuple(tuple(str, str), EndpointMetrics))
+            The method and endpoint pattern, and the metrics of its requests
+        """
+        with self._lock:
+            return sorted(
+                self._endpoints.items(), key=lambda i: (-i[1].requests, i[0])
+            )
+
+    def as_dict(self):
+        endpoints = []
+        totals = dict.fromkeys(
+            ("requests", "errors", "retries", "sent_bytes", "received_bytes"), 0
+        )
+        for (method, endpoint), stats in self.endpoints():
+            for key in totals:
+                totals[key] += getattr(stats, key)
+            endpoints.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "requests": stats.requests,
+                    "statuses": {str(k): v for k, v in sorted(stats.statuses.items())},
+                    "errors": stats.errors,
+                    "retries": stats.retries,
+                    "sent_bytes": stats.sent_bytes,
+                    "received_bytes": stats.received_bytes,
+                    "latency_secs": {
+                        "sum": stats.latency_sum,
+                        "count": sum(stats.latency_counts),
+                        "buckets": {
+                            str(bound): count
+                            for bound, count in stats.cumulative_buckets()
+                        },
+                    },
+                }
+            )
+        return {
+            "command": self.command,
+            "started": self.started,
+            "duration_secs": time.time() - self.started,
+            "totals": totals,
+            "endpoints": endpoints,
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2) + "\n"
+
+    def to_prometheus(self):
+        "Formats the metrics for the node_exporter's textfile collector"
+        command = _label_value(self.command)
+        lines = []
+
+        def metric(name, type_, help_):
+            lines.append("# HELP xnatutils_{} {}".format(name, help_))
+            lines.append("# TYPE xnatutils_{} {}".format(name, type_))
+
+        endpoints = self.endpoints()
+        metric("http_requests_total", "counter", "HTTP requests made to XNAT")
+        for (method, endpoint), stats in endpoints:
+            labels = _labels(command, method, endpoint)
+            for status, count in sorted(stats.statuses.items()):
+                lines.append(
+                    'xnatutils_http_requests_total{{{},status="{}"}} {}'.format(
+                        labels, status, count
+                    )
+                )
+            if stats.errors:
+                lines.append(
+                    'xnatutils_http_requests_total{{{},status="error"}} {}'.format(
+                        labels, stats.errors
+                    )
+                )
+        for name, attr, help_ in (
+            ("http_retries_total", "retries", "Retries of HTTP requests"),
+            ("http_sent_bytes_total", "sent_bytes", "Bytes sent in request bodies"),
+            (
+                "http_received_bytes_total",
+                "received_bytes",
+                "Bytes received in response bodies",
+            ),
+        ):
+            metric(name, "counter", help_)
+            for (method, endpoint), stats in endpoints:
+                lines.append(
+                    "xnatutils_{}{{{}}} {}".format(
+                        name, _labels(command, method, endpoint), getattr(stats, attr)
+                    )
+                )
+        metric(
+            "http_request_duration_seconds",
+            "histogram",
+            "Time until the response headers were received",
+        )
+        for (method, endpoint), stats in endpoints:
+            labels = _labels(command, method, endpoint)
+            for bound, count in stats.cumulative_buckets():
+                lines.append(
+                    'xnatutils_http_request_duration_seconds_bucket{{{},le="{}"}} {}'
+                    .format(labels, bound, count)
+                )
+            lines.append(
+                "xnatutils_http_request_duration_seconds_sum{{{}}} {}".format(
+                    labels, stats.latency_sum
+                )
+            )
+            lines.append(
+                "xnatutils_http_request_duration_seconds_count{{{}}} {}".format(
+                    labels, sum(stats.latency_counts)
+                )
+            )
+        metric("run_duration_seconds", "gauge", "Duration of the last run")
+        lines.append(
+            'xnatutils_run_duration_seconds{{command="{}"}} {}'.format(
+                command, time.time() - self.started
+            )
+        )
+        metric("run_timestamp_seconds", "gauge", "Time the last run started")
+        lines.append(
+            'xnatutils_run_timestamp_seconds{{command="{}"}} {}'.format(
+                command, self.started
+            )
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, format=None):
+        """
+        Writes the metrics to a file (replacing it in a single step, so that
+        a partially written file is never read by a scraper)
+
+        Parameters
+        ----------
+        path : str
+            The path of the file to write
+        format : str | None
+            Either 'json' or 'prometheus' (textfile collector format).
+            Guessed from the extension of the path if not provided ('.prom'
+            for Prometheus, JSON otherwise)
+        """
+        if format is None:
+            format = "prometheus" if path.endswith(".prom") else "json"
+        if format == "json":
+            text = self.to_json()
+        elif format == "prometheus":
+            text = self.to_prometheus()
+        else:
+            raise ValueError(
+                "Unrecognised metrics format '{}', can be one of '{}'".format(
+                    format, "', '".join(metrics_formats)
+                )
+            )
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def _record_response(self, response, **kwargs):
+        key = self._key(response.request)
+        with self._lock:
+            stats = self._stats(key)
+            stats.requests += 1
+            stats.statuses[response.status_code] = (
+                stats.statuses.get(response.status_code, 0) + 1
+            )
+            stats.sent_bytes += _body_size(response.request)
+            stats.observe_latency(response.elapsed.total_seconds())
+            # Retries made by the connection pool (i.e. urllib3.Retry)
+            retries = getattr(response.raw, "retries", None)
+            if retries is not None:
+                stats.retries += len(retries.history)
+        response.raw = _CountingReader(response.raw, key, self)
+        return response
+
+    def _key(self, request):
+        return (request.method, endpoint_pattern(request.url))
+
+    def _stats(self, key):
+        try:
+            return self._endpoints[key]
+        except KeyError:
+            stats = self._endpoints[key] = EndpointMetrics()
+            return stats
+
+    def _add_received(self, key, num_bytes):
+        with self._lock:
+            self._stats(key).received_bytes += num_bytes
+
+    def _add_sent(self, key, num_bytes):
+        with self._lock:
+            self._stats(key).sent_bytes += num_bytes
+
+
+class _CountingReader(object):
+    """
+    Wraps the raw (urllib3) response of a request to count the bytes of the
+    body as it is read
+    """
+
+    def __init__(self, raw, key, metrics):
+        self._raw = raw
+        self._key = key
+        self._metrics = metrics
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        if data:
+            self._metrics._add_received(self._key, len(data))
+        return data
+
+    def stream(self, *args, **kwargs):
+        for chunk in self._raw.stream(*args, **kwargs):
+            self._metrics._add_received(self._key, len(chunk))
+            yield chunk
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class _CountingIterator(object):
+    "Wraps a chunked request body to count the bytes sent"
+
+    def __init__(self, chunks, key, metrics):
+        self._chunks = chunks
+        self._key = key
+        self._metrics = metrics
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self._metrics._add_sent(self._key, len(chunk))
+            yield chunk
+
+
+def _body_size(request):
+    body = request.body
+    if body is None or isinstance(body, _CountingIterator):
+        # Streamed bodies are counted as they are sent
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    try:
+        return int(request.headers.get("Content-Length", 0))
+    except ValueError:
+        return 0
+
+
+def _label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(command, method, endpoint):
+    return 'command="{}",method="{}",endpoint="{}"'.format(
+        command, method, _label_value(endpoint)
+    )
+
+
+def active():
+    "Returns the metrics being recorded (see 'start_metrics'), if any"
+    return _active
+
+
+def start_metrics(path, command=None):
+    """
+    Starts recording the HTTP requests made by the sessions returned by
+    'connect' if an output path is provided (e.g. the '--metrics_out' option
+    of the commands)
+
+    Returns
+    -------
+    RequestMetrics | None
+        The metrics being recorded, None if no path was provided
+    """
+    global _active
+    if path is None:
+        return None
+    _active = RequestMetrics(command=command)
+    return _active
+
+
+def stop_metrics(metrics, path, format=None):
+    """
+    Stops recording the metrics started by 'start_metrics' and writes them to
+    the output path (does nothing if metrics is None)
+    """
+    global _active
+    if metrics is None:
+        return
+    if _active is metrics:
+        _active = None
+    try:
+        metrics.write(path, format=format)
+    except OSError as e:
+        logger.warning("Could not write metrics to '%s': %s", path, e)
+
+
+def instrument(login):
+    "Records the requests made by a session if metrics are being recorded"
+    if _active is not None:
+        _active.instrument(login)
+
+
+def record_retry(method, url):
+    "Records a retry made by the caller if metrics are being recorded"
+    if _active is not None:
+        _active.retry(method, url)
@@ -1,9 +1,16 @@
 import sys
+import csv
+import io
+import itertools
+import zlib
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os.path
+import shutil
 import tempfile
-import hashlib
 from pathlib import Path
-from xnat.exceptions import XNATResponseError
+from urllib.parse import unquote
 from .base import (
     sanitize_re,
     illegal_scan_chars_re,
@@ -16,17 +23,43 @@ from .base import (
     print_usage_error,
     print_info_message,
     set_logger,
+    calculate_checksum,
+    list_resource_files,
+    run_concurrently,
+    resize_connection_pool,
+    item_errors,
+    xnat,
 )
 from .exceptions import (
     XnatUtilsUsageError,
     XnatUtilsError,
-    XnatUtilsDigestCheckFailedError,
     XnatUtilsDigestCheckError,
     XnatUtilsException,
     XnatUtilsNoMatchingSessionsException,
 )
+from .cache import DigestCache
+from .metrics import start_metrics, stop_metrics
+from .retry import (
+    RetryPolicy,
+    NO_RETRIES,
+    add_retry_args,
+    retry_policy_from_args,
+)
 
-HASH_CHUNK_SIZE = 2**20
+# Methods that can be used to upload the files of a dataset, the "_stream"
+# methods generate the archive while it is being sent
+upload_methods = (
+    "per_file",
+    "tar_memory",
+    "tgz_memory",
+    "tar_file",
+    "tgz_file",
+    "tar_stream",
+    "tgz_stream",
+)
+UPLOAD_CHUNK_SIZE = 2**20
+# The amount of data compressed into each member by ParallelGzipCompressor
+GZIP_BLOCK_SIZE = 2**20
 
 
 def put(
@@ -41,6 +74,10 @@ def put(
     scan_id=None,
     modality=None,
     method="tgz_file",
+    use_digest_cache=True,
+    incremental=False,
+    compress_jobs=None,
+    retry_policy=None,
     **kwargs,
 ):
     """
@@ -112,36 +149,278 @@ def put(
         Whether to load and save user credentials from netrc file
         located at $HOME/.netrc
     method : str
-        the method used to download the files from XNAT. Can be one of
-        ["per_file", "tar_memory", "tgz_memory", "tar_file", "tgz_file"],
-        "tgz_file" by default.
+        the method used to upload the files to XNAT. Can be one of
+        ["per_file", "tar_memory", "tgz_memory", "tar_file", "tgz_file",
+        "tar_stream", "tgz_stream"], "tgz_file" by default. The "_stream"
+        methods generate the archive while it is being uploaded instead of
+        writing it to a temporary file or memory first
+    use_digest_cache : bool
+        Whether to reuse the digests of local files calculated by previous
+        uploads if the files haven't been modified since (stored in
+        ~/.cache/xnatutils)
+    incremental : bool
+        When overwriting an existing dataset, only upload the files that are
+        new or have changed (i.e. whose digests differ from those on the
+        server) and delete the remote files that don't exist locally, instead
+        of deleting the whole resource and uploading all files again.
+        Requires 'overwrite'
+    compress_jobs : int | None
+        The number of threads used to compress the uploaded archive with the
+        "tgz_" methods, the number of CPU cores by default
+    retry_policy : RetryPolicy | None
+        How requests and uploads that fail with transient errors (e.g.
+        connection resets or 503 responses) are retried (see
+        'xnatutils.retry'). Retried uploads only send the files that are
+        missing from the resource (or differ from the local files). Defaults
+        to RetryPolicy()
     """
-    # Set defaults for kwargs
-    # If a single directory is provided, upload all files in it that
-    # don't start with '.'
-    if len(filenames) == 1 and os.path.isdir(filenames[0]):
-        local_dir = filenames[0]
-    else:
-        local_dir = tempfile.mkdtemp()
-        if len(filenames) == 1 and isinstance(filenames[0], (list, tuple)):
-            filenames = filenames[0]
-        if not filenames:
-            raise XnatUtilsUsageError("No filenames provided to upload")
-        for fname in filenames:
-            if not os.path.exists(fname):
-                raise XnatUtilsUsageError(
-                    "The file to upload, '{}', does not exist".format(fname)
+    if incremental and not overwrite:
+        raise XnatUtilsUsageError(
+            "'incremental' option can only be used with 'overwrite'"
+        )
+    local_dir, filenames, resource_name = _prepare_upload(
+        session, scan, filenames, resource_name
+    )
+    digest_cache = DigestCache() if use_digest_cache else None
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    try:
+        with connect(**kwargs) as login:
+            resize_connection_pool(login, retry_policy=retry_policy)
+            session_cls, scan_cls = _session_classes(login, session, modality)
+            xsession = _get_session(
+                login, session, session_cls, create_session, project_id, subject_id
+            )
+            _upload_dataset(
+                login,
+                xsession,
+                scan,
+                filenames,
+                local_dir,
+                resource_name,
+                scan_cls,
+                scan_id=scan_id,
+                overwrite=overwrite,
+                incremental=incremental,
+                method=method,
+                digest_cache=digest_cache,
+                compress_jobs=compress_jobs,
+                retry_policy=retry_policy,
+            )
+    finally:
+        _cleanup_upload(local_dir, filenames)
+
+
+def put_many(
+    rows,
+    jobs=1,
+    overwrite=False,
+    create_session=False,
+    method="tgz_file",
+    use_digest_cache=True,
+    incremental=False,
+    compress_jobs=None,
+    retry_policy=None,
+    **kwargs,
+):
+    """
+    Uploads many datasets to an XNAT instance over a single connection, e.g.
+    the rows of a manifest file (see 'read_manifest').
+
+    Missing sessions (and subjects) are created once before any datasets are
+    uploaded, then the datasets are uploaded 'jobs' at a time. A failure to
+    upload a dataset doesn't stop the remaining datasets being uploaded, the
+    error is returned in the results for its row instead.
+
+    Parameters
+    ----------
+    rows : list(dict)
+        The datasets to upload. Each row requires 'session', 'scan' and
+        'files' (a list of files or a directory) items and can also provide
+        'resource_name', 'scan_id', 'project_id', 'subject_id' and 'modality'
+        items, which are used in the same way as the corresponding 'put'
+        arguments
+    jobs : int
+        The number of datasets to upload concurrently, 1 by default
+    overwrite : bool
+        Allow overwrite of existing datasets
+    create_session : bool
+        Create the sessions that don't exist on XNAT
+    method : str
+        The method used to upload the files (see 'put')
+    use_digest_cache : bool
+        Whether to reuse the digests of unmodified local files calculated by
+        previous uploads
+    incremental : bool
+        Only upload new or changed files when overwriting existing datasets
+        (see 'put')
+    compress_jobs : int | None
+        The number of threads used to compress each uploaded archive (see
+        'put')
+    retry_policy : RetryPolicy | None
+        How requests and uploads that fail with transient errors are retried
+        (see 'put'). Defaults to RetryPolicy()
+    **kwargs
+        Passed on to 'connect'
+
+    Returns
+    -------
+    list(tuple(dict, Exception | None))
+        The rows in the order they were provided, each paired with the error
+        that prevented it from being uploaded (None if it was uploaded)
+    """
+    if incremental and not overwrite:
+        raise XnatUtilsUsageError(
+            "'incremental' option can only be used with 'overwrite'"
+        )
+    rows = list(rows)
+    errors = {}
+    uploads = []
+    for i, row in enumerate(rows):
+        try:
+            uploads.append(
+                (i, row)
+                + _prepare_upload(
+                    row["session"], row["scan"], row["files"], row.get("resource_name")
                 )
-            local_dir_path = os.path.join(local_dir, os.path.basename(fname))
-            if os.path.exists(local_dir_path):
-                raise XnatUtilsUsageError(
-                    "Name clash between filename paths '{}'".format(
-                        os.path.basename(fname)
+            )
+        except (XnatUtilsUsageError, KeyError) as e:
+            errors[i] = e
+    digest_cache = DigestCache() if use_digest_cache else None
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    dataset_errors = item_errors()
+    try:
+        with connect(**kwargs) as login:
+            resize_connection_pool(login, jobs, retry_policy=retry_policy)
+            # Look up (and create if required) each session once, before starting
+            # the uploads so the same subject/session isn't created concurrently
+            sessions = {}
+            for i, row, _, _, _ in uploads:
+                key = (row["session"], row.get("modality"))
+                if key in sessions:
+                    continue
+                try:
+                    session_cls, scan_cls = _session_classes(
+                        login, row["session"], row.get("modality")
+                    )
+                    xsession = _get_session(
+                        login,
+                        row["session"],
+                        session_cls,
+                        create_session,
+                        row.get("project_id"),
+                        row.get("subject_id"),
+                    )
+                except dataset_errors as e:
+                    sessions[key] = e
+                else:
+                    sessions[key] = (xsession, scan_cls)
+
+            def upload(task):
+                _, row, local_dir, filenames, resource_name = task
+                session = sessions[(row["session"], row.get("modality"))]
+                if isinstance(session, Exception):
+                    return session
+                xsession, scan_cls = session
+                try:
+                    _upload_dataset(
+                        login,
+                        xsession,
+                        row["scan"],
+                        filenames,
+                        local_dir,
+                        resource_name,
+                        scan_cls,
+                        scan_id=row.get("scan_id"),
+                        overwrite=overwrite,
+                        incremental=incremental,
+                        method=method,
+                        digest_cache=digest_cache,
+                        compress_jobs=compress_jobs,
+                        retry_policy=retry_policy,
                     )
+                except dataset_errors as e:
+                    return e
+                return None
+
+            for (i, _, _, _, _), error in run_concurrently(upload, uploads, jobs=jobs):
+                if error is not None:
+                    errors[i] = error
+    finally:
+        for _, _, local_dir, filenames, _ in uploads:
+            _cleanup_upload(local_dir, filenames)
+    return [(row, errors.get(i)) for i, row in enumerate(rows)]
+
+
+def read_manifest(manifest_path):
+    """
+    Reads the datasets to upload from a CSV manifest file with 'session',
+    'scan' and 'files' columns and optional 'resource', 'scan_id',
+    'project_id', 'subject_id' and 'modality' columns. Multiple files are
+    separated by ';' in the 'files' column and relative paths are relative to
+    the directory containing the manifest.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to the manifest file
+
+    Returns
+    -------
+    list(dict)
+        The rows of the manifest in the form expected by 'put_many'
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    rows = []
+    with open(manifest_path, newline="") as f:
+        reader = csv.DictReader(f)
+        missing = {"session", "scan", "files"} - set(reader.fieldnames or ())
+        if missing:
+            raise XnatUtilsUsageError(
+                "Manifest '{}' is missing required column(s) '{}'".format(
+                    manifest_path, "', '".join(sorted(missing))
                 )
-            # Symlink file into local temp directory before uploading the
-            # whole directory (much faster for many files)
-            os.symlink(fname, local_dir_path)
+            )
+        for line in reader:
+            row = {
+                k: v.strip()
+                for k, v in line.items()
+                if k is not None and v is not None and v.strip()
+            }
+            row["files"] = [
+                os.path.join(base_dir, os.path.expanduser(f.strip()))
+                for f in row.get("files", "").split(";")
+                if f.strip()
+            ]
+            if "resource" in row:
+                row["resource_name"] = row.pop("resource")
+            rows.append(row)
+    return rows
+
+
+def _prepare_upload(session, scan, filenames, resource_name):
+    """
+    Checks the names of the session and scan to upload and collects the files
+    into a single directory to upload (if they aren't already)
+
+    Returns
+    -------
+    local_dir : str
+        The directory containing the files to upload
+    filenames : list(str)
+        The paths of the files (or directory) to upload
+    resource_name : str
+        The name of the resource to upload the files to
+    """
+    # If a single directory is provided, upload all files in it that
+    # don't start with '.'
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    elif len(filenames) == 1 and isinstance(filenames[0], (list, tuple)):
+        filenames = filenames[0]
+    if not filenames:
+        raise XnatUtilsUsageError("No filenames provided to upload")
     if sanitize_re.match(session):
         raise XnatUtilsUsageError(
             "Session '{}' is not a valid session name (must only contain "
@@ -151,7 +430,11 @@ def put(
         raise XnatUtilsUsageError(
             "Scan name '{}' contains illegal characters".format(scan)
         )
-
+    for fname in filenames:
+        if not os.path.exists(fname):
+            raise XnatUtilsUsageError(
+                "The file to upload, '{}', does not exist".format(fname)
+            )
     if resource_name is None:
         if len(filenames) == 1:
             resource_name = get_resource_name(filenames[0])
@@ -162,139 +445,481 @@ def put(
             )
     else:
         resource_name = resource_name.upper()
-    with connect(**kwargs) as login:
-        if modality is None:
-            match = session_modality_re.match(session)
-            if match is None:
-                modality = "MR"  # The default
-            else:
-                modality = match.group(1)
-        if modality == "MRPT":
-            session_cls = login.classes.PetmrSessionData
-            scan_cls = login.classes.MrScanData
-        elif modality == "SM":
-            session_cls = login.classes.SmSessionData
-            scan_cls = login.classes.SmScanData
-        elif modality == "MR":
-            # session_cls = getattr(login.classes,
-            #                       modality.capitalize() + 'SessionData')
-            # scan_cls = getattr(login.classes,
-            #                    modality.capitalize() + 'ScanData')
-            # # Other datatypes don't seem to be work by default
-            # try:
-            session_cls = login.classes.MrSessionData
-            # except AttributeError:
-            #     # Old name < 1.8
-            #     session_cls = login.classes.mrSessionData
-            # try:
-            scan_cls = login.classes.MrScanData
-            # except AttributeError:
-            #     # Old name < 1.8
-            #     scan_cls = login.classes.mrScanData
+    if len(filenames) == 1 and os.path.isdir(filenames[0]):
+        local_dir = filenames[0]
+    else:
+        local_dir = tempfile.mkdtemp()
+        for fname in filenames:
+            local_dir_path = os.path.join(local_dir, os.path.basename(fname))
+            if os.path.exists(local_dir_path):
+                shutil.rmtree(local_dir, ignore_errors=True)
+                raise XnatUtilsUsageError(
+                    "Name clash between filename paths '{}'".format(
+                        os.path.basename(fname)
+                    )
+                )
+            # Symlink file into local temp directory before uploading the
+            # whole directory (much faster for many files)
+            os.symlink(os.path.abspath(fname), local_dir_path)
+    return local_dir, list(filenames), resource_name
+
+
+def _cleanup_upload(local_dir, filenames):
+    """
+    Removes the temporary directory the files to upload were collected into
+    by '_prepare_upload' (if they weren't already in a single directory)
+    """
+    if local_dir not in filenames:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+
+def _session_classes(login, session, modality=None):
+    """
+    Returns the XnatPy classes of the session and scans for the modality of
+    the session (guessed from the session name if not provided)
+    """
+    if modality is None:
+        match = session_modality_re.match(session)
+        if match is None:
+            modality = "MR"  # The default
         else:
-            raise XnatUtilseUsageError(
-                "'modality' {} is not supported.".format(modality)
-            )
+            modality = match.group(1)
+    if modality == "MRPT":
+        session_cls = login.classes.PetmrSessionData
+        scan_cls = login.classes.MrScanData
+    elif modality == "SM":
+        session_cls = login.classes.SmSessionData
+        scan_cls = login.classes.SmScanData
+    elif modality == "MR":
+        # session_cls = getattr(login.classes,
+        #                       modality.capitalize() + 'SessionData')
+        # scan_cls = getattr(login.classes,
+        #                    modality.capitalize() + 'ScanData')
+        # # Other datatypes don't seem to be work by default
+        # try:
+        session_cls = login.classes.MrSessionData
+        # except AttributeError:
+        #     # Old name < 1.8
+        #     session_cls = login.classes.mrSessionData
+        # try:
+        scan_cls = login.classes.MrScanData
+        # except AttributeError:
+        #     # Old name < 1.8
+        #     scan_cls = login.classes.mrScanData
+    else:
+        raise XnatUtilsUsageError("'modality' {} is not supported.".format(modality))
+    return session_cls, scan_cls
 
-        try:
-            xsession = login.experiments[session]
-        except KeyError:
-            if create_session:
-                if project_id is None and subject_id is None:
-                    try:
-                        project_id, subject_id, _ = session.split("_")
-                    except ValueError:
-                        raise XnatUtilsUsageError(
-                            "Must explicitly provide project and subject IDs "
-                            "if session ID ({}) scheme doesn't match "
-                            "<project>_<subject>_<visit> convention, i.e. "
-                            "have exactly 2 underscores".format(session)
-                        )
-                if project_id is None:
-                    project_id = session.split("_")[0]
-                if subject_id is None:
-                    subject_id = "_".join(session.split("_")[:2])
+
+def _get_session(login, session, session_cls, create_session, project_id, subject_id):
+    """
+    Looks up the session to upload to, creating it (and its subject) if
+    requested
+    """
+    try:
+        xsession = login.experiments[session]
+    except KeyError:
+        if create_session:
+            if project_id is None and subject_id is None:
                 try:
-                    xproject = login.projects[project_id]
-                except KeyError:
+                    project_id, subject_id, _ = session.split("_")
+                except ValueError:
                     raise XnatUtilsUsageError(
-                        "Cannot create session '{}' as '{}' does not exist "
-                        "(or you don't have access to it)".format(session, project_id)
+                        "Must explicitly provide project and subject IDs "
+                        "if session ID ({}) scheme doesn't match "
+                        "<project>_<subject>_<visit> convention, i.e. "
+                        "have exactly 2 underscores".format(session)
                     )
-                # Creates a corresponding subject and session if they don't
-                # exist
-                xsubject = login.classes.SubjectData(label=subject_id, parent=xproject)
-                xsession = session_cls(label=session, parent=xsubject)
-                print("{} session successfully created.".format(xsession.label))
-            else:
-                raise XnatUtilsNoMatchingSessionsException(
-                    "'{}' session does not exist, to automatically create it "
-                    "please use '--create_session' option.".format(session)
-                )
-        xdataset = scan_cls(
-            id=(scan_id if scan_id is not None else scan), type=scan, parent=xsession
-        )
-        if overwrite:
+            if project_id is None:
+                project_id = session.split("_")[0]
+            if subject_id is None:
+                subject_id = "_".join(session.split("_")[:2])
             try:
-                xdataset.resources[resource_name].delete()
+                xproject = login.projects[project_id]
+            except KeyError:
+                raise XnatUtilsUsageError(
+                    "Cannot create session '{}' as '{}' does not exist "
+                    "(or you don't have access to it)".format(session, project_id)
+                )
+            # Creates a corresponding subject and session if they don't
+            # exist
+            xsubject = login.classes.SubjectData(label=subject_id, parent=xproject)
+            xsession = session_cls(label=session, parent=xsubject)
+            print("{} session successfully created.".format(xsession.label))
+        else:
+            raise XnatUtilsNoMatchingSessionsException(
+                "'{}' session does not exist, to automatically create it "
+                "please use '--create_session' option.".format(session)
+            )
+    return xsession
+
+
+def _upload_dataset(
+    login,
+    xsession,
+    scan,
+    filenames,
+    local_dir,
+    resource_name,
+    scan_cls,
+    scan_id=None,
+    overwrite=False,
+    incremental=False,
+    method="tgz_file",
+    digest_cache=None,
+    compress_jobs=None,
+    retry_policy=NO_RETRIES,
+):
+    """
+    Uploads the files of a dataset to a scan in an existing session and checks
+    their digests
+    """
+    session = xsession.label
+    xdataset = scan_cls(
+        id=(scan_id if scan_id is not None else scan), type=scan, parent=xsession
+    )
+    resource = None
+    if overwrite:
+        try:
+            existing = xdataset.resources[resource_name]
+        except KeyError:
+            pass
+        else:
+            if incremental:
+                resource = existing
+            else:
+                existing.delete()
                 print(
                     "Deleted existing resource at {}:{}/{}".format(
                         session, scan, resource_name
                     )
                 )
-            except KeyError:
-                pass
+    if resource is not None:
+        uploaded, deleted = retry_policy.call(
+            lambda: _upload_changes(resource, local_dir, digest_cache),
+            method="PUT",
+            url=resource.uri + "/files",
+        )
+        print(
+            "Uploaded {} new or changed file(s) to, and deleted {} file(s) "
+            "from, {}:{}/{}".format(
+                len(uploaded), len(deleted), session, scan, resource_name
+            )
+        )
+    else:
         resource = xdataset.create_resource(resource_name)
         # TODO: use folder upload where possible
-        resource.upload_dir(local_dir, method=method)
+        _upload_dir_with_retries(
+            resource,
+            local_dir,
+            method,
+            retry_policy,
+            compress_jobs=compress_jobs,
+            digest_cache=digest_cache,
+        )
         print(
             "Uploaded the following files to to {}:{}: {}".format(
                 filenames, session, scan
             )
         )
-        print("Uploaded files, checking digests...")
-        # Check uploaded files checksums
-        remote_digests = get_digests(resource)
-
-        def check_digest(fname):
-            remote_digest = remote_digests[os.path.basename(fname).replace(" ", "%20")]
-            local_digest = calculate_checksum(fname)
-            if local_digest != remote_digest:
-                raise XnatUtilsDigestCheckError(
-                    "Remote digest does not match local ({} vs {}) "
-                    "for {}. Please upload your datasets again".format(
-                        remote_digest, local_digest, fname
-                    )
+    print("Uploaded files, checking digests...")
+    # Check uploaded files checksums
+    remote_digests = retry_policy.call(
+        lambda: get_digests(resource), url=resource.uri + "/files"
+    )
+
+    def check_digest(fname):
+        remote_digest = remote_digests[os.path.basename(fname).replace(" ", "%20")]
+        local_digest = calculate_checksum(fname, cache=digest_cache)
+        if local_digest != remote_digest:
+            raise XnatUtilsDigestCheckError(
+                "Remote digest does not match local ({} vs {}) "
+                "for {}. Please upload your datasets again".format(
+                    remote_digest, local_digest, fname
                 )
-            # print(
-            #     f"Successfully checked digest for {session}:{scan}:{Path(fname).name}"
-            # )
+            )
+        # print(
+        #     f"Successfully checked digest for {session}:{scan}:{Path(fname).name}"
+        # )
 
-        for fname in filenames:
-            if Path(fname).is_dir():
-                for f in Path(fname).iterdir():
-                    if f.is_file():
-                        check_digest(f)
-            else:
-                check_digest(fname)
-        print(f"Successfully checked digest for {session}:{scan}")
+    for fname in filenames:
+        if Path(fname).is_dir():
+            for f in Path(fname).iterdir():
+                if f.is_file():
+                    check_digest(f)
+        else:
+            check_digest(fname)
+    print(f"Successfully checked digest for {session}:{scan}")
 
-        if resource_name == "DICOM":
-            print("pulling data from headers")
-            login.put(f"/data/experiments/{xsession.id}?pullDataFromHeaders=true")
+    if resource_name == "DICOM":
+        print("pulling data from headers")
+        login.put(f"/data/experiments/{xsession.id}?pullDataFromHeaders=true")
 
 
-def calculate_checksum(fname):
-    try:
-        file_hash = hashlib.md5()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
-                file_hash.update(chunk)
-        return file_hash.hexdigest()
-    except OSError:
-        raise XnatUtilsDigestCheckFailedError(
-            "Could not check digest of '{}' ".format(fname)
+def _upload_dir(resource, local_dir, method, compress_jobs=None):
+    """
+    Uploads the contents of a local directory to a resource using one of the
+    'upload_methods'. Gzipped archives are compressed using 'compress_jobs'
+    threads (see ParallelGzipCompressor)
+    """
+    if method in ("tar_stream", "tgz_stream"):
+        _upload_tar_stream(
+            resource,
+            local_dir,
+            compress=(method == "tgz_stream"),
+            compress_jobs=compress_jobs,
+        )
+    elif method in ("tgz_file", "tgz_memory", None):
+        if method == "tgz_memory":
+            archive = io.BytesIO()
+        else:
+            # Archives up to 256 MB are kept in memory (as in XnatPy)
+            archive = tempfile.SpooledTemporaryFile(max_size=268435456, mode="wb+")
+        with archive:
+            for chunk in _tar_stream(local_dir, compress_jobs=compress_jobs):
+                archive.write(chunk)
+            archive.seek(0)
+            resource.upload_data(archive, "upload.tar.gz", extract=True)
+    else:
+        resource.upload_dir(local_dir, method=method)
+
+
+def _upload_dir_with_retries(
+    resource, local_dir, method, retry_policy, compress_jobs=None, digest_cache=None
+):
+    """
+    Uploads the contents of a local directory to a new resource (see
+    '_upload_dir'). If the upload fails with a transient error, the retries
+    only upload the files that are missing from the resource or differ from
+    the local files (see '_upload_changes'), so the files that made it to the
+    server before the failure aren't sent again
+    """
+    attempts = itertools.count()
+
+    def upload():
+        if next(attempts):
+            _upload_changes(resource, local_dir, digest_cache)
+        else:
+            _upload_dir(resource, local_dir, method, compress_jobs=compress_jobs)
+
+    retry_policy.call(upload, method="PUT", url=resource.uri + "/files")
+
+
+def _upload_tar_stream(resource, local_dir, compress=True, compress_jobs=None):
+    """
+    Uploads the contents of a local directory to a resource as a tar(.gz)
+    archive that is generated while it is sent (as a chunked request body), so
+    the archive is never stored on disk or in memory. The archive is
+    extracted by XNAT on arrival
+    """
+    login = resource.xnat_session
+    remote_name = "upload.tar.gz" if compress else "upload.tar"
+    response = login.interface.put(
+        resource.external_uri() + "/files/" + remote_name,
+        params={"extract": "true"},
+        data=_tar_stream(local_dir, compress=compress, compress_jobs=compress_jobs),
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    if not 200 <= response.status_code < 300:
+        raise xnat.exceptions.XNATResponseError(
+            "Invalid status for response from XNATSession for url {} "
+            "(status {}):\n{}".format(response.url, response.status_code, response.text),
+            response=response,
         )
+    resource.files.clearcache()
+
+
+def _tar_stream(
+    local_dir, compress=True, chunk_size=UPLOAD_CHUNK_SIZE, compress_jobs=None
+):
+    """
+    Generates a tar archive of the files in a local directory (following
+    symlinks), reading the files in chunks as the archive is consumed
+
+    Parameters
+    ----------
+    local_dir : str
+        The directory to archive
+    compress : bool
+        Whether to gzip the archive
+    chunk_size : int
+        The size of the chunks the files are read in
+    compress_jobs : int | None
+        The number of threads to compress the archive with (see
+        ParallelGzipCompressor), the number of CPU cores by default
+
+    Yields
+    ------
+    bytes
+        The next (non-empty) chunk of the archive
+    """
+    compressor = ParallelGzipCompressor(compress_jobs) if compress else None
+    for data in _tar_blocks(local_dir, chunk_size):
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class ParallelGzipCompressor(object):
+    """
+    Compresses data into a gzip stream using several threads (in the style of
+    pigz), with the same interface as the objects returned by
+    zlib.compressobj.
+
+    The data is split into blocks that are compressed concurrently into
+    separate gzip members, which are concatenated in order. A multi-member
+    gzip stream is still a standard gzip stream (RFC 1952) that gzip, tarfile
+    and XNAT's extractor decompress as a whole. The output is slightly larger
+    than single-member output, as each block is compressed independently.
+
+    Parameters
+    ----------
+    jobs : int | None
+        The number of compression threads, the number of CPU cores by default.
+        A single standard gzip member is produced if 1
+    block_size : int
+        The size of the blocks compressed into each member
+    level : int
+        The compression level (as for zlib)
+    """
+
+    def __init__(self, jobs=None, block_size=GZIP_BLOCK_SIZE, level=6):
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        self.jobs = jobs
+        self.block_size = block_size
+        self.level = level
+        self._buffer = bytearray()
+        self._pending = deque()
+        if jobs > 1:
+            self._executor = ThreadPoolExecutor(max_workers=jobs)
+        else:
+            self._executor = None
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """
+        Adds data to the stream, returning the compressed data that is ready
+        (which may be empty)
+        """
+        if self._executor is None:
+            return self._compressor.compress(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        # Keep a bounded number of blocks in flight
+        ready = []
+        while len(self._pending) > 2 * self.jobs or (
+            self._pending and self._pending[0].done()
+        ):
+            ready.append(self._pending.popleft().result())
+        return b"".join(ready)
+
+    def flush(self):
+        """
+        Finishes the stream, returning the remaining compressed data
+        """
+        if self._executor is None:
+            return self._compressor.flush()
+        if self._buffer or not self._pending:
+            self._submit(bytes(self._buffer))
+            del self._buffer[:]
+        data = b"".join(f.result() for f in self._pending)
+        self._pending.clear()
+        self._executor.shutdown()
+        return data
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(_gzip_member, block, self.level))
+
+
+def _gzip_member(data, level):
+    # zlib releases the GIL while compressing, so members are compressed in
+    # parallel by the pool threads
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _tar_blocks(local_dir, chunk_size):
+    written = 0
+    for rel_path, path in sorted(_local_files(local_dir).items()):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            info = tarfile.TarInfo(rel_path)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = stat.st_mode & 0o7777
+            header = info.tobuf(tarfile.PAX_FORMAT)
+            yield header
+            remaining = info.size
+            while remaining:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise XnatUtilsError(
+                        "'{}' was truncated while it was being uploaded".format(path)
+                    )
+                remaining -= len(chunk)
+                yield chunk
+            padding = -info.size % tarfile.BLOCKSIZE
+            yield b"\0" * padding
+            written += len(header) + info.size + padding
+    # End of archive marker (two empty blocks), padded to a whole record
+    end = 2 * tarfile.BLOCKSIZE
+    yield b"\0" * (end + -(written + end) % tarfile.RECORDSIZE)
+
+
+def _local_files(local_dir):
+    """
+    Returns the files within a local directory (following symlinks) keyed by
+    their path relative to it, in posix format
+    """
+    local_files = {}
+    for dpath, _, fnames in os.walk(local_dir, followlinks=True):
+        for fname in fnames:
+            path = Path(dpath) / fname
+            local_files[path.relative_to(local_dir).as_posix()] = path
+    return local_files
+
+
+def _upload_changes(resource, local_dir, digest_cache=None):
+    """
+    Uploads the files in a local directory that aren't in an existing
+    resource or differ from the remote versions (by size or digest), and
+    deletes the remote files that aren't present locally
+
+    Returns
+    -------
+    uploaded : list(str)
+        The relative paths of the uploaded files
+    deleted : list(str)
+        The relative paths of the deleted remote files
+    """
+    remote_files = {unquote(f.path): f for f in list_resource_files(resource)}
+    local_files = _local_files(local_dir)
+    uploaded = []
+    for rel_path, path in sorted(local_files.items()):
+        remote_file = remote_files.get(rel_path)
+        if (
+            remote_file is not None
+            and remote_file.digest is not None
+            and (remote_file.size is None or remote_file.size == path.stat().st_size)
+            and calculate_checksum(path, cache=digest_cache) == remote_file.digest
+        ):
+            continue
+        resource.upload(path, rel_path, overwrite=True)
+        uploaded.append(rel_path)
+    deleted = []
+    for rel_path, remote_file in sorted(remote_files.items()):
+        if rel_path not in local_files:
+            resource.xnat_session.delete(
+                "{}/files/{}".format(resource.uri, remote_file.path)
+            )
+            deleted.append(rel_path)
+    return uploaded, deleted
 
 
 def get_digests(resource):
@@ -326,6 +951,13 @@ created if they are not already present, e.g.
 NB: If the scan already exists the '--overwrite' option must be provided to
 overwrite it.
 
+Many datasets can be uploaded over a single connection by listing them in a CSV
+manifest file with 'session', 'scan' and 'files' (separated by ';') columns and
+optional 'resource', 'scan_id', 'project_id', 'subject_id' and 'modality'
+columns, e.g.
+
+    $ xnat-put --manifest uploads.csv --create_session --jobs 4
+
 User credentials can be stored in a ~/.netrc file so that they don't need to be
 entered each time a command is run. If a new user provided or netrc doesn't
 exist the tool will ask whether to create a ~/.netrc file with the given
@@ -336,15 +968,39 @@ credentials.
 def parser():
     parser = base_parser(description)
     parser.add_argument(
-        "session", type=str, help="Name of the session to upload the dataset to"
+        "session",
+        type=str,
+        nargs="?",
+        help="Name of the session to upload the dataset to",
+    )
+    parser.add_argument(
+        "scan", type=str, nargs="?", help="Name for the dataset on XNAT"
     )
-    parser.add_argument("scan", type=str, help="Name for the dataset on XNAT")
     parser.add_argument(
         "filenames",
         type=str,
-        nargs="+",
+        nargs="*",
         help="Filename(s) of the dataset to upload to XNAT",
     )
+    parser.add_argument(
+        "--manifest",
+        "-m",
+        type=str,
+        default=None,
+        help=(
+            "A CSV file listing the datasets to upload (instead of providing "
+            "the session, scan and filenames arguments), with 'session', "
+            "'scan' and 'files' columns and optional 'resource', 'scan_id', "
+            "'project_id', 'subject_id' and 'modality' columns"
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        "-J",
+        type=int,
+        default=1,
+        help="The number of datasets in the manifest to upload concurrently",
+    )
     parser.add_argument(
         "--overwrite",
         "-o",
@@ -384,16 +1040,48 @@ def parser():
     parser.add_argument(
         "--method",
         type=str,
+        choices=upload_methods,
         help=(
-            "the method used to download the files from XNAT. Can be one of"
-            '["per_file", "tar_memory", "tgz_memory", "tar_file", "tgz_file"],'
-            '"tgz_file" by default.",'
+            "the method used to upload the files to XNAT, 'tgz_file' by "
+            "default. The '_stream' methods generate the archive while it is "
+            "being uploaded instead of writing it to a temporary file or "
+            "memory first"
+        ),
+    )
+    parser.add_argument(
+        "--compress_jobs",
+        type=int,
+        default=None,
+        help=(
+            "The number of threads used to compress the uploaded archive with "
+            "the 'tgz_' methods. Defaults to the number of CPU cores"
         ),
     )
     parser.add_argument(
         "--modality", type=str, default=None, choices=["MR", "MRPT", "SM"],
         help="Supported modality types, including 'MR', 'MRPT', 'SM'"
     )
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        action="store_true",
+        default=False,
+        help=(
+            "When overwriting an existing dataset (see '--overwrite'), only "
+            "upload new or changed files and delete remote files that don't "
+            "exist locally instead of replacing the whole dataset"
+        ),
+    )
+    parser.add_argument(
+        "--no_digest_cache",
+        action="store_true",
+        default=False,
+        help=(
+            "Always calculate the digests of the uploaded files instead of "
+            "reusing the digests of unmodified files from previous uploads"
+        ),
+    )
+    add_retry_args(parser)
     add_default_args(parser)
     return parser
 
@@ -403,27 +1091,77 @@ def cmd(argv=sys.argv[1:]):
     args = parser().parse_args(argv)
 
     set_logger(args.loglevel)
+    metrics = start_metrics(args.metrics_out)
 
     try:
-        put(
-            args.session,
-            args.scan,
-            *args.filenames,
-            overwrite=args.overwrite,
-            create_session=args.create_session,
-            resource_name=args.resource_name,
-            project_id=args.project_id,
-            subject_id=args.subject_id,
-            scan_id=args.scan_id,
-            modality=args.modality,
-            user=args.user,
-            server=args.server,
-            method=args.method,
-            use_netrc=(not args.no_netrc),
-        )
+        if args.manifest is not None:
+            if args.session is not None:
+                raise XnatUtilsUsageError(
+                    "Session, scan and filenames cannot be provided with "
+                    "'--manifest'"
+                )
+            results = put_many(
+                read_manifest(args.manifest),
+                jobs=args.jobs,
+                overwrite=args.overwrite,
+                create_session=args.create_session,
+                user=args.user,
+                server=args.server,
+                method=args.method,
+                use_digest_cache=(not args.no_digest_cache),
+                incremental=args.incremental,
+                compress_jobs=args.compress_jobs,
+                retry_policy=retry_policy_from_args(args),
+                use_netrc=(not args.no_netrc),
+            )
+            for row, error in results:
+                print(
+                    "{:<7} {}:{}{}".format(
+                        "FAILED" if error is not None else "OK",
+                        row.get("session"),
+                        row.get("scan"),
+                        " ({})".format(error) if error is not None else "",
+                    )
+                )
+            num_failed = sum(1 for _, e in results if e is not None)
+            print(
+                "Uploaded {} of {} datasets".format(
+                    len(results) - num_failed, len(results)
+                )
+            )
+            if num_failed:
+                sys.exit(1)
+        else:
+            if not args.filenames:
+                raise XnatUtilsUsageError(
+                    "Session, scan and filenames (or '--manifest') need to be "
+                    "provided"
+                )
+            put(
+                args.session,
+                args.scan,
+                *args.filenames,
+                overwrite=args.overwrite,
+                create_session=args.create_session,
+                resource_name=args.resource_name,
+                project_id=args.project_id,
+                subject_id=args.subject_id,
+                scan_id=args.scan_id,
+                modality=args.modality,
+                user=args.user,
+                server=args.server,
+                method=args.method,
+                use_digest_cache=(not args.no_digest_cache),
+                incremental=args.incremental,
+                compress_jobs=args.compress_jobs,
+                retry_policy=retry_policy_from_args(args),
+                use_netrc=(not args.no_netrc),
+            )
     except XnatUtilsUsageError as e:
         print_usage_error(e)
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    finally:
+        stop_metrics(metrics, args.metrics_out, args.metrics_format)
@@ -1,9 +1,12 @@
 import sys
+import csv
+from collections import defaultdict
 from .base import (print_response_error, print_usage_error, connect,
                    print_info_message, base_parser, add_default_args,
-                   set_logger)
+                   set_logger, list_rows, sanitize_re, resize_connection_pool,
+                   run_concurrently, item_errors, xnat)
 from xnatutils.exceptions import XnatUtilsUsageError, XnatUtilsException
-from xnat.exceptions import XNATResponseError
+from .metrics import start_metrics, stop_metrics
 
 
 def rename(session_name, new_session_name, **kwargs):
@@ -51,20 +54,157 @@ def rename(session_name, new_session_name, **kwargs):
                                                      new_session_name))
 
 
+def rename_many(mapping, jobs=1, project_id=None, dry_run=False, **kwargs):
+    """
+    Renames many sessions at once. The sessions to rename are looked up with
+    a single listing request per project and all new names are checked
+    before any session is renamed, so that a mistake in the mapping doesn't
+    leave the study half-renamed.
+
+        >>> xnatutils.rename_many({'MMA003_001_MR01': 'MMA003_001_MRPT01',
+        ...                        'MMA003_002_MR01': 'MMA003_002_MRPT01'})
+
+    Parameters
+    ----------
+    mapping : dict(str, str) | list(tuple(str, str))
+        The current names of the sessions mapped to their new names
+    jobs : int
+        The number of sessions to rename concurrently
+    project_id : str | None
+        The project the sessions belong to. If not provided it is taken from
+        the session names, which need to start with the project ID followed
+        by an underscore
+    dry_run : bool
+        Only check the mapping and look up the sessions, without renaming
+        them
+    **kwargs
+        Passed on to 'connect'
+
+    Returns
+    -------
+    list(tuple(str, str, str, Exception | None))
+        The current name, new name and ID of each session, in the order
+        provided, along with the error that prevented it from being renamed
+        (None if it was renamed, or would be in a dry run)
+    """
+    pairs = list(mapping.items() if isinstance(mapping, dict) else mapping)
+    problems = []
+    by_project = defaultdict(list)
+    for old, new in pairs:
+        if sanitize_re.search(new):
+            problems.append(
+                "'{}' is not a valid session name (must only contain "
+                "alpha-numeric characters and underscores)".format(new))
+        if project_id is not None:
+            by_project[project_id].append((old, new))
+        elif '_' in old:
+            by_project[old.split('_')[0]].append((old, new))
+        else:
+            problems.append(
+                "Cannot determine the project of '{}', please provide the "
+                "project ID".format(old))
+    for names, desc in (([o for o, _ in pairs], 'renamed'),
+                        ([n for _, n in pairs], 'used as a new name')):
+        problems.extend(
+            "'{}' is {} more than once".format(n, desc)
+            for n in sorted(set(n for n in names if names.count(n) > 1)))
+    if problems:
+        raise XnatUtilsUsageError(
+            "Invalid mapping:\n    " + "\n    ".join(problems))
+    session_ids = {}
+    # The classes of the data model are only built if they are needed
+    kwargs.setdefault('lazy_model', True)
+    with connect(**kwargs) as login:
+        for project, project_pairs in by_project.items():
+            rows = list_rows(
+                login, '/data/projects/{}/experiments'.format(project),
+                {'columns': 'ID,label'})
+            by_label = {r['label']: r['ID'] for r in rows}
+            for old, new in project_pairs:
+                if old in by_label:
+                    session_ids[old] = by_label[old]
+                else:
+                    problems.append(
+                        "No session named '{}' in project '{}'".format(
+                            old, project))
+                if new in by_label:
+                    problems.append(
+                        "Cannot rename '{}' to '{}' as there is already a "
+                        "session with that name in project '{}'".format(
+                            old, new, project))
+        if problems:
+            raise XnatUtilsUsageError(
+                "Cannot rename sessions:\n    " + "\n    ".join(problems))
+        if dry_run:
+            return [(old, new, session_ids[old], None) for old, new in pairs]
+
+        def relabel(pair):
+            old, new = pair
+            try:
+                login.put('/data/experiments/{}?label={}'.format(
+                    session_ids[old], new))
+            except item_errors() as e:
+                return e
+            return None
+
+        resize_connection_pool(login, jobs)
+        errors = dict(run_concurrently(relabel, pairs, jobs=jobs))
+    return [(old, new, session_ids[old], errors[(old, new)])
+            for old, new in pairs]
+
+
+def read_mapping(path):
+    """
+    Reads the current and new names of the sessions to rename from a CSV file
+    with two columns, the current name followed by the new name. A header row
+    of 'old,new' is skipped.
+    """
+    with open(path, newline='') as f:
+        rows = [[c.strip() for c in r] for r in csv.reader(f)
+                if any(c.strip() for c in r)]
+    if rows and [c.lower() for c in rows[0][:2]] == ['old', 'new']:
+        rows = rows[1:]
+    for i, row in enumerate(rows):
+        if len(row) != 2 or not all(row):
+            raise XnatUtilsUsageError(
+                "Line {} of '{}' doesn't contain a current and new session "
+                "name".format(i + 1, path))
+    return [tuple(r) for r in rows]
+
+
 description = """
 Renames a session from the command line (if there has been a mistake in its
 name for example).
 
     $ xnat-rename MMA003_001_MR01 MMA003_001_MRPT01
+
+Many sessions can be renamed at once by providing a CSV file containing the
+current names of the sessions in the first column and their new names in the
+second, e.g.
+
+    $ xnat-rename --mapping old_new.csv --dry_run
+
+All new names are checked for clashes with existing sessions before any of the
+sessions are renamed.
 """
 
 
 def parser():
     parser = base_parser(description)
-    parser.add_argument('session_name', type=str,
+    parser.add_argument('session_name', type=str, nargs='?',
                         help=("Name of the session to rename"))
-    parser.add_argument('new_session_name', type=str,
+    parser.add_argument('new_session_name', type=str, nargs='?',
                         help=("The new name of the session"))
+    parser.add_argument('--mapping', '-m', type=str, default=None,
+                        help=("CSV file mapping the current names of the "
+                              "sessions to rename to their new names"))
+    parser.add_argument('--project', '-p', type=str, default=None,
+                        help="The project the sessions belong to")
+    parser.add_argument('--jobs', '-J', type=int, default=1,
+                        help="The number of sessions to rename concurrently")
+    parser.add_argument('--dry_run', action='store_true', default=False,
+                        help=("Check the mapping and report the sessions "
+                              "that would be renamed without renaming them"))
     add_default_args(parser)
     return parser
 
@@ -74,14 +214,42 @@ def cmd(argv=sys.argv[1:]):
     args = parser().parse_args(argv)
 
     set_logger(args.loglevel)
+    metrics = start_metrics(args.metrics_out)
 
     try:
-        rename(args.session_name, args.new_session_name,
-               user=args.user, server=args.server,
-               use_netrc=(not args.no_netrc))
+        if args.mapping is not None:
+            results = rename_many(
+                read_mapping(args.mapping), jobs=args.jobs,
+                project_id=args.project, dry_run=args.dry_run,
+                user=args.user, server=args.server,
+                use_netrc=(not args.no_netrc))
+            failed = 0
+            for old, new, session_id, error in results:
+                if error is not None:
+                    failed += 1
+                    print("Could not rename '{}' to '{}': {}".format(
+                        old, new, error), file=sys.stderr)
+                elif args.dry_run:
+                    print("Would rename '{}' ({}) to '{}'".format(
+                        old, session_id, new))
+            print("{} {} of {} session(s)".format(
+                'Would rename' if args.dry_run else 'Renamed',
+                len(results) - failed, len(results)))
+            if failed:
+                sys.exit(1)
+        elif args.new_session_name is None:
+            raise XnatUtilsUsageError(
+                "A session name and new name (or '--mapping') need to be "
+                "provided")
+        else:
+            rename(args.session_name, args.new_session_name,
+                   user=args.user, server=args.server,
+                   use_netrc=(not args.no_netrc))
     except XnatUtilsUsageError as e:
         print_usage_error(e)
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    finally:
+        stop_metrics(metrics, args.metrics_out, args.metrics_format)
@@ -0,0 +1,314 @@
+import re
+import time
+import random
+import logging
+import threading
+import functools
+from .base import requests, xnat, _response_status
+from .exceptions import XnatUtilsUsageError
+from . import metrics as _metrics
+
+logger = logging.getLogger("xnat-utils")
+
+DEFAULT_RETRY_ATTEMPTS = 5
+DEFAULT_RETRY_BACKOFF = 1.0
+DEFAULT_RETRY_STATUSES = (502, 503, 504)
+
+# Methods that are resent by the connection pool when the server responds
+# with one of the retryable statuses. PUT is left to the callers (see
+# 'RetryPolicy.call') as the body may be a stream that can't be sent again
+# (e.g. a tar archive generated while it is uploaded)
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+upload_status_re = re.compile(r"Status code (\d+)")
+
+# Tracks whether the current thread is running an operation that is retried
+# by 'RetryPolicy.call', in which case the connection pool doesn't also retry
+# its requests
+_operations = threading.local()
+
+
+class RetryPolicy(object):
+    """
+    How requests to the server that fail with transient errors (connection
+    resets or the server responding with one of the 'statuses') are retried.
+
+    The policy is applied at two levels: to whole operations, such as
+    downloading or uploading a file, by 'call', and to the other requests made
+    with an idempotent method (e.g. listings) by the connection pool (see
+    'resize_connection_pool'). Requests made within an operation aren't also
+    retried by the connection pool, so each request is sent at most
+    'attempts' times and every failed attempt counts towards the circuit
+    breaker. Failed operations are retried after a random delay of up to
+    'backoff' secs, which doubles with each retry ("full jitter"), so workers
+    that failed at the same time don't all retry together.
+
+    The workers sharing a policy (e.g. the download workers of a 'get' run)
+    also share a circuit breaker, which pauses all of them when the server
+    appears to be overloaded (see CircuitBreaker)
+
+    Parameters
+    ----------
+    attempts : int
+        The maximum number of attempts at each request/operation, 1 to
+        disable retries
+    backoff : float
+        The maximum delay before the first retry (secs)
+    max_backoff : float
+        The maximum delay before any retry (secs)
+    statuses : tuple(int)
+        The HTTP statuses of responses that are retried
+    breaker_threshold : int | None
+        The number of consecutive failed attempts (by any of the workers)
+        after which all workers are paused, None to never pause them
+    breaker_cooldown : float
+        The number of secs the workers are paused for
+    """
+
+    def __init__(
+        self,
+        attempts=DEFAULT_RETRY_ATTEMPTS,
+        backoff=DEFAULT_RETRY_BACKOFF,
+        max_backoff=60.0,
+        statuses=DEFAULT_RETRY_STATUSES,
+        breaker_threshold=5,
+        breaker_cooldown=30.0,
+    ):
+        if attempts < 1:
+            raise XnatUtilsUsageError(
+                "The number of attempts needs to be at least 1 ({} provided)".format(
+                    attempts
+                )
+            )
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = tuple(statuses)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+
+    def is_retryable(self, error):
+        "Whether the error raised by an attempt is transient"
+        if isinstance(error, xnat.exceptions.XNATResponseError):
+            status = getattr(error, "status_code", None)
+            if status is None:
+                status = _response_status(error)
+            return status in self.statuses
+        if isinstance(error, xnat.exceptions.XNATUploadError):
+            # Raised by XnatPy's uploads, which only include the status in the
+            # message
+            match = upload_status_re.search(str(error))
+            return match is not None and int(match.group(1)) in self.statuses
+        return isinstance(
+            error,
+            (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                ConnectionError,
+            ),
+        )
+
+    def delay(self, retry):
+        "The delay before the given retry (counting from 0)"
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**retry))
+
+    def call(self, func, method="GET", url=None):
+        """
+        Calls a function, calling it again if it fails with a transient error
+        until it succeeds or the maximum number of attempts is reached (in
+        which case the last error is raised)
+
+        Parameters
+        ----------
+        func : callable
+            The function to call (without arguments). Needs to be safe to call
+            again after a failed attempt
+        method : str
+            The HTTP method of the operation, for the logs and metrics
+        url : str | None
+            The URL (or REST path) of the operation, for the logs and metrics
+
+        Returns
+        -------
+        object
+            The return value of the successful call
+        """
+        for attempt in range(1, self.attempts + 1):
+            self.breaker.wait()
+            _operations.depth = getattr(_operations, "depth", 0) + 1
+            try:
+                result = func()
+            except Exception as e:  # pylint: disable=broad-except
+                if not self.is_retryable(e):
+                    raise
+                self.breaker.failure()
+                if attempt == self.attempts:
+                    raise
+                delay = self.delay(attempt - 1)
+                logger.warning(
+                    "%s %s failed (%s), retrying in %.1f secs (attempt %s of %s)",
+                    method,
+                    url,
+                    e,
+                    delay,
+                    attempt + 1,
+                    self.attempts,
+                )
+                if url is not None:
+                    _metrics.record_retry(method, url)
+                time.sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+            finally:
+                _operations.depth -= 1
+
+    def urllib3_retry(self):
+        """
+        Returns the equivalent urllib3 retry configuration for the connection
+        pool, which retries requests made with idempotent methods and
+        connections that fail before the request is sent, unless they are made
+        within an operation retried by 'call'
+        """
+        retry_kwargs = {
+            "total": self.attempts - 1,
+            "allowed_methods": IDEMPOTENT_METHODS,
+            "status_forcelist": self.statuses,
+            "backoff_factor": self.backoff / 2,
+            # Return the last response instead of raising, so the error is
+            # reported by XnatPy as usual
+            "raise_on_status": False,
+        }
+        Retry = _pool_retry_class()
+        try:
+            return Retry(
+                backoff_max=self.max_backoff,
+                backoff_jitter=self.backoff,
+                **retry_kwargs,
+            )
+        except TypeError:  # urllib3 < 2.0
+            return Retry(**retry_kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _pool_retry_class():
+    # Defined on first use so urllib3 isn't imported until it is needed
+    class PoolRetry(requests.adapters.Retry):
+        def is_retry(self, method, status_code, has_retry_after=False):
+            if getattr(_operations, "depth", 0):
+                return False
+            return super().is_retry(method, status_code, has_retry_after)
+
+        def is_exhausted(self):
+            return bool(getattr(_operations, "depth", 0)) or super().is_exhausted()
+
+    return PoolRetry
+
+
+class CircuitBreaker(object):
+    """
+    Pauses all the workers that share it once 'threshold' consecutive
+    attempts have failed with transient errors, i.e. when the server appears
+    to be overloaded, to give it 'cooldown' secs to recover instead of
+    retrying against it. If the next attempt after a pause also fails the
+    workers are paused again, for twice as long each time (up to
+    'max_cooldown'), until an attempt succeeds
+
+    Parameters
+    ----------
+    threshold : int | None
+        The number of consecutive failures that pause the workers, None to
+        never pause them
+    cooldown : float
+        The number of secs the workers are first paused for
+    max_cooldown : float
+        The maximum number of secs the workers are paused for
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0, max_cooldown=300.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._failures = 0
+        self._next_cooldown = cooldown
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def paused(self):
+        return time.monotonic() < self._paused_until
+
+    def wait(self):
+        "Blocks while the workers are paused"
+        while True:
+            with self._lock:
+                remaining = self._paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._next_cooldown = self.cooldown
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            now = time.monotonic()
+            # Failures of attempts that were in progress when the workers were
+            # paused don't extend the pause
+            if (
+                self.threshold is None
+                or self._failures < self.threshold
+                or now < self._paused_until
+            ):
+                return
+            cooldown = self._next_cooldown
+            self._paused_until = now + cooldown
+            self._next_cooldown = min(cooldown * 2, self.max_cooldown)
+        logger.warning(
+            "%s consecutive attempts failed, the server appears to be overloaded "
+            "so pausing all workers for %.0f secs",
+            self._failures,
+            cooldown,
+        )
+
+
+# Used by the internal functions when a policy isn't provided
+NO_RETRIES = RetryPolicy(attempts=1, breaker_threshold=None)
+
+
+def add_retry_args(parser):
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRY_ATTEMPTS,
+        help=(
+            "The maximum number of attempts at each request and file transfer "
+            "that fails with a transient error (e.g. a connection reset or a "
+            "502, 503 or 504 response), 1 to disable retries (default "
+            "%(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--retry_backoff",
+        type=float,
+        default=DEFAULT_RETRY_BACKOFF,
+        help=(
+            "The maximum delay before the first retry (secs), doubled for each "
+            "subsequent retry (default %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--retry_statuses",
+        type=int,
+        nargs="+",
+        default=DEFAULT_RETRY_STATUSES,
+        help="The HTTP statuses that are retried (default %(default)s)",
+    )
+
+
+def retry_policy_from_args(args):
+    return RetryPolicy(
+        attempts=args.retries, backoff=args.retry_backoff, statuses=args.retry_statuses
+    )
@@ -1,9 +1,17 @@
 import sys
+import csv
+import json
+from collections import defaultdict
+from operator import itemgetter
 from .base import (connect, print_response_error, print_usage_error,
                    print_info_message, set_logger, base_parser,
-                   add_default_args)
-from xnatutils.exceptions import XnatUtilsUsageError, XnatUtilsException
-from xnat.exceptions import XNATResponseError
+                   add_default_args, is_regex, literal_prefix, list_rows,
+                   LabelMatcher, xnat)
+from .metrics import start_metrics, stop_metrics
+from xnatutils.exceptions import (
+    XnatUtilsUsageError, XnatUtilsException, XnatUtilsKeyError)
+
+output_formats = ('csv', 'json')
 
 
 def varget(subject_or_session_id, variable, default='', **kwargs):
@@ -63,10 +71,190 @@ def varget(subject_or_session_id, variable, default='', **kwargs):
             return default
 
 
+def varget_many(ids, variables, datatype=None, project_id=None, default='',
+                **kwargs):
+    """
+    Gets the values of several custom variables of many sessions or subjects
+    in an XNAT instance. The values of all matching sessions/subjects in a
+    project are retrieved in a single request.
+
+    Parameters
+    ----------
+    ids : str | list(str)
+        Names (labels or IDs) or regular expressions matching the labels of
+        the subjects or sessions to get the variables of
+    variables : str | list(str)
+        Names of the variables to get
+    datatype : str | None
+        Whether the IDs are of 'subject's or 'session's. If not provided it
+        is guessed from the number of underscores in the IDs (one for
+        subjects and two for sessions)
+    project_id : str | None
+        The project the subjects/sessions belong to. If not provided it is
+        taken from the IDs, which need to start with the project ID followed
+        by an underscore
+    default : str
+        Default value for objects that don't have a value for a variable
+    **kwargs
+        Passed on to 'connect'
+
+    Returns
+    -------
+    list(dict)
+        The label of each matching subject/session ('label') and the values
+        of the variables, sorted by label
+    """
+    if isinstance(ids, str):
+        ids = [ids]
+    if isinstance(variables, str):
+        variables = [variables]
+    if not ids or not variables:
+        raise XnatUtilsUsageError(
+            "At least one ID and one variable need to be provided")
+    if datatype is None:
+        datatype = _guess_datatype(ids)
+    results = []
+    # The classes of the data model are only built if they are needed
+    kwargs.setdefault('lazy_model', True)
+    with connect(**kwargs) as login:
+        for _, row, values in _variable_values(
+                login, _by_project(ids, project_id), datatype, variables):
+            result = {'label': row['label']}
+            for variable in variables:
+                result[variable] = values[variable] or default
+            results.append(result)
+    return sorted(results, key=itemgetter('label'))
+
+
+def _guess_datatype(ids):
+    """
+    Guesses whether the IDs are of subjects or sessions from the number of
+    underscores in them (one for subjects and two for sessions)
+    """
+    num_underscores = set(min(i.count('_'), 2) for i in ids)
+    if num_underscores == {1}:
+        return 'subject'
+    elif num_underscores == {2}:
+        return 'session'
+    raise XnatUtilsUsageError(
+        "Could not determine whether IDs '{}' are subjects or sessions (must "
+        "contain one underscore for subjects and two underscores for "
+        "sessions), please provide the datatype".format("', '".join(ids)))
+
+
+def _by_project(ids, project_id=None, literal=False):
+    """
+    Groups the IDs (or regular expressions unless 'literal' is set) by the
+    project they belong to, which is taken from the start of the IDs if
+    'project_id' isn't provided
+    """
+    by_project = defaultdict(list)
+    for id_ in ids:
+        if project_id is not None:
+            by_project[project_id].append(id_)
+            continue
+        prefix = (literal_prefix(id_) if is_regex(id_) and not literal
+                  else id_)
+        if '_' not in prefix:
+            raise XnatUtilsUsageError(
+                "Cannot determine the project of '{}', please provide the "
+                "project ID".format(id_))
+        by_project[prefix.split('_')[0]].append(id_)
+    return by_project
+
+
+def _variable_values(login, by_project, datatype, variables, literal=False):
+    """
+    Looks up the subjects/sessions matching the IDs in each project, along
+    with the current values of the variables, using a single columnar
+    listing request per project. IDs that look like regular expressions are
+    matched as patterns unless 'literal' is set
+
+    Yields
+    ------
+    path : str
+        The REST path of the subject/session listing of the project
+    row : dict
+        The listing row of the subject/session (includes 'ID', 'label' and
+        'xsiType' for sessions)
+    values : dict
+        The current value of each variable ('' if not set)
+    """
+    if datatype == 'subject':
+        xsi_type, listing, columns = 'xnat:subjectData', 'subjects', []
+    elif datatype == 'session':
+        xsi_type, listing = 'xnat:experimentData', 'experiments'
+        columns = ['xsiType']
+    else:
+        raise XnatUtilsUsageError(
+            "Unrecognised datatype '{}', can be 'subject' or 'session'"
+            .format(datatype))
+    field_columns = ['{}/fields/field[name={}]/field'.format(xsi_type, v)
+                     for v in variables]
+    for project, project_ids in by_project.items():
+        path = '/data/projects/{}/{}'.format(project, listing)
+        rows = list_rows(login, path, {
+            'columns': ','.join(['ID', 'label'] + columns + field_columns)})
+        patterns = ([] if literal
+                    else [i for i in project_ids if is_regex(i)])
+        matched = (LabelMatcher(patterns).filter(
+            rows, key=itemgetter('label')) if patterns else [])
+        for id_ in project_ids:
+            if id_ in patterns:
+                continue
+            matches = [r for r in rows if id_ in (r.get('label'), r.get('ID'))]
+            if not matches:
+                raise XnatUtilsKeyError(
+                    id_, "No {} named '{}' in project '{}'".format(
+                        datatype, id_, project))
+            matched.extend(m for m in matches if m not in matched)
+        for row in matched:
+            lowered = {k.lower(): v for k, v in row.items()}
+            values = {}
+            obj = None
+            for variable, column in zip(variables, field_columns):
+                try:
+                    value = lowered[column.lower()]
+                except KeyError:
+                    # Server didn't return the column, so read the field
+                    # from the object instead
+                    if obj is None:
+                        obj = login.create_object(
+                            '{}/{}'.format(path, row['ID']))
+                    value = obj.fields.get(variable)
+                values[variable] = value if value else ''
+            yield path, row, values
+
+
+def write_table(rows, variables, out, format='csv'):
+    """
+    Writes the values returned by 'varget_many' to a file object in CSV or
+    JSON format
+    """
+    if format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=['label'] + list(variables),
+                                lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    elif format == 'json':
+        json.dump(rows, out, indent=2)
+        out.write('\n')
+    else:
+        raise XnatUtilsUsageError(
+            "Unrecognised output format '{}', can be one of '{}'".format(
+                format, "', '".join(output_formats)))
+
+
 description = """
 Gets the value of a variable (custom or otherwise) of a session or subject in a
 an XNAT instance project
 
+The values of several custom variables of many sessions or subjects can be
+exported to CSV (or JSON) by passing their IDs (or regular expressions) and the
+variable names to the '--ids' and '--variables' options instead, e.g.
+
+    $ xnat-varget --ids 'MRH001_.*' --variables age weight --output vars.csv
+
 User credentials can be stored in a ~/.netrc file so that they don't need to be
 entered each time a command is run. If a new user provided or netrc doesn't
 exist the tool will ask whether to create a ~/.netrc file with the given
@@ -76,13 +264,35 @@ credentials.
 
 def parser():
     parser = base_parser(description)
-    parser.add_argument('subject_or_session_id', type=str,
+    parser.add_argument('subject_or_session_id', type=str, nargs='?',
                         help=("Name of subject or session to get the variable "
                               "from"))
-    parser.add_argument('variable', type=str,
+    parser.add_argument('variable', type=str, nargs='?',
                         help="Name of the variable to get")
     parser.add_argument('--default', type=str, default='',
                         help="Default value if object does not have a value")
+    parser.add_argument('--ids', type=str, nargs='+', default=None,
+                        help=("Names or regular expressions of the subjects "
+                              "or sessions to export the variables of"))
+    parser.add_argument('--ids_file', type=str, default=None,
+                        help=("File listing the names of the subjects or "
+                              "sessions to export the variables of, one per "
+                              "line"))
+    parser.add_argument('--variables', type=str, nargs='+', default=None,
+                        help="Names of the variables to export")
+    parser.add_argument('--datatype', '-d', type=str, default=None,
+                        choices=('subject', 'session'),
+                        help=("Whether the IDs are of subjects or sessions "
+                              "(guessed from the number of underscores if "
+                              "not provided)"))
+    parser.add_argument('--project', '-p', type=str, default=None,
+                        help="The project the subjects/sessions belong to")
+    parser.add_argument('--format', '-f', type=str, default='csv',
+                        choices=output_formats,
+                        help="The format to export the variables in")
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help=("The file to export the variables to (printed "
+                              "if not provided)"))
     add_default_args(parser)
     return parser
 
@@ -92,15 +302,39 @@ def cmd(argv=sys.argv[1:]):
     args = parser().parse_args(argv)
 
     set_logger(args.loglevel)
+    metrics = start_metrics(args.metrics_out)
 
     try:
-        print(varget(args.subject_or_session_id, args.variable,
-                     default=args.default, user=args.user,
-                     server=args.server, use_netrc=(not args.no_netrc)),
-                     end='')
+        if (args.ids or args.ids_file or args.variables) is not None:
+            ids = list(args.ids or [])
+            if args.ids_file is not None:
+                with open(args.ids_file) as f:
+                    ids.extend(line.strip() for line in f if line.strip())
+            rows = varget_many(ids, args.variables or [],
+                               datatype=args.datatype, project_id=args.project,
+                               default=args.default, user=args.user,
+                               server=args.server,
+                               use_netrc=(not args.no_netrc))
+            if args.output is not None:
+                with open(args.output, 'w', newline='') as f:
+                    write_table(rows, args.variables, f, format=args.format)
+            else:
+                write_table(rows, args.variables, sys.stdout,
+                            format=args.format)
+        elif args.variable is None:
+            raise XnatUtilsUsageError(
+                "A subject/session and variable (or '--ids' and "
+                "'--variables') need to be provided")
+        else:
+            print(varget(args.subject_or_session_id, args.variable,
+                         default=args.default, user=args.user,
+                         server=args.server, use_netrc=(not args.no_netrc)),
+                  end='')
     except XnatUtilsUsageError as e:
         print_usage_error(e)
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    finally:
+        stop_metrics(metrics, args.metrics_out, args.metrics_format)
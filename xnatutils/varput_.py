@@ -1,9 +1,14 @@
 import sys
+import csv
+from collections import OrderedDict
 from .base import (
     connect, print_response_error, print_usage_error,
-    print_info_message, base_parser, add_default_args, set_logger)
-from xnatutils.exceptions import XnatUtilsUsageError, XnatUtilsException
-from xnat.exceptions import XNATResponseError
+    print_info_message, base_parser, add_default_args, set_logger,
+    resize_connection_pool, run_concurrently, item_errors, xnat)
+from .varget_ import _guess_datatype, _by_project, _variable_values
+from xnatutils.exceptions import (
+    XnatUtilsUsageError, XnatUtilsException, XnatUtilsKeyError)
+from .metrics import start_metrics, stop_metrics
 
 
 def varput(subject_or_session_id, variable, value, **kwargs):
@@ -60,10 +65,178 @@ def varput(subject_or_session_id, variable, value, **kwargs):
         xnat_obj.fields[variable] = value
 
 
+def varput_many(rows, jobs=1, datatype=None, project_id=None, **kwargs):
+    """
+    Sets the values of custom variables of many sessions or subjects in an
+    XNAT instance from a table of (id, variable, value) rows.
+
+    The subjects/sessions and the current values of their variables are
+    looked up with a single listing request per project, rows whose value
+    already matches the value on the server are skipped and the changed
+    variables of each subject/session are set together in a single request.
+
+    Parameters
+    ----------
+    rows : list(dict | tuple)
+        The values to set, either as dicts with 'id', 'variable' and 'value'
+        keys or (id, variable, value) tuples, where the ID is the label or
+        ID of the subject/session
+    jobs : int
+        The number of subjects/sessions to update concurrently
+    datatype : str | None
+        Whether the IDs are of 'subject's or 'session's. If not provided it
+        is guessed from the number of underscores in the IDs (one for
+        subjects and two for sessions)
+    project_id : str | None
+        The project the subjects/sessions belong to. If not provided it is
+        taken from the IDs, which need to start with the project ID followed
+        by an underscore
+    **kwargs
+        Passed on to 'connect'
+
+    Returns
+    -------
+    list(tuple(dict, bool | Exception))
+        The rows in the order they were provided (as dicts), each paired with
+        True if the value was set, False if it already matched the value on
+        the server or the error that prevented it from being set
+    """
+    rows = [dict(r) if isinstance(r, dict) else
+            dict(zip(('id', 'variable', 'value'), r)) for r in rows]
+    if not rows:
+        return []
+    # Group the values to set by subject/session
+    by_id = OrderedDict()
+    for i, row in enumerate(rows):
+        try:
+            id_, variable = row['id'], row['variable']
+        except KeyError as e:
+            raise XnatUtilsUsageError(
+                "Row {} is missing '{}'".format(i, e.args[0]))
+        value = '' if row.get('value') is None else str(row['value'])
+        fields = by_id.setdefault(id_, OrderedDict())
+        if variable in fields and rows[fields[variable]]['value'] != value:
+            raise XnatUtilsUsageError(
+                "Conflicting values provided for '{}' of '{}' ('{}' and '{}')"
+                .format(variable, id_, rows[fields[variable]]['value'],
+                        value))
+        row['value'] = value
+        fields[variable] = i
+    if datatype is None:
+        datatype = _guess_datatype(list(by_id))
+    variables = list(OrderedDict.fromkeys(r['variable'] for r in rows))
+    results = {}
+    # The classes of the data model are only built if they are needed
+    kwargs.setdefault('lazy_model', True)
+    with connect(**kwargs) as login:
+        # Only the variables that differ from the values on the server are
+        # set, with one request per subject/session
+        updates = []
+        # The IDs in the table are matched literally as they aren't patterns
+        for path, row, values in _variable_values(
+                login, _by_project(list(by_id), project_id, literal=True),
+                datatype, variables, literal=True):
+            xsi_type = row.get('xsiType') or 'xnat:subjectData'
+            # The subject/session can be referred to by both its label and ID
+            # in different rows
+            fields = OrderedDict()
+            for key in OrderedDict.fromkeys((row['label'], row['ID'])):
+                for variable, i in by_id.get(key, {}).items():
+                    fields.setdefault(variable, []).append(i)
+            changed = []
+            for variable, indices in fields.items():
+                if len(set(rows[i]['value'] for i in indices)) > 1:
+                    error = XnatUtilsUsageError(
+                        "Conflicting values provided for '{}' of '{}' ('{}')"
+                        .format(variable, row['label'], "', '".join(
+                            rows[i]['value'] for i in indices)))
+                    for i in indices:
+                        results[i] = error
+                    continue
+                for i in indices:
+                    results[i] = values[variable] != rows[i]['value']
+                if results[indices[0]]:
+                    changed.extend(indices)
+            if changed:
+                updates.append(('{}/{}'.format(path, row['ID']), xsi_type,
+                                changed))
+
+        def update(task):
+            uri, xsi_type, changed = task
+            query = {'xsiType': xsi_type}
+            for i in changed:
+                query['{}/fields/field[name={}]/field'.format(
+                    xsi_type, rows[i]['variable'])] = rows[i]['value']
+            try:
+                login.put(uri, query=query)
+            except item_errors() as e:
+                return e
+            return None
+
+        resize_connection_pool(login, jobs)
+        for (_, _, changed), error in run_concurrently(update, updates,
+                                                       jobs=jobs):
+            if error is not None:
+                for i in changed:
+                    results[i] = error
+    for i, row in enumerate(rows):
+        if i not in results:
+            results[i] = XnatUtilsKeyError(
+                row['id'], "'{}' wasn't matched by any {}".format(
+                    row['id'], datatype))
+    return [(row, results[i]) for i, row in enumerate(rows)]
+
+
+def read_table(path):
+    """
+    Reads the values to set from a CSV file, which either has 'id',
+    'variable' and 'value' columns (one row per value) or has the IDs of the
+    subjects/sessions in the first column and a column for each variable
+    (e.g. a REDCap export). Empty cells in the latter format are skipped.
+
+    Parameters
+    ----------
+    path : str
+        Path to the CSV file
+
+    Returns
+    -------
+    list(dict)
+        The rows in the form expected by 'varput_many'
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        try:
+            header = [h.strip() for h in next(reader)]
+        except StopIteration:
+            raise XnatUtilsUsageError("'{}' is empty".format(path))
+        lines = [l for l in reader if any(c.strip() for c in l)]
+    if {'id', 'variable', 'value'} <= set(header):
+        cols = [header.index(c) for c in ('id', 'variable', 'value')]
+        return [{'id': l[cols[0]].strip(), 'variable': l[cols[1]].strip(),
+                 'value': l[cols[2]] if len(l) > cols[2] else ''}
+                for l in lines]
+    if len(header) < 2:
+        raise XnatUtilsUsageError(
+            "'{}' needs to have either 'id', 'variable' and 'value' columns or "
+            "an ID column followed by a column for each variable".format(path))
+    return [{'id': l[0].strip(), 'variable': variable, 'value': value}
+            for l in lines
+            for variable, value in zip(header[1:], l[1:]) if value.strip()]
+
+
 description = """
 Sets variables (custom or otherwise) of a session or subject in an XNAT instance
 project
 
+The values of many variables of many sessions or subjects can be set from a CSV
+file with 'id', 'variable' and 'value' columns, or with the IDs in the first
+column followed by a column for each variable, e.g.
+
+    $ xnat-varput --from table.csv --jobs 8
+
+Values that already match the values on the server are skipped.
+
 User credentials can be stored in a ~/.netrc file so that they don't need to be
 entered each time a command is run. If a new user provided or netrc doesn't
 exist the tool will ask whether to create a ~/.netrc file with the given
@@ -73,12 +246,25 @@ credentials.
 
 def parser():
     parser = base_parser(description)
-    parser.add_argument('subject_or_session_id', type=str,
+    parser.add_argument('subject_or_session_id', type=str, nargs='?',
                         help=("Name of subject or session to set the variable "
                               "of"))
-    parser.add_argument('variable', type=str,
+    parser.add_argument('variable', type=str, nargs='?',
                         help="Name of the variable to set")
-    parser.add_argument('value', help="Value of the variable")
+    parser.add_argument('value', nargs='?', help="Value of the variable")
+    parser.add_argument('--from', dest='from_file', type=str, default=None,
+                        help=("CSV file containing the values to set (see "
+                              "description)"))
+    parser.add_argument('--jobs', '-J', type=int, default=1,
+                        help=("The number of subjects/sessions to update "
+                              "concurrently"))
+    parser.add_argument('--datatype', '-d', type=str, default=None,
+                        choices=('subject', 'session'),
+                        help=("Whether the IDs are of subjects or sessions "
+                              "(guessed from the number of underscores if "
+                              "not provided)"))
+    parser.add_argument('--project', '-p', type=str, default=None,
+                        help="The project the subjects/sessions belong to")
     add_default_args(parser)
     return parser
 
@@ -88,14 +274,39 @@ def cmd(argv=sys.argv[1:]):
     args = parser().parse_args(argv)
 
     set_logger(args.loglevel)
+    metrics = start_metrics(args.metrics_out)
 
     try:
-        varput(args.subject_or_session_id, args.variable, args.value,
-               user=args.user, server=args.server,
-               use_netrc=(not args.no_netrc))
+        if args.from_file is not None:
+            results = varput_many(
+                read_table(args.from_file), jobs=args.jobs,
+                datatype=args.datatype, project_id=args.project,
+                user=args.user, server=args.server,
+                use_netrc=(not args.no_netrc))
+            failed = 0
+            for row, result in results:
+                if isinstance(result, Exception):
+                    failed += 1
+                    print("Could not set '{}' of '{}': {}".format(
+                        row['variable'], row['id'], result), file=sys.stderr)
+            print("Set {} value(s), {} already up to date, {} failed".format(
+                sum(r is True for _, r in results),
+                sum(r is False for _, r in results), failed))
+            if failed:
+                sys.exit(1)
+        elif args.value is None:
+            raise XnatUtilsUsageError(
+                "A subject/session, variable and value (or '--from') need to "
+                "be provided")
+        else:
+            varput(args.subject_or_session_id, args.variable, args.value,
+                   user=args.user, server=args.server,
+                   use_netrc=(not args.no_netrc))
     except XnatUtilsUsageError as e:
         print_usage_error(e)
-    except XNATResponseError as e:
+    except xnat.exceptions.XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    finally:
+        stop_metrics(metrics, args.metrics_out, args.metrics_format)